@@ -31,3 +31,11 @@ class CreateCharacter:
     player_id: str | None = None
     universe_id: int | None = None
     parent_id: int | None = None
+
+
+@dataclass
+class LoadWorld:
+    universe_id: int
+    source: str
+    # of the file's content, filled in when the action is logged, see world_digest()
+    digest: str | None = None
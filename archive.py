@@ -0,0 +1,182 @@
+from __future__ import annotations
+
+import lzma
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_right
+from dataclasses import dataclass
+from typing import Iterable, Iterator
+
+from codec import read_varint, write_varint
+
+ZLIB_COMPRESSION = 'zlib'
+LZMA_COMPRESSION = 'lzma'
+
+COMPRESSIONS: dict[str, int] = {ZLIB_COMPRESSION: 0, LZMA_COMPRESSION: 1}
+
+SEGMENT_MAGIC = b'TPSG'
+SEGMENT_VERSION = 1
+# Blocks are compressed independently and always start at a tick boundary.
+BLOCK_SIZE = 64 * 1024
+
+# first_tick, offset and length of a block
+INDEX_ENTRY = struct.Struct('<qQI')
+# index offset, block count and magic
+FOOTER = struct.Struct('<QI4s')
+
+# An actions log row: tick, subtick, character_id, payload_json, payload, universe_id.
+Row = tuple[int, int, int, str | None, bytes | None, int | None]
+
+
+@dataclass
+class Segment:
+    first_tick: int
+    last_tick: int
+    path: str
+
+
+class Archive:
+    """
+    Append-only segment files holding the actions log rows of old ticks.
+    A segment is a header, a sequence of compressed blocks of rows, a tick -> block index and a footer.
+    Segments are read through memory mapping, decompressing only the blocks a scan needs.
+    """
+
+    directory: str
+    compression: str
+    segments: list[Segment]
+
+    def __init__(self, directory: str, compression: str = ZLIB_COMPRESSION) -> None:
+        if compression not in COMPRESSIONS:
+            raise Exception(f'Unknown archive compression: {compression}')
+        self.directory = directory
+        self.compression = compression
+        self.segments = []
+        if os.path.isdir(directory):
+            for name in sorted(os.listdir(directory)):
+                if name.endswith('.seg'):
+                    first_tick, last_tick = name[:-len('.seg')].split('-')
+                    self.segments.append(Segment(int(first_tick), int(last_tick), f'{directory}/{name}'))
+
+    def archived_until(self) -> int:
+        """
+        The last archived tick, or -1 if nothing is archived yet.
+        """
+        return self.segments[-1].last_tick if self.segments else -1
+
+    def append(self, rows: Iterable[Row]) -> None:
+        """
+        Writes the rows, ordered by tick and subtick and following the already archived ticks, as a new segment.
+        """
+        compression: int = COMPRESSIONS[self.compression]
+        content: bytearray = bytearray(SEGMENT_MAGIC)
+        content.extend((SEGMENT_VERSION, compression))
+        index: list[tuple[int, int, int]] = []
+        block: bytearray = bytearray()
+        block_first_tick: int | None = None
+        tick: int | None = None
+        for row in rows:
+            if row[0] != tick and len(block) >= BLOCK_SIZE:
+                index.append(write_block(content, block, block_first_tick, compression))
+                block = bytearray()
+                block_first_tick = None
+            tick = row[0]
+            if block_first_tick is None:
+                block_first_tick = tick
+            write_row(block, row)
+        if block_first_tick is None:
+            return
+        index.append(write_block(content, block, block_first_tick, compression))
+        first_tick: int = index[0][0]
+        if first_tick <= self.archived_until():
+            raise Exception(f'Ticks up to {self.archived_until()} are already archived')
+        index_offset: int = len(content)
+        for entry in index:
+            content.extend(INDEX_ENTRY.pack(*entry))
+        content.extend(FOOTER.pack(index_offset, len(index), SEGMENT_MAGIC))
+        os.makedirs(self.directory, exist_ok=True)
+        segment: Segment = Segment(first_tick, tick, f'{self.directory}/{first_tick:012d}-{tick:012d}.seg')
+        # A segment appears under its final name only once it is completely on disk.
+        with open(segment.path + '.tmp', 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(segment.path + '.tmp', segment.path)
+        self.segments.append(segment)
+
+    def rows(self, from_tick: int, to_tick: int) -> Iterator[Row]:
+        for segment in self.segments:
+            if segment.last_tick < from_tick or segment.first_tick >= to_tick:
+                continue
+            with open(segment.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                yield from read_segment(content, from_tick, to_tick)
+
+
+def write_row(block: bytearray, row: Row) -> None:
+    tick, subtick, character_id, payload_json, payload, universe_id = row
+    write_varint(block, tick)
+    write_varint(block, subtick)
+    write_varint(block, character_id)
+    write_varint(block, 0 if universe_id is None else universe_id + 1)
+    if payload is None:
+        block.append(0)
+        payload = payload_json.encode()
+    else:
+        block.append(1)
+    write_varint(block, len(payload))
+    block.extend(payload)
+
+
+def write_block(content: bytearray, block: bytearray, first_tick: int, compression: int) -> tuple[int, int, int]:
+    compressed: bytes = zlib.compress(block) if compression == COMPRESSIONS[ZLIB_COMPRESSION] else lzma.compress(block)
+    offset: int = len(content)
+    content.extend(compressed)
+    return first_tick, offset, len(compressed)
+
+
+def read_segment(content: mmap.mmap, from_tick: int, to_tick: int) -> Iterator[Row]:
+    if content[:len(SEGMENT_MAGIC)] != SEGMENT_MAGIC or content[len(SEGMENT_MAGIC)] != SEGMENT_VERSION:
+        raise Exception('Unsupported archive segment')
+    compression: int = content[len(SEGMENT_MAGIC) + 1]
+    index_offset, block_count, magic = FOOTER.unpack_from(content, len(content) - FOOTER.size)
+    if magic != SEGMENT_MAGIC:
+        raise Exception('Truncated archive segment')
+    index: list[tuple[int, int, int]] = [
+        INDEX_ENTRY.unpack_from(content, index_offset + i * INDEX_ENTRY.size) for i in range(block_count)
+    ]
+    first_block: int = max(bisect_right([entry[0] for entry in index], from_tick) - 1, 0)
+    for first_tick, offset, length in index[first_block:]:
+        if first_tick >= to_tick:
+            return
+        compressed: bytes = content[offset:offset + length]
+        block: bytes = zlib.decompress(compressed) if compression == COMPRESSIONS[ZLIB_COMPRESSION] \
+            else lzma.decompress(compressed)
+        position: int = 0
+        while position < len(block):
+            row, position = read_row(block, position)
+            if row[0] >= to_tick:
+                return
+            if row[0] >= from_tick:
+                yield row
+
+
+def read_row(block: bytes, position: int) -> tuple[Row, int]:
+    tick, position = read_varint(block, position)
+    subtick, position = read_varint(block, position)
+    character_id, position = read_varint(block, position)
+    universe_id, position = read_varint(block, position)
+    is_binary: bool = block[position] == 1
+    length, position = read_varint(block, position + 1)
+    payload: bytes = block[position:position + length]
+    position += length
+    row: Row = (
+        tick,
+        subtick,
+        character_id,
+        None if is_binary else payload.decode(),
+        payload if is_binary else None,
+        None if universe_id == 0 else universe_id - 1
+    )
+    return row, position
@@ -0,0 +1,213 @@
+"""
+Benchmarks of the multiverse hot paths, run with: python -m bench [--quick] [--output bench_output.txt]
+
+Every result is appended to the output file as a JSON line, along with the parameters of the run,
+so that the results of different runs can be compared.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import platform
+import shutil
+import sqlite3
+import sys
+from dataclasses import dataclass, asdict, field
+from time import gmtime, strftime
+from typing import Any
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter
+from codec import BINARY_ENCODING, JSON_ENCODING
+from multiverse import Multiverse, ROOT_CHARACTER_ID, timed
+from storage import COPY_STORAGE, DELTA_STORAGE
+
+UNIVERSE_COUNTS = (1, 10, 100, 1000, 10000)
+
+
+@dataclass
+class Result:
+    benchmark: str
+    value: float
+    unit: str
+    params: dict[str, Any] = field(default_factory=dict)
+
+
+class Bench:
+    """
+    Every benchmark runs against a fresh instance directory, removed afterwards.
+    """
+
+    actions: int
+    max_universes: int
+    durability: str
+    results: list[Result]
+
+    def __init__(self, actions: int, max_universes: int, durability: str) -> None:
+        self.actions = actions
+        self.max_universes = max_universes
+        self.durability = durability
+        self.results = []
+
+    def run(self) -> list[Result]:
+        self.apply_throughput()
+        for encoding in (JSON_ENCODING, BINARY_ENCODING):
+            self.record_action_rate(encoding)
+        for storage in (COPY_STORAGE, DELTA_STORAGE):
+            self.universe_latency(storage)
+        for universe_count in UNIVERSE_COUNTS:
+            if universe_count <= self.max_universes:
+                self.commit_latency_and_startup(universe_count)
+        return self.results
+
+    def report(self, benchmark: str, value: float, unit: str, **params: Any) -> None:
+        result: Result = Result(benchmark, value, unit, params)
+        self.results.append(result)
+        print(f'{benchmark} {params}: {value:.6g} {unit}', file=sys.stderr)
+
+    def multiverse(self, **kwargs: Any) -> Multiverse:
+        return Multiverse('.bench-' + str(uuid4()), durability=self.durability, **kwargs).__enter__()
+
+    def apply_throughput(self) -> None:
+        m: Multiverse = self.multiverse()
+        try:
+            m.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            actions: dict[str, list[Any]] = {
+                'CreatePlayer': [CreatePlayer(player_id=f'player{i}') for i in range(self.actions)],
+                'CreateCharacter': [CreateCharacter(player_id=f'player{i}', universe_id=1) for i in range(self.actions)],
+                'CreateLocation': [
+                    CreateLocation(name=f'Location {i}', universe_id=1, description='Somewhere')
+                    for i in range(self.actions)
+                ],
+                'ConnectLocations': [
+                    ConnectLocations(from_name=f'Location {i}', to_name=f'Location {i + 1}', universe_id=1, travel_time=i)
+                    for i in range(self.actions - 1)
+                ]
+            }
+            for kind, batch in actions.items():
+                self.report('apply', len(batch) / timed(lambda: apply_all(m, batch)), 'actions/s', kind=kind)
+                m.commit()
+            batch = [(CreatePlayer(player_id=f'batched{i}'), ROOT_CHARACTER_ID) for i in range(self.actions)]
+            self.report('apply_batch', len(batch) / timed(lambda: m.apply_batch(batch)), 'actions/s', kind='CreatePlayer')
+            m.commit()
+            rejected: list[Any] = [CreateLocation(name='Nowhere', universe_id=42, description='') for _ in range(self.actions)]
+            self.report('apply_rejected', len(rejected) / timed(lambda: apply_all(m, rejected)), 'actions/s')
+        finally:
+            close(m)
+
+    def record_action_rate(self, encoding: str) -> None:
+        m: Multiverse = self.multiverse(action_encoding=encoding)
+        try:
+            action: ConnectLocations = ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=1, travel_time=33)
+            m.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+
+            def record() -> None:
+                for subtick in range(self.actions):
+                    m.record_action(subtick, ROOT_CHARACTER_ID, action)
+                m.commit()
+
+            self.report('record_action', self.actions / timed(record), 'actions/s', encoding=encoding)
+        finally:
+            close(m)
+
+    def universe_latency(self, storage: str) -> None:
+        m: Multiverse = self.multiverse(storage=storage)
+        try:
+            count: int = min(self.actions, 100)
+            m.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            apply_all(m, [CreateLocation(name=f'Location {i}', universe_id=1, description='Somewhere') for i in range(100)])
+            m.commit()
+
+            def create() -> None:
+                for _ in range(count):
+                    m.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+                m.commit()
+
+            def fork() -> None:
+                for _ in range(count):
+                    m.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+                m.commit()
+
+            self.report('create_universe', timed(create) / count * 1000, 'ms', storage=storage)
+            self.report('fork_universe', timed(fork) / count * 1000, 'ms', storage=storage)
+        finally:
+            close(m)
+
+    def commit_latency_and_startup(self, universe_count: int) -> None:
+        m: Multiverse = self.multiverse()
+        instance_id: str = m.instance_id
+        try:
+            for i in range(universe_count):
+                m.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+                m.apply(CreatePlayer(player_id=f'player{i}'), ROOT_CHARACTER_ID)
+                m.apply(CreateCharacter(player_id=f'player{i}', universe_id=i + 1), ROOT_CHARACTER_ID)
+                if i % 100 == 99:
+                    m.commit()
+            m.commit()
+            rounds: int = 20
+            for dirty_count in sorted({1, min(universe_count, 100)}):
+                # Changes are made before the clock is started, the latency of commit() alone is reported.
+                latency: float = 0
+                for tick in range(rounds):
+                    for universe_id in range(1, dirty_count + 1):
+                        m.apply(
+                            CreateLocation(name=f'Location {dirty_count}-{tick}', universe_id=universe_id, description=''),
+                            ROOT_CHARACTER_ID
+                        )
+                    latency += timed(m.commit)
+                self.report(
+                    'commit',
+                    latency / rounds * 1000,
+                    'ms',
+                    universes=universe_count,
+                    dirty_universes=dirty_count
+                )
+            m.__exit__()
+            m = Multiverse(instance_id, durability=self.durability)
+            self.report('enter', timed(m.__enter__) * 1000, 'ms', universes=universe_count)
+            self.report('first_udb', timed(lambda: m.udb(universe_count)) * 1000, 'ms', universes=universe_count)
+        finally:
+            close(m)
+
+
+def apply_all(m: Multiverse, actions: list[Any]) -> None:
+    for action in actions:
+        m.apply(action, ROOT_CHARACTER_ID)
+
+
+def close(m: Multiverse) -> None:
+    m.__exit__()
+    shutil.rmtree(m.instance_id)
+
+
+def main() -> None:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(prog='python -m bench', description=__doc__)
+    parser.add_argument('--output', default='bench_output.txt', help='JSON lines file the results are appended to')
+    parser.add_argument('--actions', type=int, default=10000, help='actions per throughput benchmark')
+    parser.add_argument('--max-universes', type=int, default=UNIVERSE_COUNTS[-1])
+    parser.add_argument('--durability', default='strict')
+    parser.add_argument('--quick', action='store_true', help='a smoke run: 1000 actions, up to 100 universes')
+    args: argparse.Namespace = parser.parse_args()
+    if args.quick:
+        args.actions = min(args.actions, 1000)
+        args.max_universes = min(args.max_universes, 100)
+    # Per-action debug and error records would dominate the measurements.
+    logging.disable(logging.CRITICAL)
+    run: dict[str, Any] = {
+        'started_at': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'actions': args.actions,
+        'max_universes': args.max_universes,
+        'durability': args.durability
+    }
+    results: list[Result] = Bench(args.actions, args.max_universes, args.durability).run()
+    with open(args.output, 'a') as f:
+        for result in results:
+            f.write(json.dumps({'run': run, **asdict(result)}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
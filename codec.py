@@ -0,0 +1,193 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass, fields
+from types import NoneType, UnionType
+from typing import get_args, get_type_hints
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter, LoadWorld
+
+JSON_ENCODING = 'json'
+BINARY_ENCODING = 'binary'
+
+# The first byte of every binary payload. Bump it when the layout rules below change.
+ENCODING_VERSION = 1
+
+# Type tags are persisted in the actions log: never reuse or renumber them.
+ACTION_TAGS: dict[type, int] = {
+    CreatePlayer: 1,
+    CreateUniverse: 2,
+    CreateLocation: 3,
+    ConnectLocations: 4,
+    CreateCharacter: 5,
+    LoadWorld: 6
+}
+
+# Action classes by the kind stored in JSON payloads.
+ACTION_KINDS: dict[str, type] = {kind.__name__: kind for kind in ACTION_TAGS}
+
+# Stored in a column of its own in the actions table, so it is left out of the payload.
+UNIVERSE_ID_FIELD = 'universe_id'
+
+
+@dataclass
+class FieldLayout:
+    name: str
+    kind: type
+    optional: bool
+
+
+@dataclass
+class ActionLayout:
+    """
+    Binary payload of an action: version byte, type tag, a bitmap of the optional fields
+    which are None, and then the values of all other fields in declaration order.
+    Integers are zigzag varints of any size, strings are utf-8 prefixed with the varint length.
+    """
+
+    kind: type
+    tag: int
+    fields: list[FieldLayout]
+    has_universe_id: bool
+    bitmap_size: int
+
+
+LAYOUTS_BY_KIND: dict[type, ActionLayout] = {}
+LAYOUTS_BY_TAG: dict[int, ActionLayout] = {}
+
+
+def action_layout(kind: type) -> ActionLayout:
+    layout: ActionLayout | None = LAYOUTS_BY_KIND.get(kind)
+    if layout is not None:
+        return layout
+    hints: dict[str, any] = get_type_hints(kind)
+    field_layouts: list[FieldLayout] = []
+    for field in fields(kind):
+        if field.name == UNIVERSE_ID_FIELD:
+            continue
+        hint: any = hints[field.name]
+        optional: bool = isinstance(hint, UnionType) and NoneType in get_args(hint)
+        if optional:
+            hint = next(arg for arg in get_args(hint) if arg is not NoneType)
+        if hint not in (int, str):
+            raise Exception(f'Unsupported type of {kind.__name__}.{field.name}: {hint}')
+        field_layouts.append(FieldLayout(field.name, hint, optional))
+    optional_count: int = sum(1 for field_layout in field_layouts if field_layout.optional)
+    layout = ActionLayout(
+        kind,
+        ACTION_TAGS[kind],
+        field_layouts,
+        UNIVERSE_ID_FIELD in hints,
+        (optional_count + 7) // 8
+    )
+    LAYOUTS_BY_KIND[kind] = layout
+    LAYOUTS_BY_TAG[layout.tag] = layout
+    return layout
+
+
+def register_action_tag(kind: type, tag: int) -> None:
+    if ACTION_TAGS.get(kind, tag) != tag or (tag in LAYOUTS_BY_TAG and LAYOUTS_BY_TAG[tag].kind is not kind):
+        raise Exception(f'Action type tag is already taken: {kind.__name__}, {tag}')
+    if kind.__name__ in ACTION_KINDS and ACTION_KINDS[kind.__name__] is not kind:
+        raise Exception(f'Action kind is already taken: {kind.__name__}')
+    ACTION_TAGS[kind] = tag
+    ACTION_KINDS[kind.__name__] = kind
+    action_layout(kind)
+
+
+def unregister_action_tag(kind: type) -> None:
+    tag: int = ACTION_TAGS.pop(kind)
+    del ACTION_KINDS[kind.__name__]
+    LAYOUTS_BY_KIND.pop(kind, None)
+    LAYOUTS_BY_TAG.pop(tag, None)
+
+
+def write_varint(buffer: bytearray, value: int) -> None:
+    while value > 0x7f:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(payload: bytes, offset: int) -> tuple[int, int]:
+    value: int = 0
+    shift: int = 0
+    while True:
+        byte: int = payload[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def encode_action(action: dataclass) -> bytes:
+    if type(action) not in ACTION_TAGS:
+        raise Exception(f'Unknown action type: {type(action).__name__}')
+    layout: ActionLayout = action_layout(type(action))
+    buffer: bytearray = bytearray((ENCODING_VERSION, layout.tag))
+    bitmap_offset: int = len(buffer)
+    buffer.extend(bytes(layout.bitmap_size))
+    optional_index: int = 0
+    for field_layout in layout.fields:
+        value: int | str | None = getattr(action, field_layout.name)
+        if field_layout.optional:
+            if value is None:
+                buffer[bitmap_offset + optional_index // 8] |= 1 << (optional_index % 8)
+                optional_index += 1
+                continue
+            optional_index += 1
+        # bool is an int, but would not be decoded as a bool
+        if type(value) is not field_layout.kind:
+            raise Exception(
+                f'{layout.kind.__name__}.{field_layout.name} must be {field_layout.kind.__name__}, '
+                f'not {type(value).__name__}'
+            )
+        if field_layout.kind is int:
+            # Python integers are unbounded, so the sign is not taken from a fixed width bit.
+            write_varint(buffer, value * 2 if value >= 0 else -value * 2 - 1)
+        else:
+            encoded: bytes = value.encode()
+            write_varint(buffer, len(encoded))
+            buffer.extend(encoded)
+    return bytes(buffer)
+
+
+def decode_action_json(payload_json: str) -> dataclass:
+    payload: dict[str, any] = json.loads(payload_json)
+    return ACTION_KINDS[payload.pop('kind')](**payload)
+
+
+def decode_action(payload_json: str | None, payload: bytes | None, universe_id: int | None) -> dataclass:
+    return decode_action_json(payload_json) if payload is None else decode_action_payload(payload, universe_id)
+
+
+def decode_action_payload(payload: bytes, universe_id: int | None) -> dataclass:
+    if payload[0] != ENCODING_VERSION:
+        raise Exception(f'Unsupported action encoding version: {payload[0]}')
+    layout: ActionLayout | None = LAYOUTS_BY_TAG.get(payload[1])
+    if layout is None:
+        raise Exception(f'Unknown action type tag: {payload[1]}')
+    offset: int = 2 + layout.bitmap_size
+    values: dict[str, int | str | None] = {}
+    optional_index: int = 0
+    for field_layout in layout.fields:
+        if field_layout.optional:
+            is_none: bool = bool(payload[2 + optional_index // 8] & (1 << (optional_index % 8)))
+            optional_index += 1
+            if is_none:
+                values[field_layout.name] = None
+                continue
+        length_or_value, offset = read_varint(payload, offset)
+        if field_layout.kind is int:
+            values[field_layout.name] = (length_or_value >> 1) ^ -(length_or_value & 1)
+        else:
+            values[field_layout.name] = payload[offset:offset + length_or_value].decode()
+            offset += length_or_value
+    if layout.has_universe_id:
+        values[UNIVERSE_ID_FIELD] = universe_id
+    return layout.kind(**values)
+
+
+for action_kind in ACTION_TAGS:
+    action_layout(action_kind)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+import json
+import threading
+from collections import deque
+from dataclasses import asdict, is_dataclass
+from typing import IO
+
+DROP_ON_OVERFLOW = 'drop'
+BLOCK_ON_OVERFLOW = 'block'
+
+
+class EventSink:
+    """
+    Writes structured events as JSON lines from a background thread.
+
+    emit() only appends the event to a bounded buffer, serialization and I/O happen in the writer thread,
+    which takes all the buffered events at once. When the buffer is full, an event is either dropped
+    (and counted in dropped) or emit() waits for the writer to catch up, depending on the overflow policy.
+    """
+
+    path: str
+    capacity: int
+    overflow: str
+    dropped: int
+    buffer: deque[dict[str, any]]
+    condition: threading.Condition
+    closed: bool
+    file: IO[str]
+    writer: threading.Thread
+
+    def __init__(self, path: str, capacity: int = 65536, overflow: str = DROP_ON_OVERFLOW) -> None:
+        if overflow not in (DROP_ON_OVERFLOW, BLOCK_ON_OVERFLOW):
+            raise Exception(f'Unknown overflow policy: {overflow}')
+        self.path = path
+        self.capacity = capacity
+        self.overflow = overflow
+        self.dropped = 0
+        self.buffer = deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.file = open(path, 'a', encoding='utf-8')
+        self.writer = threading.Thread(target=self.write, name=f'EventSink({path})', daemon=True)
+        self.writer.start()
+
+    def __enter__(self) -> EventSink:
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def emit(self, event: dict[str, any]) -> None:
+        with self.condition:
+            while len(self.buffer) >= self.capacity:
+                if self.overflow == DROP_ON_OVERFLOW or self.closed:
+                    self.dropped += 1
+                    return
+                self.condition.wait()
+            self.buffer.append(event)
+            if len(self.buffer) == 1:
+                self.condition.notify_all()
+
+    def close(self) -> None:
+        """
+        Writes the buffered events and stops the writer.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.writer.join()
+        self.file.close()
+
+    def write(self) -> None:
+        while True:
+            with self.condition:
+                while not self.buffer and not self.closed:
+                    self.condition.wait()
+                if not self.buffer:
+                    return
+                events: deque[dict[str, any]] = self.buffer
+                self.buffer = deque()
+                # wakes up the producers blocked on a full buffer
+                self.condition.notify_all()
+            self.file.write(''.join(json.dumps(event, default=jsonable) + '\n' for event in events))
+            self.file.flush()
+
+
+def jsonable(value: any) -> any:
+    if is_dataclass(value):
+        return {'kind': type(value).__name__, **asdict(value)}
+    if isinstance(value, bytes):
+        return value.hex()
+    return repr(value)
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from sqlite3 import Connection
+from typing import TYPE_CHECKING, Any, Callable
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter, LoadWorld
+from codec import register_action_tag, unregister_action_tag
+from world import read_world, world_digest
+
+if TYPE_CHECKING:
+    from multiverse import Multiverse
+
+# SQL statements are kept as constants, so every call passes the very same text
+# and hits the prepared statement cache of the connection.
+INSERT_PLAYER_SQL = 'insert into players (id) values (?)'
+INSERT_UNIVERSE_SQL = 'insert into universes (parent_id) values (?)'
+INSERT_CHARACTER_SQL = 'insert into characters (parent_id, universe_id, player_id) values (?, ?, ?)'
+
+# Rejection reasons
+UNKNOWN_ACTION = 'unknown_action'
+NOT_PERMITTED = 'not_permitted'
+INVALID_ARGUMENT = 'invalid_argument'
+ALREADY_EXISTS = 'already_exists'
+NOT_FOUND = 'not_found'
+
+
+@dataclass(frozen=True)
+class Rejection:
+    """
+    An action found invalid before touching the database. Unlike errors, rejections are
+    returned without raising, so rejecting an action costs no more than a few set lookups.
+    """
+
+    reason: str
+    message: str
+
+    def __str__(self) -> str:
+        return self.message
+
+
+@dataclass
+class ActionHandler:
+    """
+    How Multiverse.apply() applies an action type.
+    """
+
+    apply: Callable[[Multiverse, Any], None]
+    # rejects the action if its arguments are obviously invalid, before anything is written;
+    # must not query the database, see the id caches of Multiverse
+    check: Callable[[Multiverse, Any], Rejection | None] | None = None
+    root_only: bool = True
+    # the action changes only the database of its universe_id, not the multiverse one
+    universe_level: bool = False
+    # writes a run of actions of this type at once, see Multiverse.apply_batch()
+    apply_batch: Callable[[Multiverse, list[Any]], None] | None = None
+    # completes the action in place before Multiverse.record_action() logs it
+    before_record: Callable[[Multiverse, Any], None] | None = None
+
+
+def no_such_universe(multiverse: Multiverse, universe_id: int | None) -> Rejection | None:
+    if universe_id is not None and universe_id not in multiverse.universe_ids:
+        return Rejection(NOT_FOUND, f'No such universe: {universe_id}')
+    return None
+
+
+def check_universe_action(
+        multiverse: Multiverse,
+        action: CreateLocation | ConnectLocations | LoadWorld
+) -> Rejection | None:
+    return no_such_universe(multiverse, action.universe_id)
+
+
+def check_create_player(multiverse: Multiverse, action: CreatePlayer) -> Rejection | None:
+    if action.player_id in multiverse.player_ids:
+        return Rejection(ALREADY_EXISTS, f'Player already exists: {action.player_id}')
+    return None
+
+
+def create_player(multiverse: Multiverse, action: CreatePlayer) -> None:
+    multiverse.mdb.execute(INSERT_PLAYER_SQL, (action.player_id,))
+    multiverse.player_ids.add(action.player_id)
+
+
+def create_players(multiverse: Multiverse, actions: list[CreatePlayer]) -> None:
+    player_ids: list[str] = [action.player_id for action in actions]
+    multiverse.mdb.executemany(INSERT_PLAYER_SQL, [(player_id,) for player_id in player_ids])
+    multiverse.player_ids.update(player_ids)
+
+
+def check_create_universe(multiverse: Multiverse, action: CreateUniverse) -> Rejection | None:
+    return no_such_universe(multiverse, action.parent_id)
+
+
+def create_universe(multiverse: Multiverse, action: CreateUniverse) -> None:
+    universe_id: int = multiverse.mdb.execute(INSERT_UNIVERSE_SQL, (action.parent_id,)).lastrowid
+    multiverse.universe_ids.add(universe_id)
+    multiverse.universe_lineage.link(universe_id, action.parent_id)
+    multiverse.universe_db_connect(universe_id, action.parent_id)
+    if action.parent_id is None:
+        multiverse.storage.create(universe_id)
+    else:
+        multiverse.storage.fork(action.parent_id, universe_id)
+
+
+def create_location(multiverse: Multiverse, action: CreateLocation) -> None:
+    multiverse.storage.create_location(action.universe_id, action.name, action.description)
+    multiverse.added(action.universe_id, locations=[(action.name, action.description)])
+
+
+def create_locations(multiverse: Multiverse, actions: list[CreateLocation]) -> None:
+    locations: list[tuple[str, str]] = [(action.name, action.description) for action in actions]
+    multiverse.storage.create_location_batch(actions[0].universe_id, locations)
+    multiverse.added(actions[0].universe_id, locations=locations)
+
+
+def check_connect_locations(multiverse: Multiverse, action: ConnectLocations) -> Rejection | None:
+    if action.from_name == action.to_name:
+        return Rejection(INVALID_ARGUMENT, 'Cannot connect location to itself')
+    if action.travel_time < 0:
+        return Rejection(INVALID_ARGUMENT, 'Travel time cannot be less than zero')
+    return no_such_universe(multiverse, action.universe_id)
+
+
+def connect_locations(multiverse: Multiverse, action: ConnectLocations) -> None:
+    multiverse.storage.connect_locations(action.universe_id, action.from_name, action.to_name, action.travel_time)
+    multiverse.added(action.universe_id, directions=both_ways([action]))
+
+
+def connect_locations_batch(multiverse: Multiverse, actions: list[ConnectLocations]) -> None:
+    multiverse.storage.connect_locations_batch(
+        actions[0].universe_id,
+        [(action.from_name, action.to_name, action.travel_time) for action in actions]
+    )
+    multiverse.added(actions[0].universe_id, directions=both_ways(actions))
+
+
+def both_ways(actions: list[ConnectLocations]) -> list[tuple[str, str, int]]:
+    return [
+        direction
+        for action in actions
+        for direction in [
+            (action.from_name, action.to_name, action.travel_time),
+            (action.to_name, action.from_name, action.travel_time)
+        ]
+    ]
+
+
+def check_create_character(multiverse: Multiverse, action: CreateCharacter) -> Rejection | None:
+    if (action.parent_id is None) == (action.player_id is None):
+        return Rejection(INVALID_ARGUMENT, 'Exactly one of parent_id or player_id must not be None')
+    if action.player_id == 'root':
+        return Rejection(INVALID_ARGUMENT, 'No additional characters are allowed for root player')
+    if action.player_id is not None and action.player_id not in multiverse.player_ids:
+        return Rejection(NOT_FOUND, f'No such player: {action.player_id}')
+    if action.parent_id is not None and action.parent_id not in multiverse.character_ids:
+        return Rejection(NOT_FOUND, f'No such character: {action.parent_id}')
+    return no_such_universe(multiverse, action.universe_id)
+
+
+def create_character(multiverse: Multiverse, action: CreateCharacter) -> None:
+    character_id: int = multiverse.mdb.execute(
+        INSERT_CHARACTER_SQL,
+        (action.parent_id, action.universe_id, action.player_id)
+    ).lastrowid
+    multiverse.character_ids.add(character_id)
+    multiverse.character_lineage.link(character_id, action.parent_id)
+
+
+def load_world(multiverse: Multiverse, action: LoadWorld) -> None:
+    conn: Connection = multiverse.udb(action.universe_id, write=True)
+    if not conn.in_transaction:
+        conn.execute('begin')
+    # A world is loaded either completely or not at all.
+    conn.execute('savepoint load_world')
+    try:
+        multiverse.storage.load_world(action.universe_id, read_world(action.source, action.digest))
+    except Exception:
+        conn.execute('rollback to load_world')
+        raise
+    finally:
+        conn.execute('release load_world')
+        multiverse.invalidate(action.universe_id)
+
+
+def record_world_digest(multiverse: Multiverse, action: LoadWorld) -> None:
+    if action.digest is None:
+        action.digest = world_digest(action.source)
+
+
+ACTION_HANDLERS: dict[type, ActionHandler] = {
+    CreatePlayer: ActionHandler(create_player, check=check_create_player, apply_batch=create_players),
+    CreateUniverse: ActionHandler(create_universe, check=check_create_universe),
+    CreateLocation: ActionHandler(
+        create_location,
+        check=check_universe_action,
+        universe_level=True,
+        apply_batch=create_locations
+    ),
+    ConnectLocations: ActionHandler(
+        connect_locations,
+        check=check_connect_locations,
+        universe_level=True,
+        apply_batch=connect_locations_batch
+    ),
+    CreateCharacter: ActionHandler(create_character, check=check_create_character),
+    LoadWorld: ActionHandler(
+        load_world,
+        check=check_universe_action,
+        universe_level=True,
+        before_record=record_world_digest
+    )
+}
+
+
+def register_action(kind: type, tag: int, handler: ActionHandler) -> None:
+    """
+    Adds an action type, e.g. from a plugin. The tag is persisted in the binary actions log, see codec.py.
+    """
+    if kind in ACTION_HANDLERS:
+        raise Exception(f'Action already registered: {kind.__name__}')
+    register_action_tag(kind, tag)
+    ACTION_HANDLERS[kind] = handler
+
+
+def unregister_action(kind: type) -> None:
+    """
+    Removes an action type added by register_action(). Logs containing it can no longer be decoded.
+    """
+    if kind not in ACTION_HANDLERS:
+        raise Exception(f'Action not registered: {kind.__name__}')
+    unregister_action_tag(kind)
+    del ACTION_HANDLERS[kind]
+
+
+def is_universe_action(action: dataclass) -> bool:
+    handler: ActionHandler | None = ACTION_HANDLERS.get(type(action))
+    return handler is not None and handler.universe_level
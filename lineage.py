@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from multiverse import Multiverse
+
+UNIVERSE_LINEAGE = 'universe'
+CHARACTER_LINEAGE = 'character'
+
+LINEAGE_SCHEMA = '''
+    create table if not exists {name}_lineage (
+        ancestor_id integer not null,
+        descendant_id integer not null,
+        depth integer not null,
+
+        primary key (ancestor_id, depth, descendant_id),
+        foreign key (ancestor_id) references {name}s (id),
+        foreign key (descendant_id) references {name}s (id)
+    ) without rowid;
+    create index if not exists {name}_lineage_descendant_id_idx on {name}_lineage (descendant_id, depth, ancestor_id);
+'''
+
+
+class Lineage:
+    """
+    Closure table of the parent_id tree of universes or characters: a row for every node and each
+    of its ancestors, the node itself included at depth 0. Both the ancestors and the descendants
+    of a node are read with a single index range scan however deep the tree is, at the cost of
+    a row per level when a node is added.
+    """
+
+    multiverse: Multiverse
+    table: str
+
+    def __init__(self, multiverse: Multiverse, name: str) -> None:
+        self.multiverse = multiverse
+        self.table = f'{name}_lineage'
+
+    def link(self, node_id: int, parent_id: int | None) -> None:
+        """
+        Adds a node created as a child of parent_id, or as a root if parent_id is None.
+        """
+        self.multiverse.mdb.execute(
+            f'''
+                insert into {self.table} (ancestor_id, descendant_id, depth)
+                select ancestor_id, ?, depth + 1 from {self.table} where descendant_id = ?
+                union all
+                select ?, ?, 0
+            ''',
+            (node_id, parent_id, node_id, node_id)
+        )
+
+    def unlink(self, node_id: int) -> None:
+        self.multiverse.mdb.execute(f'delete from {self.table} where descendant_id = ?', (node_id,))
+
+    def ancestors(self, node_id: int) -> list[int]:
+        """
+        The ancestors of the node, from its parent to the root.
+        """
+        return [row[0] for row in self.multiverse.mdb.execute(
+            f'select ancestor_id from {self.table} where descendant_id = ? and depth > 0 order by depth',
+            (node_id,)
+        )]
+
+    def descendants(self, node_id: int) -> list[int]:
+        """
+        The descendants of the node, level by level.
+        """
+        return [row[0] for row in self.multiverse.mdb.execute(
+            f'select descendant_id from {self.table} where ancestor_id = ? and depth > 0 order by depth, descendant_id',
+            (node_id,)
+        )]
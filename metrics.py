@@ -0,0 +1,198 @@
+from __future__ import annotations
+
+import re
+import threading
+from bisect import bisect_left
+from collections import Counter
+from functools import lru_cache
+from sqlite3 import Connection, Cursor
+from time import perf_counter
+from typing import Any, Iterable
+
+# Upper bounds of histogram buckets in seconds: 10 us to 10 s, two buckets per decade.
+LATENCY_BUCKETS: tuple[float, ...] = tuple(round(10 ** (exponent / 2), 7) for exponent in range(-10, 3))
+# Literals in statements are replaced with placeholders, so that the statements differing only by them add up.
+SQL_LITERAL = re.compile(r"x?'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", re.IGNORECASE)
+SQL_WHITESPACE = re.compile(r'\s+')
+
+
+class Histogram:
+    """
+    Numbers of observations per latency bucket, not cumulative. The last bucket is +Inf.
+    """
+
+    counts: list[int]
+    count: int
+    sum: float
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self) -> dict[str, any]:
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([*map(str, LATENCY_BUCKETS), '+Inf'], self.counts))
+        }
+
+
+class Metrics:
+    """
+    Opt-in instrumentation of a Multiverse, see Multiverse(metrics=True).
+
+    With SQL timing, every execute(), executemany() and executescript() call of the multiverse connections
+    is charged its whole duration, see TimedConnection. Rows a query yields after its first one are read
+    by the caller later on, so that time is not counted.
+    """
+
+    # by action class name
+    apply_seconds: dict[str, Histogram]
+    apply_batch_seconds: dict[str, Histogram]
+    # by database: multiverse or universe
+    commit_seconds: dict[str, Histogram]
+    # duration of whole commit() calls, group commits included
+    tick_commit_seconds: Histogram
+    # APPLY_ERROR records by exception type and rejections by reason
+    errors: Counter[str]
+    rejections: Counter[str]
+    sql_timing: bool
+    # by normalized statement text
+    sql_seconds: Counter[str]
+    sql_executions: Counter[str]
+    # universes may be applied and committed by several threads at once, see Multiverse(workers=...)
+    lock: threading.Lock
+
+    def __init__(self, sql_timing: bool = False) -> None:
+        self.apply_seconds = {}
+        self.apply_batch_seconds = {}
+        self.commit_seconds = {}
+        self.tick_commit_seconds = Histogram()
+        self.errors = Counter()
+        self.rejections = Counter()
+        self.sql_timing = sql_timing
+        self.sql_seconds = Counter()
+        self.sql_executions = Counter()
+        self.lock = threading.Lock()
+
+    def observe_apply(self, kind: type, seconds: float) -> None:
+        with self.lock:
+            observe(self.apply_seconds, kind.__name__, seconds)
+
+    def observe_apply_batch(self, kind: type, seconds: float) -> None:
+        with self.lock:
+            observe(self.apply_batch_seconds, kind.__name__, seconds)
+
+    def observe_commit(self, database: str, seconds: float) -> None:
+        with self.lock:
+            observe(self.commit_seconds, database, seconds)
+
+    def count_error(self, error: Exception) -> None:
+        with self.lock:
+            self.errors[type(error).__name__] += 1
+
+    def count_rejection(self, reason: str) -> None:
+        with self.lock:
+            self.rejections[reason] += 1
+
+    def observe_sql(self, sql: str, seconds: float) -> None:
+        statement: str = normalize(sql)
+        with self.lock:
+            self.sql_executions[statement] += 1
+            self.sql_seconds[statement] += seconds
+
+    def snapshot(self) -> dict[str, any]:
+        return {
+            'apply_seconds': {kind: h.snapshot() for kind, h in self.apply_seconds.items()},
+            'apply_batch_seconds': {kind: h.snapshot() for kind, h in self.apply_batch_seconds.items()},
+            'commit_seconds': {database: h.snapshot() for database, h in self.commit_seconds.items()},
+            'tick_commit_seconds': self.tick_commit_seconds.snapshot(),
+            'errors': dict(self.errors),
+            'rejections': dict(self.rejections),
+            'sql_seconds': dict(self.sql_seconds),
+            'sql_executions': dict(self.sql_executions)
+        }
+
+    def prometheus(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        lines: list[str] = []
+        for name, label, histograms in (
+                ('temporta_apply_seconds', 'kind', self.apply_seconds),
+                ('temporta_apply_batch_seconds', 'kind', self.apply_batch_seconds),
+                ('temporta_commit_seconds', 'database', self.commit_seconds),
+                ('temporta_tick_commit_seconds', None, {None: self.tick_commit_seconds})
+        ):
+            lines.append(f'# TYPE {name} histogram')
+            for value, histogram in histograms.items():
+                labels: str = '' if label is None else f'{label}="{escape(value)}",'
+                cumulative: int = 0
+                for bound, count in zip([*map(str, LATENCY_BUCKETS), '+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+                labels = labels.rstrip(',')
+                lines.append(f'{name}_sum{{{labels}}} {histogram.sum}' if labels else f'{name}_sum {histogram.sum}')
+                lines.append(f'{name}_count{{{labels}}} {histogram.count}' if labels else f'{name}_count {histogram.count}')
+        for name, label, counter in (
+                ('temporta_apply_errors_total', 'type', self.errors),
+                ('temporta_apply_rejections_total', 'reason', self.rejections),
+                ('temporta_sql_seconds_total', 'statement', self.sql_seconds),
+                ('temporta_sql_executions_total', 'statement', self.sql_executions)
+        ):
+            lines.append(f'# TYPE {name} counter')
+            for value, count in counter.items():
+                lines.append(f'{name}{{{label}="{escape(value)}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+class TimedConnection(Connection):
+    """
+    A connection reporting the duration of its statements to metrics, which is set right after connecting:
+    sqlite3.connect(path, factory=TimedConnection).
+    """
+
+    metrics: Metrics
+
+    def execute(self, sql: str, parameters: Any = (), /) -> Cursor:
+        started: float = perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.metrics.observe_sql(sql, perf_counter() - started)
+
+    def executemany(self, sql: str, parameters: Iterable[Any], /) -> Cursor:
+        started: float = perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self.metrics.observe_sql(sql, perf_counter() - started)
+
+    def executescript(self, sql: str, /) -> Cursor:
+        started: float = perf_counter()
+        try:
+            return super().executescript(sql)
+        finally:
+            self.metrics.observe_sql(sql, perf_counter() - started)
+
+
+@lru_cache(maxsize=1024)
+def normalize(sql: str) -> str:
+    return SQL_WHITESPACE.sub(' ', SQL_LITERAL.sub('?', sql)).strip()
+
+
+def observe(histograms: dict[str, Histogram], name: str, seconds: float) -> None:
+    histogram: Histogram | None = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    histogram.observe(seconds)
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
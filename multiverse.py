@@ -3,16 +3,117 @@ from __future__ import annotations
 import json
 import logging
 import os
+import shutil
 import sqlite3
-from dataclasses import dataclass, asdict
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict, replace
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 from pathlib import Path
-from sqlite3 import Connection
+from sqlite3 import Connection, Cursor
+from time import monotonic, perf_counter
+from typing import Any, Callable, Iterable, Iterator
 
-from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter
+from archive import ZLIB_COMPRESSION, Archive, Row
+from codec import BINARY_ENCODING, JSON_ENCODING, decode_action, encode_action
+from handlers import (
+    ACTION_HANDLERS, NOT_FOUND, NOT_PERMITTED, UNKNOWN_ACTION, ActionHandler, Rejection, is_universe_action
+)
+from events import EventSink
+from lineage import CHARACTER_LINEAGE, LINEAGE_SCHEMA, UNIVERSE_LINEAGE, Lineage
+from metrics import Metrics, TimedConnection
+from perception import Perception, PerceptionDiff, SensorySystem, diff, digest
+from routing import Route, Router
+from storage import (
+    COPY_STORAGE, DELTA_STORAGE, TEMPORAL_STORAGE, CopyStorage, DeltaStorage, TemporalStorage, UniverseView
+)
 
 ROOT_PLAYER_ID = 'root'
 ROOT_CHARACTER_ID = 0
+# checkpoints.universe_id of the multiverse database snapshots
+MULTIVERSE_CHECKPOINT_ID = 0
+# rows fetched from SQLite at once when streaming the actions log
+PREFETCH_ROWS = 256
+MAX_TICK = 2 ** 63 - 1
+# prepared statements kept by every connection, see the SQL constants of handlers.py
+CACHED_STATEMENTS = 512
+# database kinds in commit metrics
+MULTIVERSE_DATABASE = 'multiverse'
+UNIVERSE_DATABASE = 'universe'
+# columns of an actions log Row
+ROW_COLUMNS = ('tick', 'subtick', 'character_id', 'payload_json', 'payload', 'universe_id')
 
+# properties.schema_version of the multiverse databases written by this version, see Multiverse.__enter__()
+SCHEMA_VERSION = 2
+# version -> the script bringing a multiverse database of that version to the next one
+MIGRATIONS: dict[int, str] = {
+    # The baseline schema, not recording its version: actions carried JSON payloads only,
+    # and there was no lineage to backfill from the parent_id columns.
+    1: '''
+        begin;
+        alter table actions rename to actions_v1;
+        create table actions (
+            tick integer not null,
+            subtick integer not null,
+            payload_json text,
+            payload blob,
+            character_id integer not null,
+            universe_id integer,
+
+            check ((payload_json is null) != (payload is null)),
+            primary key (tick, subtick),
+            foreign key (character_id) references characters (id),
+            foreign key (universe_id) references universes (id)
+        );
+        insert into actions (tick, subtick, payload_json, character_id, universe_id)
+        select tick, subtick, payload_json, character_id, universe_id from actions_v1;
+        drop table actions_v1;
+    ''' + ''.join(
+        LINEAGE_SCHEMA.format(name=name) + f'''
+            insert into {name}_lineage (ancestor_id, descendant_id, depth)
+            with recursive closure (ancestor_id, descendant_id, depth) as (
+                select id, id, 0 from {name}s
+                union all
+                select n.parent_id, c.descendant_id, c.depth + 1
+                from closure c join {name}s n on n.id = c.ancestor_id
+                where n.parent_id is not null
+            )
+            select ancestor_id, descendant_id, depth from closure;
+        '''
+        for name in (UNIVERSE_LINEAGE, CHARACTER_LINEAGE)
+    ) + '''
+        insert into properties (name, value) values ('schema_version', 2);
+        commit;
+    '''
+}
+
+# Pragmas set on every connection of a multiverse, by durability profile name.
+# strict: rollback journal with a full fsync on every commit, as SQLite does by default.
+# wal: write-ahead log, fsync only on checkpoints; a power loss may drop the last commits.
+# fast: write-ahead log without any fsync; an OS crash may drop the last commits.
+DURABILITY_PROFILES: dict[str, dict[str, str | int]] = {
+    'strict': {
+        'journal_mode': 'delete',
+        'synchronous': 'full',
+        'cache_size': -2000,
+        'mmap_size': 0
+    },
+    'wal': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -16000,
+        'mmap_size': 64 * 1024 * 1024
+    },
+    'fast': {
+        'journal_mode': 'wal',
+        'synchronous': 'off',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024
+    }
+}
 
 @dataclass
 class UniverseDatabase:
@@ -20,59 +121,238 @@ class UniverseDatabase:
     parent_universe_id: int | None
 
 
+@dataclass
+class ReplayStats:
+    ticks: int
+    actions: int
+    seconds: float
+
+    @property
+    def ticks_per_second(self) -> float:
+        return self.ticks / self.seconds if self.seconds > 0 else float('inf')
+
+
 class Multiverse:
     instance_id: str
     mdb: Connection
+    # open universe databases, from the least to the most recently used one
+    universe_dbs: OrderedDict[int, UniverseDatabase]
+    max_open_universes: int
     tick: int
+    storage: CopyStorage | DeltaStorage | TemporalStorage
+    router: Router
+    # closure tables of the universe and character trees
+    universe_lineage: Lineage
+    character_lineage: Lineage
+    senses: SensorySystem
+    # universes written during the current tick, the only ones commit() has to flush
+    dirty_universe_ids: set[int]
+    # number of universe databases flushed by the last commit()
+    flushed_universe_count: int
+    durability: str
+    # group commit: commit() makes the changes durable once either limit is reached
+    commit_every_ticks: int
+    commit_every_ms: int | None
+    uncommitted_ticks: int
+    committed_at: float
+    storage_name: str
+    # how record_action() encodes actions: JSON text or compact binary, see codec.py
+    action_encoding: str
+    # segments of the actions log rows older than archive_horizon ticks, moved out by compact()
+    archive: Archive
+    archive_horizon: int
+    archive_every_ticks: int | None
+    flatten_depth: int
+    # checkpoint policy: a checkpoint is taken once either limit is reached
+    checkpoint_every_ticks: int | None
+    checkpoint_every_actions: int | None
+    # retention: the most recent checkpoints are all kept, of the older ones only the oldest one per age range,
+    # the ranges doubling from checkpoint_sparse_ticks on, so that their number grows logarithmically with the history
+    checkpoint_keep_recent: int
+    checkpoint_sparse_ticks: int
+    checkpoint_tick: int
+    actions_since_checkpoint: int
+    # universes written since the last checkpoint, the only ones the next checkpoint has to copy
+    checkpoint_dirty_ids: set[int]
+    checkpoint_all: bool
+    # ids known to exist, so that validate() rejects actions referring to missing ones without querying
+    player_ids: set[str]
+    universe_ids: set[int]
+    character_ids: set[int]
+    rejected_action_count: int
+    # None unless enabled, so that instrumentation costs a single attribute check
+    metrics: Metrics | None
+    # receives the per-action events; when None, the events are not even built
+    events: EventSink | None
+    # with more than one worker, apply_batch() and flush() process universes in parallel, see apply_partitions()
+    workers: int
+    executor: ThreadPoolExecutor | None
+    # commit() logs the digests of the characters' perceptions, see record_perceptions()
+    perception_log: bool
+    # the latest logged digest of every character
+    perception_digests: dict[int, bytes]
+    counters_lock: threading.Lock
 
-    def __init__(self, instance_id: str) -> None:
+    def __init__(
+            self,
+            instance_id: str,
+            storage: str = COPY_STORAGE,
+            flatten_depth: int = 32,
+            max_open_universes: int = 1024,
+            durability: str = 'strict',
+            commit_every_ticks: int = 1,
+            commit_every_ms: int | None = None,
+            checkpoint_every_ticks: int | None = None,
+            checkpoint_every_actions: int | None = None,
+            checkpoint_keep_recent: int = 8,
+            checkpoint_sparse_ticks: int = 1024,
+            action_encoding: str = JSON_ENCODING,
+            archive_horizon: int = 1024,
+            archive_every_ticks: int | None = None,
+            archive_compression: str = ZLIB_COMPRESSION,
+            metrics: bool = False,
+            sql_timing: bool = False,
+            events: EventSink | None = None,
+            workers: int = 1,
+            perception_log: bool = False
+    ) -> None:
+        # Forking needs both the parent and the child open, and delta storage reads need the whole chain.
+        if max_open_universes < 2 or (storage == DELTA_STORAGE and max_open_universes <= flatten_depth):
+            raise Exception(f'Too few open universes allowed: {max_open_universes}')
+        if durability not in DURABILITY_PROFILES:
+            raise Exception(f'Unknown durability profile: {durability}')
+        if action_encoding not in (JSON_ENCODING, BINARY_ENCODING):
+            raise Exception(f'Unknown action encoding: {action_encoding}')
         self.instance_id = instance_id
-        self.universe_dbs = {}
+        self.universe_dbs = OrderedDict()
+        self.max_open_universes = max_open_universes
         self.tick = 0
+        self.dirty_universe_ids = set()
+        self.flushed_universe_count = 0
+        self.durability = durability
+        self.commit_every_ticks = commit_every_ticks
+        self.commit_every_ms = commit_every_ms
+        self.uncommitted_ticks = 0
+        self.committed_at = monotonic()
+        self.storage_name = storage
+        self.action_encoding = action_encoding
+        self.archive = Archive(f'{instance_id}/archive', archive_compression)
+        self.archive_horizon = archive_horizon
+        self.archive_every_ticks = archive_every_ticks
+        self.flatten_depth = flatten_depth
+        self.checkpoint_every_ticks = checkpoint_every_ticks
+        self.checkpoint_every_actions = checkpoint_every_actions
+        self.checkpoint_keep_recent = max(checkpoint_keep_recent, 1)
+        self.checkpoint_sparse_ticks = checkpoint_sparse_ticks
+        self.checkpoint_tick = 0
+        self.actions_since_checkpoint = 0
+        self.checkpoint_dirty_ids = set()
+        # Changes made before the instance was opened are not tracked, so the first checkpoint copies everything.
+        self.checkpoint_all = True
+        self.player_ids = set()
+        self.universe_ids = set()
+        self.character_ids = set()
+        self.rejected_action_count = 0
+        self.router = Router(self)
+        self.universe_lineage = Lineage(self, UNIVERSE_LINEAGE)
+        self.character_lineage = Lineage(self, CHARACTER_LINEAGE)
+        self.senses = SensorySystem(self)
+        self.metrics = Metrics(sql_timing) if metrics or sql_timing else None
+        self.events = events
+        self.workers = workers
+        self.executor = None
+        self.counters_lock = threading.Lock()
+        self.perception_log = perception_log
+        self.perception_digests = {}
+        if workers > 1 and storage == DELTA_STORAGE:
+            raise Exception(f'Parallel application is not supported by {DELTA_STORAGE} storage')
+        if storage == COPY_STORAGE:
+            self.storage = CopyStorage(self)
+        elif storage == TEMPORAL_STORAGE:
+            self.storage = TemporalStorage(self)
+        elif storage == DELTA_STORAGE:
+            self.storage = DeltaStorage(self, flatten_depth)
+        else:
+            raise Exception(f'Unknown universe storage: {storage}')
 
     def __enter__(self) -> Multiverse:
         database_path = f'{self.instance_id}/multiverse.db'
         database_exists = os.path.isfile(database_path)
         Path(self.instance_id).mkdir(parents=True, exist_ok=True)
-        self.mdb = sqlite3.connect(database_path)
-        self.mdb.execute('pragma foreign_keys = 1')
+        self.mdb = self.connect(database_path)
+        schema_version: int = self.schema_version() if database_exists else SCHEMA_VERSION
+        if schema_version > SCHEMA_VERSION:
+            raise Exception(f'Multiverse database schema version {schema_version} is newer than {SCHEMA_VERSION}')
+        for version in range(schema_version, SCHEMA_VERSION):
+            self.mdb.executescript(MIGRATIONS[version])
+        # Every start makes sure the whole schema is in place, the objects added since the last migration included.
+        self.mdb.executescript('''
+            create table if not exists players (
+                id text primary key
+            );
+            create table if not exists properties (
+                name text primary key,
+                value blob
+            );
+            create table if not exists universes (
+                id integer primary key,
+                parent_id integer,
+                
+                foreign key (parent_id) references universes (id)
+            );
+            create table if not exists characters (
+                id integer primary key,
+                parent_id integer,
+                universe_id integer,
+                player_id text,
+
+                foreign key (parent_id) references characters (id),
+                foreign key (universe_id) references universes (id),
+                foreign key (player_id) references players (id)
+            );
+            create table if not exists actions (
+                tick integer not null,
+                subtick integer not null,
+                payload_json text,
+                payload blob,
+                character_id integer not null,
+                universe_id integer,
+                
+                check ((payload_json is null) != (payload is null)),
+                primary key (tick, subtick),
+                foreign key (character_id) references characters (id),
+                foreign key (universe_id) references universes (id)
+            );
+            create index if not exists actions_character_id_idx on actions (character_id, tick, subtick);
+            create index if not exists actions_universe_id_idx on actions (universe_id, tick, subtick);
+            create table if not exists checkpoints (
+                universe_id integer not null,
+                tick integer not null,
+
+                primary key (universe_id, tick)
+            );
+            create table if not exists perceptions (
+                character_id integer not null,
+                tick integer not null,
+                digest blob not null,
+
+                primary key (character_id, tick),
+                foreign key (character_id) references characters (id)
+            ) without rowid;
+            create table if not exists replay_lags (
+                character_id integer primary key,
+                lag integer not null,
+
+                foreign key (character_id) references characters (id)
+            );
+            create table if not exists universe_shards (
+                universe_id integer primary key,
+                shard integer not null,
+
+                foreign key (universe_id) references universes (id)
+            );
+        ''' + LINEAGE_SCHEMA.format(name=UNIVERSE_LINEAGE) + LINEAGE_SCHEMA.format(name=CHARACTER_LINEAGE))
         if not database_exists:
-            self.mdb.executescript('''
-                create table players (
-                    id text primary key
-                );
-                create table properties (
-                    name text primary key,
-                    value blob
-                );
-                create table universes (
-                    id integer primary key,
-                    parent_id integer,
-                    
-                    foreign key (parent_id) references universes (id)
-                );
-                create table characters (
-                    id integer primary key,
-                    parent_id integer,
-                    universe_id integer,
-                    player_id text,
-
-                    foreign key (parent_id) references characters (id),
-                    foreign key (universe_id) references universes (id),
-                    foreign key (player_id) references players (id)
-                );
-                create table actions (
-                    tick integer not null,
-                    subtick integer not null,
-                    payload_json text not null,
-                    character_id integer not null,
-                    universe_id integer,
-                    
-                    primary key (tick, subtick),
-                    foreign key (character_id) references characters (id),
-                    foreign key (universe_id) references universes (id)
-                );
-            ''')
             self.mdb.execute(
                 'insert into properties (name, value) values (?, ?)',
                 ('tick', 0)
@@ -82,119 +362,328 @@ class Multiverse:
                 insert into characters (id, parent_id, universe_id, player_id)
                 values (?, null, null, 'root')
             ''', (ROOT_CHARACTER_ID, ))
-            self.mdb.commit()
-        for row in self.mdb.execute('select id, parent_id from universes').fetchall():
-            self.universe_db_connect(row[0], row[1])
+            self.character_lineage.link(ROOT_CHARACTER_ID, None)
+            self.mdb.execute(
+                "insert into properties (name, value) values ('schema_version', ?)",
+                (SCHEMA_VERSION,)
+            )
+        self.mdb.commit()
+        self.tick = self.mdb.execute("select value from properties where name = 'tick'").fetchone()[0]
+        self.checkpoint_tick = self.mdb.execute(
+            'select coalesce(max(tick), 0) from checkpoints where universe_id = ?',
+            (MULTIVERSE_CHECKPOINT_ID,)
+        ).fetchone()[0]
+        if self.workers > 1:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Multiverse')
+        self.player_ids = {row[0] for row in self.mdb.execute('select id from players')}
+        self.universe_ids = {row[0] for row in self.mdb.execute('select id from universes')}
+        self.character_ids = {row[0] for row in self.mdb.execute('select id from characters')}
+        # SQLite takes the bare columns of an aggregate query from the row holding the max()
+        self.perception_digests = {
+            character_id: digest
+            for character_id, digest, _ in self.mdb.execute(
+                'select character_id, digest, max(tick) from perceptions group by character_id'
+            )
+        }
         return self
 
     def __exit__(self, *args) -> None:
+        # A clean shutdown makes the ticks committed since the last flush durable.
+        if self.uncommitted_ticks > 0 and (not args or args[0] is None):
+            self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
         for _, udb in self.universe_dbs.items():
             udb.connection.close()
         self.mdb.close()
+        # Nothing of the closed connections survives, so that the same object can be entered again.
+        self.universe_dbs.clear()
+        self.dirty_universe_ids.clear()
+        self.uncommitted_ticks = 0
+        self.checkpoint_dirty_ids.clear()
+        self.checkpoint_all = True
+        self.router = Router(self)
+        self.senses = SensorySystem(self)
+        if isinstance(self.storage, DeltaStorage):
+            self.storage.bases.clear()
 
-    def universe_db_connect(self, universe_id: int, parent_universe_id: int | None) -> None:
-        conn: Connection = sqlite3.connect(f'{self.instance_id}/{universe_id}.db')
+    def schema_version(self) -> int:
+        row: tuple[int] | None = self.mdb.execute(
+            "select value from properties where name = 'schema_version'"
+        ).fetchone()
+        return 1 if row is None else row[0]
+
+    def connect(self, path: str) -> Connection:
+        sql_timing: bool = self.metrics is not None and self.metrics.sql_timing
+        conn: Connection = sqlite3.connect(
+            path,
+            cached_statements=CACHED_STATEMENTS,
+            # Python's sqlite3 serializes the access to a connection, and in parallel mode a universe
+            # is only ever accessed by the worker its partition is assigned to.
+            check_same_thread=self.workers == 1,
+            factory=TimedConnection if sql_timing else Connection
+        )
+        if sql_timing:
+            conn.metrics = self.metrics
         conn.execute('pragma foreign_keys = 1')
-        self.universe_dbs[universe_id] = UniverseDatabase(conn, parent_universe_id)
+        for name, value in DURABILITY_PROFILES[self.durability].items():
+            conn.execute(f'pragma {name} = {value}')
+        return conn
+
+    def universe_db_connect(self, universe_id: int, parent_universe_id: int | None) -> UniverseDatabase:
+        while len(self.universe_dbs) >= self.max_open_universes:
+            self.universe_db_close(next(iter(self.universe_dbs)))
+        conn: Connection = self.connect(f'{self.instance_id}/{universe_id}.db')
+        udb: UniverseDatabase = UniverseDatabase(conn, parent_universe_id)
+        self.universe_dbs[universe_id] = udb
+        return udb
+
+    def universe_db_close(self, universe_id: int) -> None:
+        udb: UniverseDatabase = self.universe_dbs.pop(universe_id)
+        udb.connection.commit()
+        udb.connection.close()
+        if universe_id in self.dirty_universe_ids:
+            self.dirty_universe_ids.remove(universe_id)
+            self.checkpoint_dirty_ids.add(universe_id)
+        self.invalidate(universe_id)
+
+    def validate(self, handler: ActionHandler | None, action: dataclass, character_id: int) -> Rejection | None:
+        if handler is None:
+            return Rejection(UNKNOWN_ACTION, f'Unknown action: {type(action).__name__}')
+        if handler.root_only and character_id != ROOT_CHARACTER_ID:
+            return Rejection(NOT_PERMITTED, 'Action permitted only for root character')
+        if character_id not in self.character_ids:
+            return Rejection(NOT_FOUND, f'No such character: {character_id}')
+        return None if handler.check is None else handler.check(self, action)
 
     def apply(
             self,
             action: dataclass,
             character_id: int
-    ) -> None:
-        logging.debug({
-            'event_type': 'BEFORE_APPLY',
-            'tick': self.tick,
-            'action': action
-        })
+    ) -> Exception | Rejection | None:
+        if self.events is not None:
+            self.events.emit({
+                'event_type': 'BEFORE_APPLY',
+                'tick': self.tick,
+                'character_id': character_id,
+                'action': action
+            })
+        handler: ActionHandler | None = ACTION_HANDLERS.get(type(action))
+        rejection: Rejection | None = self.validate(handler, action, character_id)
+        if rejection is not None:
+            return self.apply_rejection(action, rejection)
+        started: float = 0 if self.metrics is None else perf_counter()
         try:
-            match action:
-
-                case CreatePlayer(player_id):
-                    if character_id != ROOT_CHARACTER_ID:
-                        raise Exception('Action permitted only for root character')
-                    self.mdb.execute('insert into players (id) values (?)', (player_id,))
-
-                case CreateUniverse(parent_id):
-                    if character_id != ROOT_CHARACTER_ID:
-                        raise Exception('Action permitted only for root character')
-                    universe_id: int = self.mdb.execute(
-                        'insert into universes (parent_id) values (?)',
-                        (parent_id,)
-                    ).lastrowid
-                    self.universe_db_connect(universe_id, parent_id)
-                    self.udb(universe_id).executescript('''
-                        create table locations (
-                            name text primary key,
-                            description text not null
-                        );
-                        create table directions (
-                            from_name text not null,
-                            to_name text not null,
-                            travel_time integer not null,
-                            ordinal integer not null,
-
-                            foreign key (from_name) references locations (name),
-                            foreign key (to_name) references locations (name),
-                            primary key (from_name, to_name),
-                            unique (from_name, ordinal)
-                        );
-                        create index directions_from_name_idx on directions (from_name);
-                    ''')
-
-                case CreateLocation(name, universe_id, description):
-                    if character_id != ROOT_CHARACTER_ID:
-                        raise Exception('Action permitted only for root character')
-                    self.udb(universe_id).execute(
-                        'insert into locations (name, description) values (?, ?)',
-                        (name, description)
-                    )
-
-                case ConnectLocations(from_name, to_name, universe_id, travel_time):
-                    if character_id != ROOT_CHARACTER_ID:
-                        raise Exception('Action permitted only for root character')
-                    if from_name == to_name:
-                        raise Exception('Cannot connect location to itself')
-                    if travel_time < 0:
-                        raise Exception('Travel time cannot be less than zero')
-                    self.udb(universe_id).executemany(
-                        '''
-                            insert into directions values
-                            (?, ?, ?, (select count(*) from directions where from_name = ?))
-                        ''',
-                        [
-                            (from_name, to_name, travel_time, from_name),
-                            (to_name, from_name, travel_time, to_name)
-                        ]
-                    )
-
-                case CreateCharacter(player_id, universe_id, parent_id):
-                    if character_id != ROOT_CHARACTER_ID:
-                        raise Exception('Action permitted only for root character')
-                    if (parent_id is None) == (player_id is None):
-                        raise Exception('Exactly one of parent_id or player_id must not be None')
-                    if player_id == 'root':
-                        raise Exception('No additional characters are allowed for root player')
-                    self.mdb.execute(
-                        'insert into characters (parent_id, universe_id, player_id) values (?, ?, ?)',
-                        (parent_id, universe_id, player_id)
-                    )
-
-                # TODO handle unmatched
-
+            handler.apply(self, action)
         except Exception as e:
-            # TODO send error message back to user
-            # TODO implement messaging
+            return self.apply_error(action, e)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe_apply(type(action), perf_counter() - started)
+        return None
 
-            logging.error({
-                'event_type': 'APPLY_ERROR',
+    def apply_rejection(self, action: dataclass, rejection: Rejection) -> Rejection:
+        with self.counters_lock:
+            self.rejected_action_count += 1
+        if self.metrics is not None:
+            self.metrics.count_rejection(rejection.reason)
+        if self.events is not None:
+            self.events.emit({
+                'event_type': 'APPLY_REJECTED',
                 'tick': self.tick,
-                'error': e,
+                'reason': rejection.reason,
                 'action': action
             })
+        return rejection
+
+    def apply_error(self, action: dataclass, error: Exception) -> Exception:
+        # TODO send error message back to user
+        # TODO implement messaging
+
+        if self.metrics is not None:
+            self.metrics.count_error(error)
+        event: dict[str, any] = {
+            'event_type': 'APPLY_ERROR',
+            'tick': self.tick,
+            'error': error,
+            'action': action
+        }
+        logging.error(event)
+        if self.events is not None:
+            self.events.emit(event)
+        return error
+
+    def apply_batch(self, actions: list[tuple[dataclass, int]]) -> list[Exception | Rejection | None]:
+        """
+        Applies actions with the same outcome as calling apply() for each of them in order,
+        and returns the error of each action (None on success).
+
+        Multiverse-level actions keep their order and split the batch into segments.
+        Within a segment, universe-level actions are grouped by universe, as universes
+        are independent of each other. Runs of the same action type are then written
+        to the database with a single executemany.
+        """
+        errors: list[Exception | Rejection | None] = [None] * len(actions)
+        multiverse_indices: list[int] = []
+        universe_indices: dict[int, list[int]] = {}
+        for index, (action, _) in enumerate(actions):
+            if is_universe_action(action):
+                self.apply_runs(actions, multiverse_indices, errors)
+                multiverse_indices.clear()
+                universe_indices.setdefault(action.universe_id, []).append(index)
+            else:
+                self.apply_partitions(actions, universe_indices, errors)
+                universe_indices.clear()
+                multiverse_indices.append(index)
+        self.apply_runs(actions, multiverse_indices, errors)
+        self.apply_partitions(actions, universe_indices, errors)
+        return errors
+
+    def apply_partitions(
+            self,
+            actions: list[tuple[dataclass, int]],
+            universe_indices: dict[int, list[int]],
+            errors: list[Exception | Rejection | None]
+    ) -> None:
+        """
+        Applies the universe-level actions of a segment, partitioned by universe, on the worker pool if any.
+        A worker touches only the database of its partition's universe, and all of them are opened
+        beforehand, so that no worker evicts a connection another one is using.
+        """
+        if self.executor is None or len(universe_indices) < 2:
+            for indices in universe_indices.values():
+                self.apply_runs(actions, indices, errors)
+            return
+        universe_ids: list[int] = list(universe_indices)
+        for start in range(0, len(universe_ids), self.max_open_universes):
+            partition_ids: list[int] = universe_ids[start:start + self.max_open_universes]
+            for universe_id in partition_ids:
+                if universe_id in self.universe_ids:
+                    self.udb(universe_id)
+            for _ in self.executor.map(
+                    lambda universe_id: self.apply_runs(actions, universe_indices[universe_id], errors),
+                    partition_ids
+            ):
+                pass
+
+    def apply_runs(
+            self,
+            actions: list[tuple[dataclass, int]],
+            indices: list[int],
+            errors: list[Exception | Rejection | None]
+    ) -> None:
+        for kind, run in groupby(indices, key=lambda i: type(actions[i][0])):
+            run: list[int] = list(run)
+            handler: ActionHandler | None = ACTION_HANDLERS.get(kind)
+            if len(run) > 1 and handler is not None and handler.apply_batch is not None:
+                self.apply_run(kind, handler, actions, run, errors)
+            else:
+                for index in run:
+                    errors[index] = self.apply(*actions[index])
+
+    def apply_run(
+            self,
+            kind: type,
+            handler: ActionHandler,
+            actions: list[tuple[dataclass, int]],
+            run: list[int],
+            errors: list[Exception | Rejection | None]
+    ) -> None:
+        if self.events is not None:
+            self.events.emit({
+                'event_type': 'BEFORE_APPLY_BATCH',
+                'tick': self.tick,
+                'kind': kind.__name__,
+                'size': len(run)
+            })
+        valid: list[int] = []
+        for index in run:
+            action, character_id = actions[index]
+            rejection: Rejection | None = self.validate(handler, action, character_id)
+            if rejection is None:
+                valid.append(index)
+            else:
+                errors[index] = self.apply_rejection(action, rejection)
+        if not valid:
+            return
+        batch: list[dataclass] = [actions[index][0] for index in valid]
+        try:
+            conn: Connection = self.udb(batch[0].universe_id, write=True) if handler.universe_level else self.mdb
+        except Exception:
+            for index in valid:
+                errors[index] = self.apply(*actions[index])
+            return
+        if not conn.in_transaction:
+            conn.execute('begin')
+        conn.execute('savepoint apply_batch')
+        started: float = 0 if self.metrics is None else perf_counter()
+        try:
+            handler.apply_batch(self, batch)
+            conn.execute('release apply_batch')
+            if self.metrics is not None:
+                self.metrics.observe_apply_batch(kind, perf_counter() - started)
+        except Exception:
+            # Some action of the run is invalid: fall back to one by one application to find it.
+            conn.execute('rollback to apply_batch')
+            conn.execute('release apply_batch')
+            for index in valid:
+                errors[index] = self.apply(*actions[index])
+
+    def udb(self, universe_id: int, write: bool = False) -> Connection:
+        udb: UniverseDatabase | None = self.universe_dbs.get(universe_id)
+        if udb is None:
+            row: tuple[int | None] | None = self.mdb.execute(
+                'select parent_id from universes where id = ?',
+                (universe_id,)
+            ).fetchone()
+            if row is None:
+                raise Exception(f'No such universe: {universe_id}')
+            udb = self.universe_db_connect(universe_id, row[0])
+        else:
+            self.universe_dbs.move_to_end(universe_id)
+        if write:
+            self.dirty_universe_ids.add(universe_id)
+        return udb.connection
+
+    def locations(self, universe_id: int) -> list[tuple[str, str]]:
+        return self.storage.locations(universe_id)
+
+    def directions(self, universe_id: int) -> list[tuple[str, str, int, int]]:
+        return self.storage.directions(universe_id)
 
-    def udb(self, universe_id: int) -> Connection:
-        return self.universe_dbs[universe_id].connection
+    def route(self, universe_id: int, from_name: str, to_name: str) -> Route | None:
+        return self.router.route(universe_id, from_name, to_name)
+
+    def invalidate(self, universe_id: int) -> None:
+        """
+        Drops everything derived from the state of the universe. Called by the handlers changing it.
+        """
+        self.router.invalidate(universe_id)
+        self.senses.invalidate(universe_id)
+
+    def added(
+            self,
+            universe_id: int,
+            locations: Iterable[tuple[str, str]] = (),
+            directions: Iterable[tuple[str, str, int]] = ()
+    ) -> None:
+        """
+        Called by the handlers adding locations and directions to the universe instead of invalidate():
+        the additions are folded into the digest of its perception rather than making it read the universe again.
+        """
+        self.router.invalidate(universe_id)
+        self.senses.add(universe_id, locations, directions)
+
+    def view(self, universe_id: int, tick: int) -> UniverseView:
+        """
+        The state the universe had at the beginning of the given tick. Requires temporal storage.
+        """
+        if not isinstance(self.storage, TemporalStorage):
+            raise Exception(f'Views of past ticks require {TEMPORAL_STORAGE} storage')
+        if tick > self.tick:
+            raise Exception(f'Cannot view future tick {tick}')
+        return self.storage.view(universe_id, tick)
 
     def record_action(
             self,
@@ -202,27 +691,497 @@ class Multiverse:
             character_id: int,
             action: dataclass
     ) -> None:
-        logging.debug({
-            'event_type': 'STORE_ACTION',
-            'tick': self.tick,
-            'subtick': subtick,
-            'action': action
-        })
-        ad = asdict(action)
-        ad['kind'] = type(action).__name__
-        self.mdb.execute(
-            '''
-                insert into actions (tick, subtick, payload_json, character_id, universe_id) 
-                values (?, ?, ?, ?, ?)
-            ''',
-            (self.tick, subtick, json.dumps(ad), character_id, ad.get('universe_id'))
-        )
+        handler: ActionHandler | None = ACTION_HANDLERS.get(type(action))
+        if handler is not None and handler.before_record is not None:
+            handler.before_record(self, action)
+        if self.events is not None:
+            self.events.emit({
+                'event_type': 'STORE_ACTION',
+                'tick': self.tick,
+                'subtick': subtick,
+                'character_id': character_id,
+                'action': action
+            })
+        if self.action_encoding == BINARY_ENCODING:
+            self.mdb.execute(
+                '''
+                    insert into actions (tick, subtick, payload, character_id, universe_id)
+                    values (?, ?, ?, ?, ?)
+                ''',
+                (self.tick, subtick, encode_action(action), character_id, getattr(action, 'universe_id', None))
+            )
+        else:
+            ad = asdict(action)
+            ad['kind'] = type(action).__name__
+            self.mdb.execute(
+                '''
+                    insert into actions (tick, subtick, payload_json, character_id, universe_id) 
+                    values (?, ?, ?, ?, ?)
+                ''',
+                (self.tick, subtick, json.dumps(ad), character_id, ad.get('universe_id'))
+            )
+        self.actions_since_checkpoint += 1
 
     def commit(self) -> None:
+        started: float = 0 if self.metrics is None else perf_counter()
+        if self.perception_log:
+            self.record_perceptions()
         next_tick: int = self.mdb.execute('''
             update properties set value = value + 1 where name = 'tick' returning value
         ''').fetchone()[0]
-        self.mdb.commit()
-        for _, udb in self.universe_dbs.items():
-            udb.connection.commit()
+        self.uncommitted_ticks += 1
+        if self.uncommitted_ticks >= self.commit_every_ticks or (
+                self.commit_every_ms is not None and (monotonic() - self.committed_at) * 1000 >= self.commit_every_ms
+        ):
+            self.flush()
+        else:
+            self.flushed_universe_count = 0
         self.tick = next_tick
+        if (
+                self.checkpoint_every_ticks is not None
+                and self.tick - self.checkpoint_tick >= self.checkpoint_every_ticks
+        ) or (
+                self.checkpoint_every_actions is not None
+                and self.actions_since_checkpoint >= self.checkpoint_every_actions
+        ):
+            self.checkpoint()
+        if self.archive_every_ticks is not None and self.tick % self.archive_every_ticks == 0:
+            self.compact()
+        if self.metrics is not None:
+            self.metrics.tick_commit_seconds.observe(perf_counter() - started)
+
+    def record_perceptions(self) -> None:
+        """
+        The Sensory System stage of the tick: logs the digest of the perception of every character placed
+        in a universe. The log is append-only and keeps the changes only: a digest logged at tick T
+        holds until the next one of the same character. The perceptions themselves are not stored,
+        see perception().
+        """
+        for character_id, universe_id in self.mdb.execute(
+                'select id, universe_id from characters where universe_id is not null'
+        ).fetchall():
+            perceived: bytes = self.senses.perceive(universe_id)
+            if self.perception_digests.get(character_id) == perceived:
+                continue
+            self.mdb.execute(
+                'insert into perceptions (character_id, tick, digest) values (?, ?, ?)',
+                (character_id, self.tick, perceived)
+            )
+            self.perception_digests[character_id] = perceived
+
+    def perception_digest(self, character_id: int, tick: int) -> bytes | None:
+        row: tuple[bytes] | None = self.mdb.execute(
+            'select digest from perceptions where character_id = ? and tick <= ? order by tick desc limit 1',
+            (character_id, tick)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def divergence(self, character_id: int, tick: int) -> PerceptionDiff | None:
+        """
+        Compares the perception logged for the character at the given tick with the one of its twin,
+        i.e. its parent character, at the same tick. The digests are compared first, with an index seek each,
+        and the perceptions are rebuilt and diffed only if they differ. Returns None if they do not.
+        """
+        twin_id: int | None = self.mdb.execute(
+            'select parent_id from characters where id = ?',
+            (character_id,)
+        ).fetchone()[0]
+        if twin_id is None:
+            raise Exception(f'Character {character_id} has no twin')
+        digests: list[bytes | None] = [
+            self.perception_digest(character_id, tick),
+            self.perception_digest(twin_id, tick)
+        ]
+        if digests[0] == digests[1]:
+            return None
+        return diff(self.perception(character_id, tick, digests[0]), self.perception(twin_id, tick, digests[1]))
+
+    def perception(self, character_id: int, tick: int, logged_digest: bytes | None) -> Perception:
+        """
+        The perception the character had at the end of the given tick, rebuilt from the state of its universe:
+        the current one if it still has the logged digest, otherwise the one as of the next tick,
+        which requires temporal storage.
+        """
+        if logged_digest is None:
+            # a character not perceiving anything yet
+            return Perception([], [])
+        universe_id: int = self.mdb.execute(
+            'select universe_id from characters where id = ?',
+            (character_id,)
+        ).fetchone()[0]
+        if self.senses.perceive(universe_id) == logged_digest:
+            return Perception(self.locations(universe_id), [d[:3] for d in self.directions(universe_id)])
+        if isinstance(self.storage, TemporalStorage) and tick < self.tick:
+            view: UniverseView = self.view(universe_id, tick + 1)
+            perception: Perception = Perception(view.locations, [d[:3] for d in view.directions])
+            if digest(perception) == logged_digest:
+                return perception
+        raise Exception(f'Perception of character {character_id} at tick {tick} is no longer available')
+
+    def flush(self) -> None:
+        self.commit_database(MULTIVERSE_DATABASE, self.mdb)
+        connections: list[Connection] = [
+            self.universe_dbs[universe_id].connection for universe_id in self.dirty_universe_ids
+        ]
+        if self.executor is None or len(connections) < 2:
+            for conn in connections:
+                self.commit_database(UNIVERSE_DATABASE, conn)
+        else:
+            for _ in self.executor.map(partial(self.commit_database, UNIVERSE_DATABASE), connections):
+                pass
+        self.flushed_universe_count = len(self.dirty_universe_ids)
+        self.checkpoint_dirty_ids |= self.dirty_universe_ids
+        self.dirty_universe_ids.clear()
+        self.uncommitted_ticks = 0
+        self.committed_at = monotonic()
+
+    def commit_database(self, database: str, conn: Connection) -> None:
+        if self.metrics is None:
+            conn.commit()
+        else:
+            self.metrics.observe_commit(database, timed(conn.commit))
+
+    def jump_to(self, tick: int) -> None:
+        if tick < self.tick:
+            raise Exception(f'Cannot jump back from tick {self.tick} to tick {tick}')
+        self.mdb.execute("update properties set value = ? where name = 'tick'", (tick,))
+        self.tick = tick
+
+    def log_rows(
+            self,
+            conn: Connection,
+            archive: Archive,
+            from_tick: int,
+            to_tick: int,
+            column: str | None = None,
+            value: int | None = None
+    ) -> Iterator[Row]:
+        """
+        Streams the actions log rows of ticks [from_tick, to_tick) from the archive and then from the actions table,
+        optionally only those having the given value in the given column.
+        """
+        live_from_tick: int = max(from_tick, archive.archived_until() + 1)
+        if from_tick < live_from_tick:
+            position: int | None = None if column is None else ROW_COLUMNS.index(column)
+            for row in archive.rows(from_tick, min(to_tick, live_from_tick)):
+                if position is None or row[position] == value:
+                    yield row
+        sql: str = f'''
+            select {', '.join(ROW_COLUMNS)} from actions
+            where tick >= ? and tick < ?
+        '''
+        params: tuple[int, ...] = (live_from_tick, to_tick)
+        if column is not None:
+            sql += f' and {column} = ?'
+            params += (value,)
+        yield from prefetched(conn.execute(sql + ' order by tick, subtick', params))
+
+    def logged_actions(
+            self,
+            from_tick: int,
+            to_tick: int,
+            universe_id: int | None = None,
+            source: str | None = None
+    ) -> Iterator[tuple[int, int, int, dataclass]]:
+        """
+        Streams (tick, subtick, character_id, action) of the actions logged during ticks [from_tick, to_tick)
+        in their order. The rows are read with a cursor, never fetched all at once.
+        source is a path to the database of another multiverse to read the log from.
+        """
+        conn: Connection = self.mdb if source is None else sqlite3.connect(f'file:{source}?mode=ro', uri=True)
+        archive: Archive = self.archive if source is None else Archive(f'{os.path.dirname(source)}/archive')
+        try:
+            for tick, subtick, character_id, payload_json, payload, action_universe_id in self.log_rows(
+                    conn,
+                    archive,
+                    from_tick,
+                    to_tick,
+                    None if universe_id is None else 'universe_id',
+                    universe_id
+            ):
+                yield tick, subtick, character_id, decode_action(payload_json, payload, action_universe_id)
+        finally:
+            if source is not None:
+                conn.close()
+
+    def actions_for_character(
+            self,
+            character_id: int,
+            from_tick: int,
+            to_tick: int | None = None
+    ) -> Iterator[tuple[int, int, dataclass]]:
+        """
+        Streams (tick, subtick, action) of the actions logged for the character since from_tick (and before to_tick)
+        in their order, e.g. to replay a twin character.
+        """
+        for tick, subtick, _, payload_json, payload, universe_id in self.log_rows(
+                self.mdb,
+                self.archive,
+                from_tick,
+                MAX_TICK if to_tick is None else to_tick,
+                'character_id',
+                character_id
+        ):
+            yield tick, subtick, decode_action(payload_json, payload, universe_id)
+
+    def compact(self) -> None:
+        """
+        Moves the actions log rows older than archive_horizon ticks from the actions table to a new archive segment.
+        """
+        from_tick: int = self.archive.archived_until() + 1
+        to_tick: int = self.tick - self.archive_horizon
+        if to_tick <= from_tick:
+            return
+        self.flush()
+        self.archive.append(prefetched(self.mdb.execute(
+            f'select {", ".join(ROW_COLUMNS)} from actions where tick >= ? and tick < ? order by tick, subtick',
+            (from_tick, to_tick)
+        )))
+        self.mdb.execute('delete from actions where tick < ?', (to_tick,))
+        self.flush()
+        logging.debug({
+            'event_type': 'COMPACT',
+            'tick': self.tick,
+            'archived_until': self.archive.archived_until()
+        })
+
+    def replay(
+            self,
+            from_tick: int,
+            to_tick: int,
+            universe_id: int | None = None,
+            source: str | None = None,
+            into_universe_id: int | None = None
+    ) -> ReplayStats:
+        """
+        Re-applies the actions logged during ticks [from_tick, to_tick) tick by tick with apply_batch().
+        With universe_id, only the actions changing that universe's database are replayed.
+
+        By default, the own log is replayed within the current tick. The log of another multiverse (source)
+        is replayed in lockstep instead: this multiverse jumps to every replayed tick, records its actions
+        and commits it, ending up at to_tick. Replaying a whole log into an empty instance rebuilds
+        the multiverse.
+
+        With into_universe_id, the actions of universe_id are applied to another universe instead.
+        """
+        started: float = monotonic()
+        action_count: int = 0
+        for tick, rows in groupby(self.logged_actions(from_tick, to_tick, universe_id, source), key=itemgetter(0)):
+            batch: list[tuple[int, int, dataclass]] = [
+                (subtick, character_id, action)
+                for _, subtick, character_id, action in rows
+                if universe_id is None or is_universe_action(action)
+            ]
+            if source is not None:
+                self.jump_to(tick)
+                for subtick, character_id, action in batch:
+                    self.record_action(subtick, character_id, action)
+            if into_universe_id is not None:
+                batch = [
+                    (subtick, character_id, replace(action, universe_id=into_universe_id))
+                    for subtick, character_id, action in batch
+                ]
+            self.apply_batch([(action, character_id) for _, character_id, action in batch])
+            if source is not None:
+                self.commit()
+            action_count += len(batch)
+        if source is not None and self.tick < to_tick:
+            self.jump_to(to_tick)
+            self.flush()
+        stats: ReplayStats = ReplayStats(to_tick - from_tick, action_count, monotonic() - started)
+        logging.info({
+            'event_type': 'REPLAY',
+            'from_tick': from_tick,
+            'to_tick': to_tick,
+            'actions': stats.actions,
+            'ticks_per_second': stats.ticks_per_second
+        })
+        return stats
+
+    def checkpoint_path(self, tick: int, universe_id: int) -> str:
+        name: str = 'multiverse' if universe_id == MULTIVERSE_CHECKPOINT_ID else str(universe_id)
+        return f'{self.instance_id}/checkpoints/{tick}/{name}.db'
+
+    def checkpoint(self) -> None:
+        """
+        Snapshots the multiverse database and the universes changed since the previous checkpoint.
+        A universe snapshot stays valid for the later checkpoints until the universe changes again.
+        The snapshots of the multiverse database leave the actions log out, restore() takes it from the instance.
+        """
+        self.flush()
+        Path(f'{self.instance_id}/checkpoints/{self.tick}').mkdir(parents=True, exist_ok=True)
+        universe_ids: list[int] = [
+            row[0] for row in self.mdb.execute('select id from universes order by id')
+        ] if self.checkpoint_all else sorted(self.checkpoint_dirty_ids)
+        for universe_id in universe_ids:
+            backup(self.udb(universe_id), self.checkpoint_path(self.tick, universe_id))
+        self.mdb.executemany(
+            'insert into checkpoints (universe_id, tick) values (?, ?)',
+            [(universe_id, self.tick) for universe_id in [MULTIVERSE_CHECKPOINT_ID] + universe_ids]
+        )
+        self.mdb.commit()
+        backup_without_log(
+            f'{self.instance_id}/multiverse.db',
+            self.checkpoint_path(self.tick, MULTIVERSE_CHECKPOINT_ID)
+        )
+        logging.debug({
+            'event_type': 'CHECKPOINT',
+            'tick': self.tick,
+            'universes': len(universe_ids)
+        })
+        self.checkpoint_tick = self.tick
+        self.actions_since_checkpoint = 0
+        self.checkpoint_dirty_ids.clear()
+        self.checkpoint_all = False
+        self.prune_checkpoints()
+
+    def prune_checkpoints(self) -> None:
+        ticks: list[int] = [row[0] for row in self.mdb.execute(
+            'select tick from checkpoints where universe_id = ? order by tick',
+            (MULTIVERSE_CHECKPOINT_ID,)
+        )]
+        kept: set[int] = set(ticks[-self.checkpoint_keep_recent:])
+        age_ranges: set[int] = set()
+        for tick in ticks[:-self.checkpoint_keep_recent]:
+            # 0 for the ages below checkpoint_sparse_ticks, k for [checkpoint_sparse_ticks * 2^(k-1), ... * 2^k)
+            age_range: int = ((self.tick - tick) // self.checkpoint_sparse_ticks).bit_length()
+            if age_range not in age_ranges:
+                age_ranges.add(age_range)
+                kept.add(tick)
+        needed: set[tuple[int, int]] = {(MULTIVERSE_CHECKPOINT_ID, tick) for tick in kept}
+        for tick in kept:
+            needed.update(self.mdb.execute(
+                'select universe_id, max(tick) from checkpoints where universe_id != ? and tick <= ? group by universe_id',
+                (MULTIVERSE_CHECKPOINT_ID, tick)
+            ))
+        obsolete: list[tuple[int, int]] = [
+            row for row in self.mdb.execute('select universe_id, tick from checkpoints') if row not in needed
+        ]
+        for universe_id, tick in obsolete:
+            os.remove(self.checkpoint_path(tick, universe_id))
+        self.mdb.executemany('delete from checkpoints where universe_id = ? and tick = ?', obsolete)
+        self.mdb.commit()
+        for tick in {tick for _, tick in obsolete}:
+            directory: str = f'{self.instance_id}/checkpoints/{tick}'
+            if not os.listdir(directory):
+                os.rmdir(directory)
+
+    def fork_at(self, universe_id: int, tick: int) -> int:
+        """
+        Creates a child universe of universe_id with the state universe_id had at the beginning of the given tick:
+        copies the nearest earlier checkpoint and replays the universe's actions logged since then.
+        With temporal storage, it copies the rows valid at that tick instead.
+        Unlike CreateUniverse, it is not an action, so it does not appear in the actions log.
+        """
+        if tick > self.tick:
+            raise Exception(f'Cannot fork universe {universe_id} at future tick {tick}')
+        checkpoint_tick: int | None = None
+        if not isinstance(self.storage, TemporalStorage):
+            checkpoint_tick = self.mdb.execute(
+                'select max(tick) from checkpoints where universe_id = ? and tick <= ?',
+                (universe_id, tick)
+            ).fetchone()[0]
+            if checkpoint_tick is None:
+                raise Exception(f'No checkpoint of universe {universe_id} at or before tick {tick}')
+        fork_id: int = self.mdb.execute(
+            'insert into universes (parent_id) values (?)',
+            (universe_id,)
+        ).lastrowid
+        self.universe_ids.add(fork_id)
+        self.universe_lineage.link(fork_id, universe_id)
+        if checkpoint_tick is None:
+            self.storage.fork_at(universe_id, fork_id, tick)
+            return fork_id
+        shutil.copyfile(self.checkpoint_path(checkpoint_tick, universe_id), f'{self.instance_id}/{fork_id}.db')
+        self.udb(fork_id, write=True)
+        self.replay(checkpoint_tick, tick, universe_id, into_universe_id=fork_id)
+        return fork_id
+
+    def restore(self, tick: int, instance_id: str) -> None:
+        """
+        Creates a new instance with the state this multiverse had at the beginning of the given tick:
+        copies the nearest earlier checkpoint, the actions logged before it, and replays the actions logged since then.
+        """
+        if tick > self.tick:
+            raise Exception(f'Cannot restore future tick {tick}')
+        checkpoint_tick: int | None = self.mdb.execute(
+            'select max(tick) from checkpoints where universe_id = ? and tick <= ?',
+            (MULTIVERSE_CHECKPOINT_ID, tick)
+        ).fetchone()[0]
+        if checkpoint_tick is None:
+            raise Exception(f'No checkpoint at or before tick {tick}')
+        snapshots: list[tuple[int, int]] = self.mdb.execute(
+            'select universe_id, max(tick) from checkpoints where universe_id != ? and tick <= ? group by universe_id',
+            (MULTIVERSE_CHECKPOINT_ID, checkpoint_tick)
+        ).fetchall()
+        # The tail of the log is read by a separate connection.
+        self.flush()
+        Path(instance_id).mkdir(parents=True)
+        shutil.copyfile(
+            self.checkpoint_path(checkpoint_tick, MULTIVERSE_CHECKPOINT_ID),
+            f'{instance_id}/multiverse.db'
+        )
+        for universe_id, snapshot_tick in snapshots:
+            shutil.copyfile(self.checkpoint_path(snapshot_tick, universe_id), f'{instance_id}/{universe_id}.db')
+        with Multiverse(
+                instance_id,
+                storage=self.storage_name,
+                flatten_depth=self.flatten_depth,
+                max_open_universes=self.max_open_universes,
+                durability=self.durability,
+                archive_compression=self.archive.compression
+        ) as restored:
+            restored.mdb.execute('delete from checkpoints')
+            restored.archive.append(self.archive.rows(0, checkpoint_tick))
+            restored.mdb.executemany(
+                f'insert into actions ({", ".join(ROW_COLUMNS)}) values ({", ".join("?" * len(ROW_COLUMNS))})',
+                prefetched(self.mdb.execute(
+                    f'select {", ".join(ROW_COLUMNS)} from actions where tick >= ? and tick < ? order by tick, subtick',
+                    (self.archive.archived_until() + 1, checkpoint_tick)
+                ))
+            )
+            for universe_id, snapshot_tick in snapshots:
+                if snapshot_tick < checkpoint_tick:
+                    restored.replay(snapshot_tick, checkpoint_tick, universe_id)
+            restored.replay(checkpoint_tick, tick, source=f'{self.instance_id}/multiverse.db')
+            restored.flush()
+
+
+def timed(function: Callable[[], Any]) -> float:
+    started: float = perf_counter()
+    function()
+    return perf_counter() - started
+
+
+def prefetched(cursor: Cursor) -> Iterator[tuple]:
+    while rows := cursor.fetchmany(PREFETCH_ROWS):
+        yield from rows
+
+
+def backup_without_log(source: str, path: str) -> None:
+    """
+    Copies the multiverse database at source, committed, to path, leaving the actions table empty.
+    """
+    target: Connection = sqlite3.connect(path)
+    try:
+        target.execute('attach database ? as source', (source,))
+        schema: list[tuple[str, str, str]] = target.execute('''
+            select type, name, sql from source.sqlite_master
+            where sql is not null and name not like 'sqlite_%' order by type != 'table'
+        ''').fetchall()
+        for kind, name, sql in schema:
+            target.execute(sql)
+            if kind == 'table' and name != 'actions':
+                target.execute(f'insert into main."{name}" select * from source."{name}"')
+        target.commit()
+        target.execute('detach database source')
+    finally:
+        target.close()
+
+
+def backup(conn: Connection, path: str) -> None:
+    target: Connection = sqlite3.connect(path)
+    try:
+        conn.backup(target)
+    finally:
+        target.close()
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import json
+from dataclasses import dataclass
+from hashlib import blake2b
+from typing import TYPE_CHECKING, Any, Iterable
+
+if TYPE_CHECKING:
+    from multiverse import Multiverse
+
+DIGEST_SIZE = 16
+DIGEST_MODULUS = 1 << (8 * DIGEST_SIZE)
+
+
+@dataclass
+class Perception:
+    """
+    Everything a character observes. It does not include the universe id, so that the perceptions
+    of twins in different universes are equal for as long as their universes are alike.
+    """
+    locations: list[tuple[str, str]]
+    # (from_name, to_name, travel_time), the ordinals being an artifact of the order of the writes
+    directions: list[tuple[str, str, int]]
+
+
+@dataclass
+class PerceptionDiff:
+    # field -> items observed by the character only
+    added: dict[str, list[Any]]
+    # field -> items observed by the twin only
+    removed: dict[str, list[Any]]
+
+
+class SensorySystem:
+    """
+    Keeps the digest of what the characters of every universe perceive. Characters of the same universe
+    perceive the same, so a universe is perceived once: its whole state is read on the first request only,
+    and the handlers then report the locations and directions they add, see add(). The digest is a sum
+    of the digests of the perceived items, so the additions are folded into it in time proportional to their number.
+    """
+
+    multiverse: Multiverse
+    # universe_id -> sum of the item digests
+    sums: dict[int, int]
+
+    def __init__(self, multiverse: Multiverse) -> None:
+        self.multiverse = multiverse
+        self.sums = {}
+
+    def invalidate(self, universe_id: int) -> None:
+        self.sums.pop(universe_id, None)
+
+    def add(
+            self,
+            universe_id: int,
+            locations: Iterable[tuple[str, str]] = (),
+            directions: Iterable[tuple[str, str, int]] = ()
+    ) -> None:
+        total: int | None = self.sums.get(universe_id)
+        # a universe not perceived yet is read as a whole when it is
+        if total is not None:
+            self.sums[universe_id] = (total + items_sum(locations, directions)) % DIGEST_MODULUS
+
+    def perceive(self, universe_id: int) -> bytes:
+        total: int | None = self.sums.get(universe_id)
+        if total is None:
+            total = self.sums[universe_id] = items_sum(
+                self.multiverse.locations(universe_id),
+                (direction[:3] for direction in self.multiverse.directions(universe_id))
+            )
+        return total.to_bytes(DIGEST_SIZE, 'big')
+
+
+def item_digest(field: str, item: tuple) -> int:
+    return int.from_bytes(
+        blake2b(json.dumps([field, *item], ensure_ascii=False).encode(), digest_size=DIGEST_SIZE).digest(),
+        'big'
+    )
+
+
+def items_sum(locations: Iterable[tuple[str, str]], directions: Iterable[tuple[str, str, int]]) -> int:
+    return (
+        sum(item_digest('locations', location) for location in locations)
+        + sum(item_digest('directions', direction) for direction in directions)
+    ) % DIGEST_MODULUS
+
+
+def digest(perception: Perception) -> bytes:
+    """
+    The digest of the perception, whatever the order of its items.
+    """
+    return items_sum(perception.locations, perception.directions).to_bytes(DIGEST_SIZE, 'big')
+
+
+def diff(perception: Perception, twin_perception: Perception) -> PerceptionDiff:
+    added: dict[str, list[Any]] = {}
+    removed: dict[str, list[Any]] = {}
+    for field in ('locations', 'directions'):
+        items: list[Any] = getattr(perception, field)
+        twin_items: list[Any] = getattr(twin_perception, field)
+        twin_set: set[Any] = set(twin_items)
+        item_set: set[Any] = set(items)
+        if only := [item for item in items if item not in twin_set]:
+            added[field] = only
+        if only := [item for item in twin_items if item not in item_set]:
+            removed[field] = only
+    return PerceptionDiff(added, removed)
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING
+
+from handlers import ACTION_HANDLERS, is_universe_action
+
+if TYPE_CHECKING:
+    from multiverse import Multiverse
+
+# ticks of a twin's log read at once, when they are already complete
+REPLAY_PREFETCH_TICKS = 64
+
+
+class TwinCursor:
+    """
+    Streams the logged actions of a twin character, lag ticks behind the multiverse.
+    Past ticks of the log do not change, so they are read up to REPLAY_PREFETCH_TICKS at a time,
+    while the current tick is read on its own when it is asked for.
+    """
+
+    multiverse: Multiverse
+    twin_id: int
+    lag: int
+    # (tick, action) read ahead
+    rows: deque[tuple[int, dataclass]]
+    # the first tick not read yet
+    read_until: int
+
+    def __init__(self, multiverse: Multiverse, twin_id: int, lag: int) -> None:
+        self.multiverse = multiverse
+        self.twin_id = twin_id
+        self.lag = lag
+        self.rows = deque()
+        self.read_until = 0
+
+    def take(self, tick: int) -> list[dataclass]:
+        twin_tick: int = tick - self.lag
+        if twin_tick >= self.read_until:
+            self.rows.clear()
+            # the ticks before the current one are complete
+            self.read_until = max(twin_tick + 1, min(twin_tick + REPLAY_PREFETCH_TICKS, self.multiverse.tick))
+            self.rows.extend(
+                (row_tick, action)
+                for row_tick, _, action in self.multiverse.actions_for_character(
+                    self.twin_id,
+                    twin_tick,
+                    self.read_until
+                )
+            )
+        while self.rows and self.rows[0][0] < twin_tick:
+            self.rows.popleft()
+        actions: list[dataclass] = []
+        while self.rows and self.rows[0][0] == twin_tick:
+            actions.append(self.rows.popleft()[1])
+        return actions
+
+
+class ReplayDriver:
+    """
+    Drives the characters without a player with the recorded actions of their ancestor twin,
+    i.e. the nearest ancestor character having a player. Every tick, the twin's universe-level actions
+    of the matching tick are rewritten to the universe of the replaying character.
+
+    The matching tick is the same tick, unless the character follows its twin with a lag set by follow(),
+    e.g. in a universe forked at a past tick. Characters sharing a twin and a lag share a single cursor,
+    so the log of a twin is read once per tick however many characters replay it.
+    """
+
+    multiverse: Multiverse
+    # (twin_id, lag) -> [(character_id, universe_id)] of the characters replaying the twin
+    replayers: dict[tuple[int, int], list[tuple[int, int]]]
+    cursors: dict[tuple[int, int], TwinCursor]
+    # number of characters when replayers were resolved, as characters are only ever added
+    resolved_character_count: int
+
+    def __init__(self, multiverse: Multiverse) -> None:
+        self.multiverse = multiverse
+        self.replayers = {}
+        self.cursors = {}
+        self.resolved_character_count = -1
+
+    def follow(self, character_id: int, lag: int) -> None:
+        """
+        Makes the character replay the actions its twin made lag ticks earlier.
+        """
+        if lag < 0:
+            raise Exception(f'Cannot follow a twin from the future: {lag}')
+        self.multiverse.mdb.execute(
+            'insert into replay_lags (character_id, lag) values (?, ?) '
+            'on conflict (character_id) do update set lag = excluded.lag',
+            (character_id, lag)
+        )
+        self.resolved_character_count = -1
+
+    def resolve(self) -> None:
+        # The twin is the nearest ancestor having a player, and the lags of the characters
+        # below it add up, both read from the character lineage instead of walking up the tree.
+        self.replayers = {}
+        for character_id, universe_id, twin_id, lag in self.multiverse.mdb.execute('''
+            with replayers as (
+                select c.id, c.universe_id, (
+                    select min(l.depth) from character_lineage l join characters a on a.id = l.ancestor_id
+                    where l.descendant_id = c.id and a.player_id is not null
+                ) as twin_depth
+                from characters c
+                where c.player_id is null and c.parent_id is not null and c.universe_id is not null
+            )
+            select r.id, r.universe_id, t.ancestor_id, (
+                select coalesce(sum(g.lag), 0)
+                from character_lineage l join replay_lags g on g.character_id = l.ancestor_id
+                where l.descendant_id = r.id and l.depth < r.twin_depth
+            )
+            from replayers r join character_lineage t on t.descendant_id = r.id and t.depth = r.twin_depth
+            order by r.id
+        '''):
+            self.replayers.setdefault((twin_id, lag), []).append((character_id, universe_id))
+        self.cursors = {key: self.cursors.get(key) or TwinCursor(self.multiverse, *key) for key in self.replayers}
+        self.resolved_character_count = len(self.multiverse.character_ids)
+
+    def actions(self) -> list[tuple[int, dataclass]]:
+        """
+        (character_id, action) of the replaying characters for the current tick.
+        To see the twins' actions of the current tick, it is called once they are recorded.
+        """
+        if self.resolved_character_count != len(self.multiverse.character_ids):
+            self.resolve()
+        replayed: list[tuple[int, dataclass]] = []
+        for key, replayers in self.replayers.items():
+            actions: list[dataclass] = [
+                action for action in self.cursors[key].take(self.multiverse.tick) if is_universe_action(action)
+            ]
+            for character_id, universe_id in replayers:
+                replayed.extend((character_id, replace(action, universe_id=universe_id)) for action in actions)
+        return replayed
+
+    def inject(self, subtick: int) -> list[tuple[dataclass, int]]:
+        """
+        Records the replayed actions of the current tick from the given subtick on
+        and returns them in the form apply_batch() takes. Actions the replaying character would be
+        refused, e.g. the root-only ones, are neither recorded nor returned.
+        """
+        batch: list[tuple[dataclass, int]] = []
+        for character_id, action in self.actions():
+            if self.multiverse.validate(ACTION_HANDLERS.get(type(action)), action, character_id) is not None:
+                continue
+            self.multiverse.record_action(subtick + len(batch), character_id, action)
+            batch.append((action, character_id))
+        return batch
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import heapq
+from collections import OrderedDict
+from dataclasses import dataclass
+from itertools import count
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from multiverse import Multiverse
+
+# shortest path trees kept per universe, the least recently used one is dropped first
+ROUTE_TREES_PER_UNIVERSE = 64
+
+
+@dataclass
+class Route:
+    # locations from the start to the destination, both included
+    path: list[str]
+    travel_time: int
+
+
+class Router:
+    """
+    Shortest travel time routes between the locations of a universe.
+    The directions of a universe are loaded into memory on the first request, and every shortest path tree
+    computed by Dijkstra's algorithm is kept, up to ROUTE_TREES_PER_UNIVERSE per universe, so repeated requests
+    from the same location cost a dict walk. Adding directions to a universe drops the caches of that universe only,
+    and so does closing its database, so the caches are bounded by the pool of open universes.
+    """
+
+    multiverse: Multiverse
+    # universe_id -> location -> [(neighbour, travel_time)]
+    adjacency: dict[int, dict[str, list[tuple[str, int]]]]
+    # universe_id -> from_name -> (travel time, previous location) of every location reachable from from_name
+    trees: dict[int, OrderedDict[str, dict[str, tuple[int, str | None]]]]
+
+    def __init__(self, multiverse: Multiverse) -> None:
+        self.multiverse = multiverse
+        self.adjacency = {}
+        self.trees = {}
+
+    def invalidate(self, universe_id: int) -> None:
+        self.adjacency.pop(universe_id, None)
+        self.trees.pop(universe_id, None)
+
+    def route(self, universe_id: int, from_name: str, to_name: str) -> Route | None:
+        """
+        The fastest way from from_name to to_name, or None if to_name is unreachable.
+        """
+        tree: dict[str, tuple[int, str | None]] = self.tree(universe_id, from_name)
+        if to_name not in self.locations(universe_id):
+            raise Exception(f'No such location: {to_name}')
+        if to_name not in tree:
+            return None
+        path: list[str] = []
+        name: str | None = to_name
+        while name is not None:
+            path.append(name)
+            name = tree[name][1]
+        path.reverse()
+        return Route(path, tree[to_name][0])
+
+    def locations(self, universe_id: int) -> dict[str, list[tuple[str, int]]]:
+        adjacency: dict[str, list[tuple[str, int]]] | None = self.adjacency.get(universe_id)
+        if adjacency is None:
+            adjacency = {name: [] for name, _ in self.multiverse.locations(universe_id)}
+            for from_name, to_name, travel_time, _ in self.multiverse.directions(universe_id):
+                adjacency[from_name].append((to_name, travel_time))
+            self.adjacency[universe_id] = adjacency
+        return adjacency
+
+    def tree(self, universe_id: int, from_name: str) -> dict[str, tuple[int, str | None]]:
+        trees: OrderedDict[str, dict[str, tuple[int, str | None]]] = self.trees.setdefault(universe_id, OrderedDict())
+        tree: dict[str, tuple[int, str | None]] | None = trees.get(from_name)
+        if tree is not None:
+            trees.move_to_end(from_name)
+            return tree
+        adjacency: dict[str, list[tuple[str, int]]] = self.locations(universe_id)
+        if from_name not in adjacency:
+            raise Exception(f'No such location: {from_name}')
+        tree = {}
+        # the counter breaks ties, so that entries never compare their previous locations
+        pushed: count = count()
+        queue: list[tuple[int, str, int, str | None]] = [(0, from_name, next(pushed), None)]
+        while queue:
+            travel_time, name, _, previous = heapq.heappop(queue)
+            if name in tree:
+                continue
+            tree[name] = (travel_time, previous)
+            for neighbour, edge_time in adjacency[name]:
+                if neighbour not in tree:
+                    heapq.heappush(queue, (travel_time + edge_time, neighbour, next(pushed), name))
+        trees[from_name] = tree
+        if len(trees) > ROUTE_TREES_PER_UNIVERSE:
+            trees.popitem(last=False)
+        return tree
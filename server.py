@@ -0,0 +1,215 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from handlers import ACTION_HANDLERS, INVALID_ARGUMENT, NOT_FOUND, UNKNOWN_ACTION, Rejection
+from multiverse import Multiverse
+from replay import ReplayDriver
+
+# What submit() does when the queue of a character is full.
+WAIT_ON_OVERFLOW = 'wait'
+SHED_ON_OVERFLOW = 'shed'
+
+OVERLOADED = 'overloaded'
+# the outcome of the actions still queued when the server stops
+STOPPED = 'stopped'
+
+
+@dataclass
+class Submission:
+    character_id: int
+    action: dataclass
+    outcome: asyncio.Future
+
+
+class TickServer:
+    """
+    Asyncio front end of a Multiverse. Player sessions submit actions concurrently, and the server
+    closes a tick every tick_seconds or as soon as max_tick_actions actions are waiting, whichever comes first.
+
+    Subticks are assigned deterministically: characters take turns in the order of their ids,
+    one queued action each per turn, until the queues are empty or the tick is full.
+
+    With replay, every tick also applies the actions of the characters replaying their twins, see ReplayDriver.
+
+    All SQLite work, opening and closing the multiverse included, runs on a single worker thread,
+    as sqlite3 connections must stay on the thread that created them.
+
+    A tick failing as a whole fails the submissions it took, and the server goes on with the next one.
+    """
+
+    multiverse: Multiverse
+    tick_seconds: float
+    max_tick_actions: int
+    queue_size: int
+    overflow: str
+    replay: bool
+    replays: ReplayDriver | None
+    queues: dict[int, asyncio.Queue[Submission]]
+    pending: int
+    # set when max_tick_actions actions are waiting
+    full: asyncio.Event
+    stopping: bool
+    executor: ThreadPoolExecutor
+    runner: asyncio.Task | None
+
+    def __init__(
+            self,
+            multiverse: Multiverse,
+            tick_seconds: float = 0.1,
+            max_tick_actions: int = 10000,
+            queue_size: int = 64,
+            overflow: str = WAIT_ON_OVERFLOW,
+            replay: bool = False
+    ) -> None:
+        if overflow not in (WAIT_ON_OVERFLOW, SHED_ON_OVERFLOW):
+            raise Exception(f'Unknown overflow policy: {overflow}')
+        self.multiverse = multiverse
+        self.tick_seconds = tick_seconds
+        self.max_tick_actions = max_tick_actions
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.replay = replay
+        self.replays = None
+        self.queues = {}
+        self.pending = 0
+        self.full = asyncio.Event()
+        self.stopping = False
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='TickServer')
+        self.runner = None
+
+    async def __aenter__(self) -> TickServer:
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.open)
+        self.runner = asyncio.create_task(self.run())
+        return self
+
+    def open(self) -> None:
+        self.multiverse.__enter__()
+        if self.replay:
+            self.replays = ReplayDriver(self.multiverse)
+
+    async def __aexit__(self, *args) -> None:
+        self.stopping = True
+        self.full.set()
+        await self.runner
+        self.drain()
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.multiverse.__exit__)
+        self.executor.shutdown()
+
+    async def submit(self, character_id: int, action: dataclass) -> Exception | Rejection | None:
+        """
+        Queues the action and waits for the tick that applies it. Returns the outcome of apply().
+        """
+        if self.stopping:
+            return Rejection(STOPPED, 'The server is stopping')
+        queue: asyncio.Queue[Submission] | None = self.queues.get(character_id)
+        if queue is None:
+            queue = self.queues[character_id] = asyncio.Queue(self.queue_size)
+        if queue.full() and self.overflow == SHED_ON_OVERFLOW:
+            return Rejection(OVERLOADED, f'Too many actions queued for character {character_id}')
+        submission: Submission = Submission(character_id, action, asyncio.get_running_loop().create_future())
+        # With the wait policy, a session blocks here until its previous actions are taken into a tick.
+        await queue.put(submission)
+        self.pending += 1
+        if self.runner is not None and self.runner.done():
+            # the server stopped while the session was waiting for room in the queue
+            self.drain()
+        if self.pending >= self.max_tick_actions:
+            self.full.set()
+        return await submission.outcome
+
+    async def run(self) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        deadline: float = loop.time() + self.tick_seconds
+        while not self.stopping:
+            try:
+                await asyncio.wait_for(self.full.wait(), max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                pass
+            self.full.clear()
+            deadline = loop.time() + self.tick_seconds
+            submissions: list[Submission] = self.take()
+            try:
+                outcomes: list[Exception | Rejection | None] = await loop.run_in_executor(
+                    self.executor,
+                    self.close_tick,
+                    [(submission.character_id, submission.action) for submission in submissions]
+                )
+            except Exception as e:
+                logging.error({'event_type': 'TICK_ERROR', 'tick': self.multiverse.tick, 'error': e})
+                # Every session gets an error of its own: the traceback of e holds the frame of this loop,
+                # which must not be cleared or kept alive by whoever handles the error.
+                for submission in submissions:
+                    if not submission.outcome.done():
+                        submission.outcome.set_exception(Exception(f'Tick failed: {e}'))
+                continue
+            for submission, outcome in zip(submissions, outcomes):
+                # the session may have gone away meanwhile
+                if not submission.outcome.done():
+                    submission.outcome.set_result(outcome)
+            if self.pending >= self.max_tick_actions:
+                self.full.set()
+
+    def take(self) -> list[Submission]:
+        submissions: list[Submission] = []
+        queues: list[asyncio.Queue[Submission]] = [
+            self.queues[character_id] for character_id in sorted(self.queues) if not self.queues[character_id].empty()
+        ]
+        while queues and len(submissions) < self.max_tick_actions:
+            for queue in queues:
+                if len(submissions) == self.max_tick_actions:
+                    break
+                submissions.append(queue.get_nowait())
+            queues = [queue for queue in queues if not queue.empty()]
+        self.pending -= len(submissions)
+        return submissions
+
+    def drain(self) -> None:
+        for queue in self.queues.values():
+            while not queue.empty():
+                submission: Submission = queue.get_nowait()
+                self.pending -= 1
+                if not submission.outcome.done():
+                    submission.outcome.set_result(Rejection(STOPPED, 'The server stopped before the next tick'))
+
+    def close_tick(self, actions: list[tuple[int, dataclass]]) -> list[Exception | Rejection | None]:
+        outcomes: list[Exception | Rejection | None] = [None] * len(actions)
+        # The actions log refers to existing characters and known actions only,
+        # so the other actions are neither logged nor applied.
+        logged: list[int] = []
+        for index, (character_id, action) in enumerate(actions):
+            if character_id not in self.multiverse.character_ids:
+                outcomes[index] = self.multiverse.apply_rejection(
+                    action,
+                    Rejection(NOT_FOUND, f'No such character: {character_id}')
+                )
+                continue
+            if type(action) not in ACTION_HANDLERS:
+                outcomes[index] = self.multiverse.apply_rejection(
+                    action,
+                    Rejection(UNKNOWN_ACTION, f'Unknown action: {type(action).__name__}')
+                )
+                continue
+            try:
+                self.multiverse.record_action(len(logged), character_id, action)
+            except Exception as e:
+                outcomes[index] = self.multiverse.apply_rejection(
+                    action,
+                    Rejection(INVALID_ARGUMENT, f'Cannot log {type(action).__name__}: {e}')
+                )
+                continue
+            logged.append(index)
+        batch: list[tuple[dataclass, int]] = [(actions[index][1], actions[index][0]) for index in logged]
+        if self.replays is not None:
+            batch += self.replays.inject(len(logged))
+        try:
+            applied: list[Exception | Rejection | None] = self.multiverse.apply_batch(batch)
+        finally:
+            # The tick is closed even if it fails, so that the next one does not reuse its subticks.
+            self.multiverse.commit()
+        for index, outcome in zip(logged, applied):
+            outcomes[index] = outcome
+        return outcomes
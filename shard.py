@@ -0,0 +1,292 @@
+from __future__ import annotations
+
+import multiprocessing
+import os
+import pickle
+from dataclasses import dataclass
+from multiprocessing.connection import Connection as Pipe
+from multiprocessing.process import BaseProcess
+from pathlib import Path
+from typing import Any
+
+from actions import CreateUniverse
+from handlers import ACTION_HANDLERS, INSERT_UNIVERSE_SQL, ActionHandler, Rejection
+from multiverse import Multiverse, ROOT_CHARACTER_ID, backup
+from routing import Route
+from storage import COPY_STORAGE
+
+
+@dataclass
+class Shard:
+    index: int
+    directory: str
+    process: BaseProcess
+    pipe: Pipe
+
+
+class ShardedMultiverse(Multiverse):
+    """
+    A multiverse whose universe databases are spread over worker processes, one shard directory each.
+
+    The coordinator, i.e. this object, owns the multiverse database: players, universes, characters,
+    the actions log and the universe_shards assignment. It validates every action, applies multiverse-level
+    actions itself and sends universe-level ones to the shards owning their universes, all shards of
+    an apply_batch() segment working at once. commit() makes every shard commit before the tick
+    is committed to the multiverse database, so ticks stay globally ordered.
+
+    Universes are forked and moved between shards by copying their database files, which requires
+    the shards to share the file system. Only copy storage is supported, and the features working
+    on universe databases directly (checkpoints, fork_at(), compaction of the universes) are not.
+    """
+
+    shard_count: int
+    shards: list[Shard]
+    # universe_id -> shard index
+    assignment: dict[int, int]
+    # shards changed since the last flush()
+    dirty_shards: set[int]
+
+    def __init__(self, instance_id: str, shard_count: int = 2, durability: str = 'strict', **kwargs: Any) -> None:
+        if kwargs.get('storage', COPY_STORAGE) != COPY_STORAGE:
+            raise Exception(f'Sharded multiverse supports only {COPY_STORAGE} storage')
+        for name in ('checkpoint_every_ticks', 'checkpoint_every_actions'):
+            if kwargs.get(name) is not None:
+                raise Exception(f'Sharded multiverse does not support checkpoints: {name}')
+        kwargs['storage'] = COPY_STORAGE
+        super().__init__(instance_id, durability=durability, **kwargs)
+        self.shard_count = shard_count
+        self.shards = []
+        self.assignment = {}
+        self.dirty_shards = set()
+
+    def __enter__(self) -> ShardedMultiverse:
+        super().__enter__()
+        self.assignment = dict(self.mdb.execute('select universe_id, shard from universe_shards'))
+        # Worker processes are spawned rather than forked, so they do not inherit the open connections.
+        context: multiprocessing.context.BaseContext = multiprocessing.get_context('spawn')
+        for index in range(self.shard_count):
+            directory: str = f'{self.instance_id}/shard-{index}'
+            # Forks are written into the directory of their shard by the shard of their parent.
+            Path(directory).mkdir(exist_ok=True)
+            pipe, worker_pipe = context.Pipe()
+            process: BaseProcess = context.Process(
+                target=serve,
+                args=(worker_pipe, directory, self.durability),
+                name=f'shard-{index}',
+                daemon=True
+            )
+            process.start()
+            self.shards.append(Shard(index, directory, process, pipe))
+        return self
+
+    def __exit__(self, *args) -> None:
+        for shard in self.shards:
+            self.request(shard.index, 'stop')
+            shard.process.join()
+        self.shards = []
+        super().__exit__(*args)
+
+    def request(self, index: int, command: str, *args: Any) -> Any:
+        self.shards[index].pipe.send((command, args))
+        return self.response(index)
+
+    def response(self, index: int) -> Any:
+        ok, result = self.shards[index].pipe.recv()
+        if not ok:
+            raise result
+        return result
+
+    def shard_of(self, universe_id: int) -> int:
+        index: int | None = self.assignment.get(universe_id)
+        if index is None:
+            raise Exception(f'No such universe: {universe_id}')
+        return index
+
+    def apply(self, action: dataclass, character_id: int) -> Exception | Rejection | None:
+        handler: ActionHandler | None = ACTION_HANDLERS.get(type(action))
+        if handler is None or not (handler.universe_level or isinstance(action, CreateUniverse)):
+            return super().apply(action, character_id)
+        rejection: Rejection | None = self.validate(handler, action, character_id)
+        if rejection is not None:
+            return self.apply_rejection(action, rejection)
+        try:
+            if isinstance(action, CreateUniverse):
+                self.create_universe(action.parent_id)
+                return None
+            index: int = self.shard_of(action.universe_id)
+            self.dirty_shards.add(index)
+            self.invalidate(action.universe_id)
+            outcome: Exception | Rejection | None = self.request(index, 'apply', [action])[0]
+        except Exception as e:
+            return self.apply_error(action, e)
+        return self.apply_error(action, outcome) if isinstance(outcome, Exception) else outcome
+
+    def apply_partitions(
+            self,
+            actions: list[tuple[dataclass, int]],
+            universe_indices: dict[int, list[int]],
+            errors: list[Exception | Rejection | None]
+    ) -> None:
+        # Every shard gets a single request with the valid actions of all its universes in their order.
+        requests: dict[int, list[int]] = {}
+        for universe_id, indices in universe_indices.items():
+            for index in indices:
+                action, character_id = actions[index]
+                rejection: Rejection | None = self.validate(ACTION_HANDLERS[type(action)], action, character_id)
+                if rejection is not None:
+                    errors[index] = self.apply_rejection(action, rejection)
+                else:
+                    requests.setdefault(self.shard_of(universe_id), []).append(index)
+                    self.invalidate(universe_id)
+        for shard_index, indices in requests.items():
+            self.dirty_shards.add(shard_index)
+            self.shards[shard_index].pipe.send(('apply', ([actions[index][0] for index in indices],)))
+        for shard_index, indices in requests.items():
+            for index, outcome in zip(indices, self.response(shard_index)):
+                errors[index] = self.apply_error(actions[index][0], outcome) if isinstance(outcome, Exception) \
+                    else outcome
+
+    def create_universe(self, parent_id: int | None) -> int:
+        # the least loaded shard
+        loads: list[int] = [0] * self.shard_count
+        for index in self.assignment.values():
+            loads[index] += 1
+        index: int = loads.index(min(loads))
+        universe_id: int = self.mdb.execute(INSERT_UNIVERSE_SQL, (parent_id,)).lastrowid
+        if parent_id is not None:
+            parent_index: int = self.shard_of(parent_id)
+            self.request(parent_index, 'snapshot', parent_id, f'{self.shards[index].directory}/{universe_id}.db')
+        self.request(index, 'adopt', universe_id, parent_id is None)
+        self.assign(universe_id, index)
+        self.dirty_shards.add(index)
+        self.universe_ids.add(universe_id)
+        self.universe_lineage.link(universe_id, parent_id)
+        return universe_id
+
+    def move_universe(self, universe_id: int, index: int) -> None:
+        """
+        Rebalances the shards: moves the database file of the universe to another shard.
+        """
+        source: int = self.shard_of(universe_id)
+        if source == index:
+            return
+        path: str = self.request(source, 'release', universe_id)
+        os.replace(path, f'{self.shards[index].directory}/{universe_id}.db')
+        self.request(index, 'adopt', universe_id, False)
+        self.assign(universe_id, index)
+        self.dirty_shards |= {source, index}
+
+    def assign(self, universe_id: int, index: int) -> None:
+        self.mdb.execute(
+            'insert into universe_shards (universe_id, shard) values (?, ?) '
+            'on conflict (universe_id) do update set shard = excluded.shard',
+            (universe_id, index)
+        )
+        self.assignment[universe_id] = index
+
+    def flush(self) -> None:
+        # The shards commit first: the tick becomes durable in the multiverse database only once they all have.
+        dirty_shards: list[int] = sorted(self.dirty_shards)
+        for index in dirty_shards:
+            self.shards[index].pipe.send(('commit', ()))
+        for index in dirty_shards:
+            self.response(index)
+        self.dirty_shards.clear()
+        super().flush()
+
+    def checkpoint(self) -> None:
+        raise Exception('Sharded multiverse does not support checkpoints')
+
+    def fork_at(self, universe_id: int, tick: int) -> int:
+        raise Exception('Sharded multiverse does not support fork_at()')
+
+    def restore(self, tick: int, instance_id: str) -> None:
+        raise Exception('Sharded multiverse does not support restore()')
+
+    def udb(self, universe_id: int, write: bool = False) -> Any:
+        raise Exception(f'Universe databases are owned by the shards: {universe_id}')
+
+    def locations(self, universe_id: int) -> list[tuple[str, str]]:
+        return self.request(self.shard_of(universe_id), 'locations', universe_id)
+
+    def directions(self, universe_id: int) -> list[tuple[str, str, int, int]]:
+        return self.request(self.shard_of(universe_id), 'directions', universe_id)
+
+    def route(self, universe_id: int, from_name: str, to_name: str) -> Route | None:
+        return self.request(self.shard_of(universe_id), 'route', universe_id, from_name, to_name)
+
+
+def serve(pipe: Pipe, directory: str, durability: str) -> None:
+    """
+    The loop of a shard worker process. The shard is a Multiverse of its own, whose universes table
+    lists the universes assigned to it under their multiverse-wide ids. The actions it gets
+    have already been validated by the coordinator, so they are applied on behalf of the root character.
+    """
+    with Multiverse(directory, durability=durability) as shard:
+        while True:
+            command, args = pipe.recv()
+            try:
+                result: Any = SHARD_COMMANDS[command](shard, *args)
+            except Exception as e:
+                pipe.send((False, portable(e)))
+                continue
+            pipe.send((True, result))
+            if command == 'stop':
+                return
+
+
+def adopt(shard: Multiverse, universe_id: int, create: bool) -> None:
+    # Parents may live on other shards, so the parent_id of shard universes is not kept.
+    shard.mdb.execute('insert into universes (id, parent_id) values (?, null)', (universe_id,))
+    shard.universe_ids.add(universe_id)
+    shard.universe_lineage.link(universe_id, None)
+    if create:
+        shard.storage.create(universe_id)
+
+
+def snapshot(shard: Multiverse, universe_id: int, path: str) -> None:
+    conn = shard.udb(universe_id)
+    if conn.in_transaction:
+        conn.commit()
+    backup(conn, path)
+
+
+def release(shard: Multiverse, universe_id: int) -> str:
+    shard.udb(universe_id)
+    shard.universe_db_close(universe_id)
+    shard.checkpoint_dirty_ids.discard(universe_id)
+    shard.universe_lineage.unlink(universe_id)
+    shard.mdb.execute('delete from universes where id = ?', (universe_id,))
+    shard.universe_ids.discard(universe_id)
+    return f'{shard.instance_id}/{universe_id}.db'
+
+
+def apply(shard: Multiverse, actions: list[dataclass]) -> list[Exception | Rejection | None]:
+    return [
+        portable(outcome) if isinstance(outcome, Exception) else outcome
+        for outcome in shard.apply_batch([(action, ROOT_CHARACTER_ID) for action in actions])
+    ]
+
+
+def portable(error: Exception) -> Exception:
+    """
+    The error itself if it can be sent to the coordinator, otherwise a plain Exception with the same message.
+    """
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return Exception(f'{type(error).__name__}: {error}')
+
+
+SHARD_COMMANDS: dict[str, Any] = {
+    'adopt': adopt,
+    'snapshot': snapshot,
+    'release': release,
+    'apply': apply,
+    'commit': Multiverse.flush,
+    'locations': Multiverse.locations,
+    'directions': Multiverse.directions,
+    'route': Multiverse.route,
+    'stop': lambda shard: None
+}
@@ -0,0 +1,552 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+from sqlite3 import Connection
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator
+
+from world import LOCATION_RECORD, WorldRecord
+
+if TYPE_CHECKING:
+    from multiverse import Multiverse
+
+COPY_STORAGE = 'copy'
+DELTA_STORAGE = 'delta'
+TEMPORAL_STORAGE = 'temporal'
+
+# The largest value SQLite can keep in an integer column.
+MAX_SEQ = 2 ** 63 - 1
+# valid_to_tick of the rows still in place
+OPEN_TICK = MAX_SEQ
+# rows written at once by load_world()
+LOAD_CHUNK_ROWS = 4096
+
+UNIVERSE_SCHEMA = '''
+    create table locations (
+        name text primary key,
+        description text not null
+    );
+    create table directions (
+        from_name text not null,
+        to_name text not null,
+        travel_time integer not null,
+        ordinal integer not null,
+
+        foreign key (from_name) references locations (name),
+        foreign key (to_name) references locations (name),
+        primary key (from_name, to_name),
+        unique (from_name, ordinal)
+    );
+    create index directions_from_name_idx on directions (from_name);
+'''
+
+DELTA_UNIVERSE_SCHEMA = '''
+    create table properties (
+        name text primary key,
+        value blob
+    );
+    create table locations (
+        seq integer primary key,
+        name text not null,
+        description text,
+        deleted integer not null default 0
+    );
+    create index locations_name_idx on locations (name, seq);
+    create table directions (
+        seq integer primary key,
+        from_name text not null,
+        to_name text not null,
+        travel_time integer,
+        ordinal integer,
+        deleted integer not null default 0
+    );
+    create index directions_from_name_idx on directions (from_name, seq);
+'''
+
+# The partial indexes are used only by queries repeating their literal condition, hence the formatting.
+TEMPORAL_UNIVERSE_SCHEMA = f'''
+    create table locations (
+        name text not null,
+        description text not null,
+        valid_from_tick integer not null,
+        valid_to_tick integer not null default {OPEN_TICK}
+    );
+    create unique index locations_name_idx on locations (name) where valid_to_tick = {OPEN_TICK};
+    create index locations_valid_idx on locations (valid_from_tick, valid_to_tick);
+    create table directions (
+        from_name text not null,
+        to_name text not null,
+        travel_time integer not null,
+        ordinal integer not null,
+        valid_from_tick integer not null,
+        valid_to_tick integer not null default {OPEN_TICK}
+    );
+    create unique index directions_to_name_idx on directions (from_name, to_name) where valid_to_tick = {OPEN_TICK};
+    create unique index directions_ordinal_idx on directions (from_name, ordinal) where valid_to_tick = {OPEN_TICK};
+    create index directions_valid_idx on directions (valid_from_tick, valid_to_tick);
+'''
+
+
+@dataclass
+class UniverseView:
+    tick: int
+    locations: list[tuple[str, str]]
+    directions: list[tuple[str, str, int, int]]
+
+
+class CopyStorage:
+    """
+    Every universe database holds the complete state of its universe.
+    Forking a universe copies the parent's database.
+    """
+
+    multiverse: Multiverse
+
+    def __init__(self, multiverse: Multiverse) -> None:
+        self.multiverse = multiverse
+
+    def create(self, universe_id: int) -> None:
+        self.multiverse.udb(universe_id, write=True).executescript(UNIVERSE_SCHEMA)
+
+    def fork(self, parent_universe_id: int, universe_id: int) -> None:
+        parent: Connection = self.multiverse.udb(parent_universe_id)
+        # Backup API blocks on a source connection with a pending write transaction,
+        # so the parent's changes made during the current tick are flushed first.
+        if parent.in_transaction:
+            parent.commit()
+        parent.backup(self.multiverse.udb(universe_id, write=True))
+
+    def create_location(self, universe_id: int, name: str, description: str) -> None:
+        self.multiverse.udb(universe_id, write=True).execute(
+            'insert into locations (name, description) values (?, ?)',
+            (name, description)
+        )
+
+    def connect_locations(self, universe_id: int, from_name: str, to_name: str, travel_time: int) -> None:
+        self.multiverse.udb(universe_id, write=True).executemany(
+            '''
+                insert into directions values
+                (?, ?, ?, (select count(*) from directions where from_name = ?))
+            ''',
+            [
+                (from_name, to_name, travel_time, from_name),
+                (to_name, from_name, travel_time, to_name)
+            ]
+        )
+
+    def create_location_batch(self, universe_id: int, locations: list[tuple[str, str]]) -> None:
+        self.multiverse.udb(universe_id, write=True).executemany(
+            'insert into locations (name, description) values (?, ?)',
+            locations
+        )
+
+    def connect_locations_batch(self, universe_id: int, connections: list[tuple[str, str, int]]) -> None:
+        self.multiverse.udb(universe_id, write=True).executemany(
+            '''
+                insert into directions values
+                (?, ?, ?, (select count(*) from directions where from_name = ?))
+            ''',
+            (
+                direction
+                for from_name, to_name, travel_time in connections
+                for direction in (
+                    (from_name, to_name, travel_time, from_name),
+                    (to_name, from_name, travel_time, to_name)
+                )
+            )
+        )
+
+    def load_world(self, universe_id: int, records: Iterable[WorldRecord]) -> None:
+        conn: Connection = self.multiverse.udb(universe_id, write=True)
+        ordinals: dict[str, int] = dict(conn.execute('select from_name, count(*) from directions group by from_name'))
+        conn.execute('drop index directions_from_name_idx')
+        load_world(
+            records,
+            ordinals,
+            lambda locations: conn.executemany('insert into locations (name, description) values (?, ?)', locations),
+            lambda directions: conn.executemany('insert into directions values (?, ?, ?, ?)', directions)
+        )
+        conn.execute('create index directions_from_name_idx on directions (from_name)')
+
+    def locations(self, universe_id: int) -> list[tuple[str, str]]:
+        return self.multiverse.udb(universe_id).execute(
+            'select name, description from locations order by name'
+        ).fetchall()
+
+    def directions(self, universe_id: int) -> list[tuple[str, str, int, int]]:
+        return self.multiverse.udb(universe_id).execute(
+            'select from_name, to_name, travel_time, ordinal from directions order by from_name, ordinal'
+        ).fetchall()
+
+
+class TemporalStorage(CopyStorage):
+    """
+    Copy storage whose rows carry their validity: a row is part of the state at the beginning of the ticks
+    in [valid_from_tick, valid_to_tick). Rows are written with valid_from_tick being the tick after
+    the current one and are closed rather than deleted, so the state as of any past tick is a range lookup.
+    """
+
+    def create(self, universe_id: int) -> None:
+        self.multiverse.udb(universe_id, write=True).executescript(TEMPORAL_UNIVERSE_SCHEMA)
+
+    def fork_at(self, universe_id: int, fork_universe_id: int, tick: int) -> None:
+        """
+        Fills an empty universe with the rows universe_id had at the beginning of the given tick.
+        """
+        view: UniverseView = self.view(universe_id, tick)
+        self.create(fork_universe_id)
+        conn: Connection = self.multiverse.udb(fork_universe_id, write=True)
+        conn.executemany(
+            'insert into locations (name, description, valid_from_tick) values (?, ?, ?)',
+            ((name, description, tick) for name, description in view.locations)
+        )
+        conn.executemany(
+            'insert into directions (from_name, to_name, travel_time, ordinal, valid_from_tick) values (?, ?, ?, ?, ?)',
+            (direction + (tick,) for direction in view.directions)
+        )
+
+    def valid_from_tick(self) -> int:
+        return self.multiverse.tick + 1
+
+    def check_locations(self, conn: Connection, names: Iterable[str]) -> None:
+        # directions cannot reference the locations, as location names are unique among the open rows only
+        for name in names:
+            if conn.execute(
+                    f'select 1 from locations where name = ? and valid_to_tick = {OPEN_TICK}',
+                    (name,)
+            ).fetchone() is None:
+                raise Exception(f'No such location: {name}')
+
+    def create_location(self, universe_id: int, name: str, description: str) -> None:
+        self.create_location_batch(universe_id, [(name, description)])
+
+    def connect_locations(self, universe_id: int, from_name: str, to_name: str, travel_time: int) -> None:
+        self.connect_locations_batch(universe_id, [(from_name, to_name, travel_time)])
+
+    def create_location_batch(self, universe_id: int, locations: list[tuple[str, str]]) -> None:
+        valid_from_tick: int = self.valid_from_tick()
+        self.multiverse.udb(universe_id, write=True).executemany(
+            'insert into locations (name, description, valid_from_tick) values (?, ?, ?)',
+            ((name, description, valid_from_tick) for name, description in locations)
+        )
+
+    def connect_locations_batch(self, universe_id: int, connections: list[tuple[str, str, int]]) -> None:
+        conn: Connection = self.multiverse.udb(universe_id, write=True)
+        self.check_locations(conn, {name for from_name, to_name, _ in connections for name in (from_name, to_name)})
+        valid_from_tick: int = self.valid_from_tick()
+        conn.executemany(
+            f'''
+                insert into directions (from_name, to_name, travel_time, ordinal, valid_from_tick) values
+                (?, ?, ?, (select count(*) from directions where from_name = ? and valid_to_tick = {OPEN_TICK}), ?)
+            ''',
+            (
+                direction
+                for from_name, to_name, travel_time in connections
+                for direction in (
+                    (from_name, to_name, travel_time, from_name, valid_from_tick),
+                    (to_name, from_name, travel_time, to_name, valid_from_tick)
+                )
+            )
+        )
+
+    def load_world(self, universe_id: int, records: Iterable[WorldRecord]) -> None:
+        conn: Connection = self.multiverse.udb(universe_id, write=True)
+        names: set[str] = {name for name, _ in self.locations(universe_id)}
+        ordinals: dict[str, int] = dict(conn.execute(
+            f'select from_name, count(*) from directions where valid_to_tick = {OPEN_TICK} group by from_name'
+        ))
+
+        def checked() -> Iterator[WorldRecord]:
+            for record in records:
+                if record[0] == LOCATION_RECORD:
+                    names.add(record[1])
+                else:
+                    for name in record[1:3]:
+                        if name not in names:
+                            raise Exception(f'No such location: {name}')
+                yield record
+
+        valid_from_tick: int = self.valid_from_tick()
+        conn.execute('drop index locations_valid_idx')
+        conn.execute('drop index directions_valid_idx')
+        load_world(
+            checked(),
+            ordinals,
+            lambda locations: conn.executemany(
+                'insert into locations (name, description, valid_from_tick) values (?, ?, ?)',
+                ((name, description, valid_from_tick) for name, description in locations)
+            ),
+            lambda directions: conn.executemany(
+                'insert into directions (from_name, to_name, travel_time, ordinal, valid_from_tick) '
+                'values (?, ?, ?, ?, ?)',
+                (direction + (valid_from_tick,) for direction in directions)
+            )
+        )
+        conn.execute('create index locations_valid_idx on locations (valid_from_tick, valid_to_tick)')
+        conn.execute('create index directions_valid_idx on directions (valid_from_tick, valid_to_tick)')
+
+    def locations(self, universe_id: int) -> list[tuple[str, str]]:
+        return self.multiverse.udb(universe_id).execute(
+            f'select name, description from locations where valid_to_tick = {OPEN_TICK} order by name'
+        ).fetchall()
+
+    def directions(self, universe_id: int) -> list[tuple[str, str, int, int]]:
+        return self.multiverse.udb(universe_id).execute(
+            f'''
+                select from_name, to_name, travel_time, ordinal from directions
+                where valid_to_tick = {OPEN_TICK} order by from_name, ordinal
+            '''
+        ).fetchall()
+
+    def view(self, universe_id: int, tick: int) -> UniverseView:
+        conn: Connection = self.multiverse.udb(universe_id)
+        return UniverseView(
+            tick,
+            conn.execute(
+                '''
+                    select name, description from locations
+                    where valid_from_tick <= ? and valid_to_tick > ? order by name
+                ''',
+                (tick, tick)
+            ).fetchall(),
+            conn.execute(
+                '''
+                    select from_name, to_name, travel_time, ordinal from directions
+                    where valid_from_tick <= ? and valid_to_tick > ? order by from_name, ordinal
+                ''',
+                (tick, tick)
+            ).fetchall()
+        )
+
+
+class DeltaStorage:
+    """
+    A forked universe database keeps only the rows written in that universe.
+    Rows are never updated in place: every change, including a removal (tombstone),
+    is appended with a new seq number. Reads fall through the chain of base universes,
+    seeing each base only up to the seq numbers it had at the moment of the fork.
+    """
+
+    multiverse: Multiverse
+    flatten_depth: int
+    # universe_id -> (base_universe_id, base_locations_seq, base_directions_seq)
+    bases: dict[int, tuple[int, int, int] | None]
+
+    def __init__(self, multiverse: Multiverse, flatten_depth: int) -> None:
+        self.multiverse = multiverse
+        self.flatten_depth = flatten_depth
+        self.bases = {}
+
+    def create(self, universe_id: int) -> None:
+        self.multiverse.udb(universe_id, write=True).executescript(DELTA_UNIVERSE_SCHEMA)
+        self.bases[universe_id] = None
+
+    def fork(self, parent_universe_id: int, universe_id: int) -> None:
+        self.create(universe_id)
+        conn: Connection = self.multiverse.udb(universe_id, write=True)
+        if len(self.chain(parent_universe_id)) >= self.flatten_depth:
+            conn.executemany(
+                'insert into locations (name, description) values (?, ?)',
+                self.locations(parent_universe_id)
+            )
+            conn.executemany(
+                'insert into directions (from_name, to_name, travel_time, ordinal) values (?, ?, ?, ?)',
+                self.directions(parent_universe_id)
+            )
+            return
+        parent: Connection = self.multiverse.udb(parent_universe_id)
+        base: tuple[int, int, int] = (
+            parent_universe_id,
+            parent.execute('select coalesce(max(seq), 0) from locations').fetchone()[0],
+            parent.execute('select coalesce(max(seq), 0) from directions').fetchone()[0]
+        )
+        conn.executemany(
+            'insert into properties (name, value) values (?, ?)',
+            zip(('base_universe_id', 'base_locations_seq', 'base_directions_seq'), base)
+        )
+        self.bases[universe_id] = base
+
+    def base(self, universe_id: int) -> tuple[int, int, int] | None:
+        if universe_id not in self.bases:
+            props: dict[str, int] = dict(
+                self.multiverse.udb(universe_id).execute('select name, value from properties').fetchall()
+            )
+            self.bases[universe_id] = (
+                props['base_universe_id'],
+                props['base_locations_seq'],
+                props['base_directions_seq']
+            ) if 'base_universe_id' in props else None
+        return self.bases[universe_id]
+
+    def chain(self, universe_id: int) -> list[tuple[Connection, int, int]]:
+        chain: list[tuple[Connection, int, int]] = [(self.multiverse.udb(universe_id), MAX_SEQ, MAX_SEQ)]
+        base: tuple[int, int, int] | None = self.base(universe_id)
+        while base is not None:
+            base_universe_id, locations_seq, directions_seq = base
+            chain.append((self.multiverse.udb(base_universe_id), locations_seq, directions_seq))
+            base = self.base(base_universe_id)
+        return chain
+
+    def location(self, universe_id: int, name: str) -> str | None:
+        for conn, locations_seq, _ in self.chain(universe_id):
+            row = conn.execute(
+                '''
+                    select description, deleted from locations
+                    where name = ? and seq <= ? order by seq desc limit 1
+                ''',
+                (name, locations_seq)
+            ).fetchone()
+            if row is not None:
+                return None if row[1] else row[0]
+        return None
+
+    def outgoing(self, universe_id: int, from_name: str) -> dict[str, tuple[int, int]]:
+        found: dict[str, tuple[int, int] | None] = {}
+        for conn, _, directions_seq in self.chain(universe_id):
+            for to_name, travel_time, ordinal, deleted in conn.execute(
+                '''
+                    select to_name, travel_time, ordinal, deleted from directions
+                    where from_name = ? and seq <= ? order by seq desc
+                ''',
+                (from_name, directions_seq)
+            ):
+                found.setdefault(to_name, None if deleted else (travel_time, ordinal))
+        return {to_name: found[to_name] for to_name in found if found[to_name] is not None}
+
+    def create_location(self, universe_id: int, name: str, description: str) -> None:
+        if self.location(universe_id, name) is not None:
+            raise Exception(f'Location already exists: {name}')
+        self.multiverse.udb(universe_id, write=True).execute(
+            'insert into locations (name, description) values (?, ?)',
+            (name, description)
+        )
+
+    def connect_locations(self, universe_id: int, from_name: str, to_name: str, travel_time: int) -> None:
+        for name in (from_name, to_name):
+            if self.location(universe_id, name) is None:
+                raise Exception(f'No such location: {name}')
+        from_directions: dict[str, tuple[int, int]] = self.outgoing(universe_id, from_name)
+        if to_name in from_directions:
+            raise Exception(f'Locations are already connected: {from_name}, {to_name}')
+        self.multiverse.udb(universe_id, write=True).executemany(
+            'insert into directions (from_name, to_name, travel_time, ordinal) values (?, ?, ?, ?)',
+            [
+                (from_name, to_name, travel_time, len(from_directions)),
+                (to_name, from_name, travel_time, len(self.outgoing(universe_id, to_name)))
+            ]
+        )
+
+    def create_location_batch(self, universe_id: int, locations: list[tuple[str, str]]) -> None:
+        for name, description in locations:
+            self.create_location(universe_id, name, description)
+
+    def connect_locations_batch(self, universe_id: int, connections: list[tuple[str, str, int]]) -> None:
+        for from_name, to_name, travel_time in connections:
+            self.connect_locations(universe_id, from_name, to_name, travel_time)
+
+    def load_world(self, universe_id: int, records: Iterable[WorldRecord]) -> None:
+        names: set[str] = {name for name, _ in self.locations(universe_id)}
+        connected: set[tuple[str, str]] = set()
+        ordinals: dict[str, int] = {}
+        for from_name, to_name, _, _ in self.directions(universe_id):
+            connected.add((from_name, to_name))
+            ordinals[from_name] = ordinals.get(from_name, 0) + 1
+
+        # Constraints are not enforced by the delta tables, so the records are checked against the whole chain here.
+        def checked() -> Iterator[WorldRecord]:
+            for record in records:
+                if record[0] == LOCATION_RECORD:
+                    if record[1] in names:
+                        raise Exception(f'Location already exists: {record[1]}')
+                    names.add(record[1])
+                else:
+                    _, from_name, to_name, _ = record
+                    for name in (from_name, to_name):
+                        if name not in names:
+                            raise Exception(f'No such location: {name}')
+                    if (from_name, to_name) in connected:
+                        raise Exception(f'Locations are already connected: {from_name}, {to_name}')
+                    connected.add((from_name, to_name))
+                    connected.add((to_name, from_name))
+                yield record
+
+        conn: Connection = self.multiverse.udb(universe_id, write=True)
+        conn.execute('drop index locations_name_idx')
+        conn.execute('drop index directions_from_name_idx')
+        load_world(
+            checked(),
+            ordinals,
+            lambda locations: conn.executemany('insert into locations (name, description) values (?, ?)', locations),
+            lambda directions: conn.executemany(
+                'insert into directions (from_name, to_name, travel_time, ordinal) values (?, ?, ?, ?)',
+                directions
+            )
+        )
+        conn.execute('create index locations_name_idx on locations (name, seq)')
+        conn.execute('create index directions_from_name_idx on directions (from_name, seq)')
+
+    def locations(self, universe_id: int) -> list[tuple[str, str]]:
+        found: dict[str, str | None] = {}
+        for conn, locations_seq, _ in self.chain(universe_id):
+            for name, description, deleted in conn.execute(
+                'select name, description, deleted from locations where seq <= ? order by seq desc',
+                (locations_seq,)
+            ):
+                found.setdefault(name, None if deleted else description)
+        return sorted((name, description) for name, description in found.items() if description is not None)
+
+    def directions(self, universe_id: int) -> list[tuple[str, str, int, int]]:
+        found: dict[tuple[str, str], tuple[int, int] | None] = {}
+        for conn, _, directions_seq in self.chain(universe_id):
+            for from_name, to_name, travel_time, ordinal, deleted in conn.execute(
+                '''
+                    select from_name, to_name, travel_time, ordinal, deleted from directions
+                    where seq <= ? order by seq desc
+                ''',
+                (directions_seq,)
+            ):
+                found.setdefault((from_name, to_name), None if deleted else (travel_time, ordinal))
+        return sorted(
+            (
+                (from_name, to_name, value[0], value[1])
+                for (from_name, to_name), value in found.items() if value is not None
+            ),
+            key=lambda direction: (direction[0], direction[3])
+        )
+
+
+def load_world(
+        records: Iterable[WorldRecord],
+        ordinals: dict[str, int],
+        write_locations: Callable[[list[tuple[str, str]]], None],
+        write_directions: Callable[[list[tuple[str, str, int, int]]], None]
+) -> None:
+    """
+    Writes the records in chunks, numbering the directions from the given ordinals, i.e. the numbers
+    of directions each location already has. Pending locations are always written before pending directions.
+    """
+    locations: list[tuple[str, str]] = []
+    directions: list[tuple[str, str, int, int]] = []
+    for record in records:
+        if record[0] == LOCATION_RECORD:
+            locations.append((record[1], record[2]))
+            if len(locations) >= LOAD_CHUNK_ROWS:
+                write_locations(locations)
+                locations = []
+            continue
+        _, from_name, to_name, travel_time = record
+        from_ordinal: int = ordinals.get(from_name, 0)
+        to_ordinal: int = ordinals.get(to_name, 0)
+        ordinals[from_name] = from_ordinal + 1
+        ordinals[to_name] = to_ordinal + 1
+        directions.append((from_name, to_name, travel_time, from_ordinal))
+        directions.append((to_name, from_name, travel_time, to_ordinal))
+        if len(directions) >= LOAD_CHUNK_ROWS:
+            if locations:
+                write_locations(locations)
+                locations = []
+            write_directions(directions)
+            directions = []
+    if locations:
+        write_locations(locations)
+    if directions:
+        write_directions(directions)
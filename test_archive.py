@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import os
+import shutil
+import unittest
+from uuid import uuid4
+
+from archive import LZMA_COMPRESSION, Archive
+
+
+class TestArchive(unittest.TestCase):
+    directory: str
+
+    def setUp(self):
+        self.directory = '.test-' + str(uuid4())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        # given
+        rows = [
+            (tick, subtick, subtick, f'{{"kind": "CreatePlayer", "player_id": "player{tick}-{subtick}"}}', None, None)
+            if subtick % 2 else
+            (tick, subtick, 0, None, bytes([1, 3, 5]) + b'Location' + bytes([tick % 256]), tick % 3 + 1)
+            for tick in range(1000)
+            for subtick in range(4)
+        ]
+        archive = Archive(self.directory)
+        # when
+        archive.append(rows[:2000])
+        archive.append(rows[2000:])
+        # then
+        self.assertEqual(rows, list(archive.rows(0, 1000)))
+        self.assertEqual(rows[1396:2404], list(archive.rows(349, 601)))
+        self.assertEqual([], list(archive.rows(1000, 2000)))
+        self.assertEqual(
+            ['000000000000-000000000499.seg', '000000000500-000000000999.seg'],
+            sorted(os.listdir(self.directory))
+        )
+        # when reopened
+        archive = Archive(self.directory, LZMA_COMPRESSION)
+        # then
+        self.assertEqual(999, archive.archived_until())
+        self.assertEqual(rows[3996:], list(archive.rows(999, 1000)))
+
+    def test_multiple_blocks(self):
+        # given
+        rows = [(tick, 0, 0, 'x' * 1000, None, None) for tick in range(300)]
+        archive = Archive(self.directory, LZMA_COMPRESSION)
+        # when
+        archive.append(rows)
+        # then
+        self.assertEqual(rows, list(archive.rows(0, 300)))
+        self.assertEqual(rows[100:200], list(archive.rows(100, 200)))
+
+    def test_ticks_are_archived_once(self):
+        # given
+        archive = Archive(self.directory)
+        archive.append([(5, 0, 0, '{}', None, None)])
+        # expect
+        with self.assertRaises(Exception):
+            archive.append([(5, 1, 0, '{}', None, None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
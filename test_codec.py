@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import json
+import unittest
+from dataclasses import asdict
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter, LoadWorld
+from codec import decode_action_payload, encode_action
+
+
+class TestCodec(unittest.TestCase):
+
+    def test_round_trip(self):
+        for action in [
+            CreatePlayer(player_id='player1'),
+            CreateUniverse(),
+            CreateUniverse(parent_id=42),
+            CreateLocation(name='Tbilisi', universe_id=7, description='The capital of Georgia'),
+            CreateLocation(name='Тбилиси', universe_id=7, description=''),
+            ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=33),
+            ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=-2 ** 40),
+            ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=2 ** 63),
+            ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=2 ** 70),
+            ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=-2 ** 70),
+            CreateCharacter(player_id='player1', universe_id=7),
+            CreateCharacter(parent_id=300, universe_id=None),
+            LoadWorld(universe_id=7, source='world.csv'),
+            LoadWorld(universe_id=7, source='world.csv', digest='0123456789abcdef0123456789abcdef')
+        ]:
+            # expect
+            self.assertEqual(action, decode_action_payload(encode_action(action), getattr(action, 'universe_id', None)))
+
+    def test_layout(self):
+        # expect version, tag, bitmap of optional fields which are None and then the values
+        self.assertEqual(bytes([1, 2, 1]), encode_action(CreateUniverse()))
+        self.assertEqual(bytes([1, 2, 0, 84]), encode_action(CreateUniverse(parent_id=42)))
+        self.assertEqual(
+            bytes([1, 4, 6]) + b'London' + bytes([7]) + b'Tbilisi' + bytes([66]),
+            encode_action(ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=33))
+        )
+
+    def test_smaller_than_json(self):
+        # given
+        action = ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=7, travel_time=33)
+        # expect
+        self.assertLess(len(encode_action(action)) * 3, len(json.dumps(asdict(action))))
+
+    def test_invalid_field_values(self):
+        # expect
+        for action in [
+            CreatePlayer(player_id=None),
+            CreatePlayer(player_id=42),
+            CreateUniverse(parent_id='42'),
+            CreateUniverse(parent_id=True)
+        ]:
+            with self.subTest(action=action), self.assertRaisesRegex(Exception, 'must be'):
+                encode_action(action)
+        with self.assertRaisesRegex(Exception, 'Unknown action type'):
+            encode_action(asdict(CreateUniverse()))
+
+    def test_unknown_version(self):
+        # expect
+        with self.assertRaises(Exception):
+            decode_action_payload(bytes([99, 2, 1]), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import threading
+import time
+import unittest
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse
+from events import BLOCK_ON_OVERFLOW, DROP_ON_OVERFLOW, EventSink
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+
+
+class StalledFile:
+    """
+    Keeps the writer thread of a sink busy until released.
+    """
+
+    def __init__(self, file) -> None:
+        self.file = file
+        self.released = threading.Event()
+
+    def write(self, text: str) -> None:
+        self.released.wait()
+        self.file.write(text)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class TestEventSink(unittest.TestCase):
+    instance_id: str
+
+    def setUp(self):
+        self.instance_id = '.test-' + str(uuid4())
+
+    def tearDown(self):
+        shutil.rmtree(self.instance_id)
+
+    def test_multiverse_events(self):
+        # given
+        with Multiverse(self.instance_id) as multiverse:
+            path = f'{self.instance_id}/events.jsonl'
+            # when
+            with EventSink(path) as sink:
+                multiverse.events = sink
+                multiverse.record_action(0, ROOT_CHARACTER_ID, CreatePlayer(player_id='player1'))
+                multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+                multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+                multiverse.apply(CreateUniverse(parent_id=42), 42)
+        # then
+        with open(path) as f:
+            events = [json.loads(line) for line in f]
+        self.assertEqual(
+            ['STORE_ACTION', 'BEFORE_APPLY', 'BEFORE_APPLY', 'APPLY_REJECTED', 'BEFORE_APPLY', 'APPLY_REJECTED'],
+            [event['event_type'] for event in events]
+        )
+        self.assertEqual({'kind': 'CreatePlayer', 'player_id': 'player1'}, events[0]['action'])
+        self.assertEqual('already_exists', events[3]['reason'])
+
+    def test_drop_on_overflow(self):
+        # given
+        sink = self.stalled_sink(DROP_ON_OVERFLOW)
+        # when
+        sink.emit({'n': 2})
+        sink.emit({'n': 3})
+        sink.emit({'n': 4})
+        sink.file.released.set()
+        sink.close()
+        # then
+        self.assertEqual(1, sink.dropped)
+        self.assertEqual([1, 2, 3], self.written())
+
+    def test_block_on_overflow(self):
+        # given
+        sink = self.stalled_sink(BLOCK_ON_OVERFLOW)
+        sink.emit({'n': 2})
+        sink.emit({'n': 3})
+        # when
+        producer = threading.Thread(target=lambda: sink.emit({'n': 4}))
+        producer.start()
+        producer.join(0.1)
+        # then
+        self.assertTrue(producer.is_alive())
+        # when
+        sink.file.released.set()
+        producer.join()
+        sink.close()
+        # then
+        self.assertEqual(0, sink.dropped)
+        self.assertEqual([1, 2, 3, 4], self.written())
+
+    def stalled_sink(self, overflow: str) -> EventSink:
+        os.makedirs(self.instance_id)
+        sink = EventSink(f'{self.instance_id}/events.jsonl', capacity=2, overflow=overflow)
+        sink.file = StalledFile(sink.file)
+        sink.emit({'n': 1})
+        # waits for the writer to take the first event and get stuck writing it
+        while sink.buffer:
+            time.sleep(0.001)
+        return sink
+
+    def written(self) -> list[int]:
+        with open(f'{self.instance_id}/events.jsonl') as f:
+            return [json.loads(line)['n'] for line in f]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import shutil
+import unittest
+from dataclasses import dataclass
+from uuid import uuid4
+
+from actions import CreateUniverse, CreateLocation
+from codec import BINARY_ENCODING, decode_action_payload, encode_action
+from handlers import ACTION_HANDLERS, ActionHandler, register_action
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+
+
+@dataclass
+class DescribeLocation:
+    name: str
+    universe_id: int
+    description: str
+
+
+def describe_location(multiverse: Multiverse, action: DescribeLocation) -> None:
+    multiverse.udb(action.universe_id, write=True).execute(
+        'update locations set description = ? where name = ?',
+        (action.description, action.name)
+    )
+
+
+if DescribeLocation not in ACTION_HANDLERS:
+    register_action(DescribeLocation, 100, ActionHandler(describe_location, universe_level=True))
+
+
+class TestHandlers(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()), action_encoding=BINARY_ENCODING)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(
+            CreateLocation(name='Tbilisi', universe_id=1, description='The capital of Georgia'),
+            ROOT_CHARACTER_ID
+        )
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_plugin_action(self):
+        # given
+        action = DescribeLocation(name='Tbilisi', universe_id=1, description='Old town and sulfur baths')
+        # when
+        self.multiverse.record_action(0, ROOT_CHARACTER_ID, action)
+        error = self.multiverse.apply(action, ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # then
+        self.assertIsNone(error)
+        self.assertEqual([('Tbilisi', 'Old town and sulfur baths')], self.multiverse.locations(1))
+        self.assertEqual([(0, 0, ROOT_CHARACTER_ID, action)], list(self.multiverse.logged_actions(0, 1)))
+        self.assertEqual(action, decode_action_payload(encode_action(action), 1))
+
+    def test_plugin_action_is_root_only_by_default(self):
+        # when
+        error = self.multiverse.apply(DescribeLocation(name='Tbilisi', universe_id=1, description='Nope'), 42)
+        # then
+        self.assertEqual('Action permitted only for root character', str(error))
+        self.assertEqual([('Tbilisi', 'The capital of Georgia')], self.multiverse.locations(1))
+
+    def test_unknown_action(self):
+        # given
+        @dataclass
+        class Teleport:
+            name: str
+
+        # when
+        error = self.multiverse.apply(Teleport(name='Tbilisi'), ROOT_CHARACTER_ID)
+        # then
+        self.assertEqual('Unknown action: Teleport', str(error))
+
+    def test_register_twice(self):
+        # expect
+        with self.assertRaises(Exception):
+            register_action(DescribeLocation, 100, ActionHandler(describe_location))
+
+    def test_tag_taken(self):
+        # given
+        @dataclass
+        class CreateDungeon:
+            name: str
+
+        # expect
+        with self.assertRaises(Exception):
+            register_action(CreateDungeon, 3, ActionHandler(describe_location))
+        self.assertNotIn(CreateDungeon, ACTION_HANDLERS)
+
+
+if __name__ == '__main__':
+    unittest.main()
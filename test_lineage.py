@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import shutil
+import unittest
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse, CreateCharacter
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+
+
+class TestLineage(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()))
+        self.multiverse.__enter__()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_universe_lineage(self):
+        # given a chain of 300 universes and a branch off its middle
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        for universe_id in range(1, 300):
+            self.multiverse.apply(CreateUniverse(parent_id=universe_id), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateUniverse(parent_id=150), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # expect
+        lineage = self.multiverse.universe_lineage
+        self.assertEqual(list(range(299, 0, -1)), lineage.ancestors(300))
+        self.assertEqual(list(range(150, 0, -1)), lineage.ancestors(301))
+        self.assertEqual([], lineage.ancestors(1))
+        self.assertEqual([151, 301] + list(range(152, 301)), lineage.descendants(150))
+        self.assertEqual([], lineage.descendants(301))
+
+    def test_character_lineage(self):
+        # given
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateCharacter(player_id='player1', universe_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateCharacter(universe_id=1, parent_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateCharacter(universe_id=1, parent_id=2), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateCharacter(universe_id=1, parent_id=1), ROOT_CHARACTER_ID)
+        # expect
+        lineage = self.multiverse.character_lineage
+        self.assertEqual([2, 1], lineage.ancestors(3))
+        self.assertEqual([2, 4, 3], lineage.descendants(1))
+        self.assertEqual([], lineage.ancestors(ROOT_CHARACTER_ID))
+
+    def test_queries_seek_indexes(self):
+        # given
+        lineage = self.multiverse.universe_lineage
+        # expect
+        for sql in [
+            f'select ancestor_id from {lineage.table} where descendant_id = 1 and depth > 0 order by depth',
+            f'select descendant_id from {lineage.table} where ancestor_id = 1 and depth > 0 '
+            'order by depth, descendant_id'
+        ]:
+            plan = ' '.join(row[3] for row in self.multiverse.mdb.execute('explain query plan ' + sql))
+            self.assertIn('SEARCH', plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import shutil
+import unittest
+from time import perf_counter
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation
+from metrics import Histogram
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+
+
+class TestMetrics(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()), metrics=True, sql_timing=True)
+        self.multiverse.__enter__()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_snapshot(self):
+        # when
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply_batch([
+            (CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID),
+            (CreatePlayer(player_id='player2'), ROOT_CHARACTER_ID)
+        ])
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateLocation(name='Tomsk', universe_id=1, description='Not my favourite city'), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateLocation(name='Tomsk', universe_id=1, description='Duplicate'), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        snapshot = self.multiverse.metrics.snapshot()
+        # then
+        self.assertEqual(1, snapshot['apply_seconds']['CreateUniverse']['count'])
+        self.assertEqual(2, snapshot['apply_seconds']['CreateLocation']['count'])
+        self.assertEqual(1, snapshot['apply_batch_seconds']['CreatePlayer']['count'])
+        self.assertEqual({'IntegrityError': 1}, snapshot['errors'])
+        self.assertEqual({'already_exists': 1}, snapshot['rejections'])
+        self.assertEqual(1, snapshot['commit_seconds']['multiverse']['count'])
+        self.assertEqual(1, snapshot['commit_seconds']['universe']['count'])
+        self.assertEqual(1, snapshot['tick_commit_seconds']['count'])
+        self.assertEqual(2, snapshot['sql_executions']['insert into locations (name, description) values (?, ?)'])
+
+    def test_sql_seconds_cover_short_statements(self):
+        # given
+        sql = 'insert into players (id) values (?)'
+        executions = self.multiverse.metrics.sql_executions[sql]
+        seconds = self.multiverse.metrics.sql_seconds[sql]
+        started = perf_counter()
+        # when
+        for i in range(5000):
+            self.multiverse.mdb.execute(sql, (f'player{i}',))
+        elapsed = perf_counter() - started
+        # then every execution is charged its whole duration, however short
+        self.assertEqual(executions + 5000, self.multiverse.metrics.sql_executions[sql])
+        self.assertGreater(self.multiverse.metrics.sql_seconds[sql] - seconds, elapsed / 2)
+
+    def test_prometheus(self):
+        # when
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        text = self.multiverse.metrics.prometheus()
+        # then
+        self.assertIn('# TYPE temporta_apply_seconds histogram\n', text)
+        self.assertIn('temporta_apply_seconds_bucket{kind="CreatePlayer",le="+Inf"} 1\n', text)
+        self.assertIn('temporta_apply_seconds_count{kind="CreatePlayer"} 1\n', text)
+        self.assertIn('temporta_tick_commit_seconds_count 1\n', text)
+        self.assertIn('temporta_sql_executions_total{statement="insert into players (id) values (?)"} 2\n', text)
+
+    def test_disabled_by_default(self):
+        # given
+        self.multiverse.__exit__()
+        # when
+        self.multiverse = Multiverse(self.multiverse.instance_id)
+        self.multiverse.__enter__()
+        # then
+        self.assertIsNone(self.multiverse.metrics)
+        self.assertIsNone(self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID))
+
+    def test_histogram(self):
+        # given
+        histogram = Histogram()
+        # when
+        for seconds in [0.000001, 0.00001, 0.002, 0.002, 100]:
+            histogram.observe(seconds)
+        # then
+        self.assertEqual({'1e-05': 2, '0.0031623': 2, '+Inf': 1}, {
+            bound: count for bound, count in histogram.snapshot()['buckets'].items() if count
+        })
+        self.assertEqual(5, histogram.count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,13 @@ import json
 import logging
 import os
 import shutil
+import sqlite3
 import unittest
 from typing import Any
 from uuid import uuid4
 
 from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter
-from multiverse import Multiverse, ROOT_CHARACTER_ID
+from multiverse import Multiverse, ROOT_CHARACTER_ID, SCHEMA_VERSION
 from testutil import Conn
 
 # TODO remove
@@ -37,10 +38,66 @@ class TestMultiverse(unittest.TestCase):
     def test_create_multiverse(self):
         # expect
         self.assertEqual(
-            [('tick', 0)],
+            [('tick', 0), ('schema_version', SCHEMA_VERSION)],
             self.mdb.all('select name, value from properties')
         )
 
+    def test_migrate_baseline_database(self):
+        # given a database written before the schema version was kept
+        instance_id = self.multiverse.instance_id + '/baseline'
+        os.mkdir(instance_id)
+        conn = sqlite3.connect(f'{instance_id}/multiverse.db')
+        conn.executescript('''
+            create table players (id text primary key);
+            create table properties (name text primary key, value blob);
+            create table universes (id integer primary key, parent_id integer);
+            create table characters (id integer primary key, parent_id integer, universe_id integer, player_id text);
+            create table actions (
+                tick integer not null,
+                subtick integer not null,
+                payload_json text not null,
+                character_id integer not null,
+                universe_id integer,
+
+                primary key (tick, subtick)
+            );
+            insert into properties values ('tick', 2);
+            insert into players values ('root'), ('player1');
+            insert into universes values (1, null), (2, 1);
+            insert into characters values (0, null, null, 'root'), (1, null, 1, 'player1'), (2, 1, 2, null);
+        ''')
+        conn.execute(
+            'insert into actions values (?, ?, ?, ?, ?)',
+            (1, 0, json.dumps({'kind': 'CreateUniverse', 'parent_id': 1}), ROOT_CHARACTER_ID, None)
+        )
+        conn.commit()
+        conn.close()
+        # when
+        with Multiverse(instance_id, action_encoding='binary') as multiverse:
+            multiverse.record_action(0, ROOT_CHARACTER_ID, CreatePlayer(player_id='player2'))
+            multiverse.apply(CreatePlayer(player_id='player2'), ROOT_CHARACTER_ID)
+            multiverse.commit()
+            # then
+            self.assertEqual([1], multiverse.universe_lineage.ancestors(2))
+            self.assertEqual([1], multiverse.character_lineage.ancestors(2))
+            self.assertEqual(
+                [
+                    (1, 0, ROOT_CHARACTER_ID, CreateUniverse(parent_id=1)),
+                    (2, 0, ROOT_CHARACTER_ID, CreatePlayer(player_id='player2'))
+                ],
+                list(multiverse.logged_actions(0, 3))
+            )
+        mdb = Conn(f'{instance_id}/multiverse.db')
+        self.assertEqual(SCHEMA_VERSION, mdb.one("select value from properties where name = 'schema_version'")[0])
+        self.assertEqual(1, mdb.count("sqlite_master where name = 'actions_character_id_idx'"))
+        # when the database is newer than this version
+        mdb.connection.execute("update properties set value = ? where name = 'schema_version'", (SCHEMA_VERSION + 1,))
+        mdb.connection.commit()
+        mdb.close()
+        # then
+        with self.assertRaisesRegex(Exception, 'newer'):
+            Multiverse(instance_id).__enter__()
+
     def test_create_player(self):
         # expect
         self.assertEqual(
@@ -132,6 +189,71 @@ class TestMultiverse(unittest.TestCase):
             self.udb(1).all('select name, description from locations')
         )
 
+    def test_fork_universe(self):
+        # given
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(
+            CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.apply(
+            CreateLocation(name='Beijing', universe_id=1, description='The capital of China'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.apply(
+            ConnectLocations(from_name='Strezhevoy', to_name='Beijing', universe_id=1, travel_time=3510),
+            ROOT_CHARACTER_ID
+        )
+        # when
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # then child universe gets a copy of the parent's state
+        self.assertEqual(
+            [(1, None), (2, 1)],
+            self.mdb.all('select id, parent_id from universes')
+        )
+        self.assertEqual(
+            [('Strezhevoy', 'The best town in the world'), ('Beijing', 'The capital of China')],
+            self.udb(2).all('select name, description from locations')
+        )
+        self.assertEqual(
+            [('Strezhevoy', 'Beijing', 3510, 0), ('Beijing', 'Strezhevoy', 3510, 0)],
+            self.udb(2).all('select from_name, to_name, travel_time, ordinal from directions')
+        )
+        # when the child diverges
+        self.multiverse.apply(
+            CreateLocation(name='London', universe_id=2, description='The capital of the UK'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.apply(
+            ConnectLocations(from_name='Strezhevoy', to_name='London', universe_id=2, travel_time=6000),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.commit()
+        # then the parent is not affected
+        self.assertEqual(
+            [('Strezhevoy', 'Beijing', 3510, 0), ('Beijing', 'Strezhevoy', 3510, 0)],
+            self.udb(1).all('select from_name, to_name, travel_time, ordinal from directions')
+        )
+        self.assertEqual(
+            [
+                ('Strezhevoy', 'Beijing', 3510, 0),
+                ('Beijing', 'Strezhevoy', 3510, 0),
+                ('Strezhevoy', 'London', 6000, 1),
+                ('London', 'Strezhevoy', 6000, 0)
+            ],
+            self.udb(2).all('select from_name, to_name, travel_time, ordinal from directions')
+        )
+        # when forking from non-existent universe
+        self.multiverse.apply(CreateUniverse(parent_id=42), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # then no changes happen
+        self.assertEqual(
+            [(1, None), (2, 1)],
+            self.mdb.all('select id, parent_id from universes')
+        )
+        self.assertFalse(os.path.isfile(f'{self.multiverse.instance_id}/3.db'))
+
     def test_connect_locations(self):
         # given
         self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
@@ -232,6 +354,57 @@ class TestMultiverse(unittest.TestCase):
             self.udb(1).all('select from_name, to_name, travel_time, ordinal from directions')
         )
 
+    def test_apply_batch(self):
+        # when
+        errors = self.multiverse.apply_batch([
+            (CreateUniverse(), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Beijing', universe_id=1, description='The capital of China'), ROOT_CHARACTER_ID),
+            (CreateUniverse(), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Tomsk', universe_id=2, description='Not my favourite city'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='London', universe_id=1, description='The capital of the UK'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Beijing', universe_id=1, description='Duplicate'), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='Strezhevoy', to_name='Beijing', universe_id=1, travel_time=3510), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='Strezhevoy', to_name='London', universe_id=1, travel_time=6000), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='London', to_name='London', universe_id=1, travel_time=1), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='London', to_name='Beijing', universe_id=1, travel_time=999), 123),
+            (CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID),
+            (CreatePlayer(player_id='player2'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Kyiv', universe_id=42, description='No such universe'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Paris', universe_id=42, description='No such universe'), ROOT_CHARACTER_ID)
+        ])
+        self.multiverse.commit()
+        # then
+        self.assertEqual(
+            [False, False, False, False, False, False, True, False, False, True, True, False, False, True, True],
+            [error is not None for error in errors]
+        )
+        self.assertEqual(
+            [('root',), ('player1',), ('player2',)],
+            self.mdb.all('select id from players')
+        )
+        self.assertEqual(
+            [
+                ('Strezhevoy', 'The best town in the world'),
+                ('Beijing', 'The capital of China'),
+                ('London', 'The capital of the UK')
+            ],
+            self.udb(1).all('select name, description from locations')
+        )
+        self.assertEqual(
+            [('Tomsk', 'Not my favourite city')],
+            self.udb(2).all('select name, description from locations')
+        )
+        self.assertEqual(
+            [
+                ('Strezhevoy', 'Beijing', 3510, 0),
+                ('Beijing', 'Strezhevoy', 3510, 0),
+                ('Strezhevoy', 'London', 6000, 1),
+                ('London', 'Strezhevoy', 6000, 0)
+            ],
+            self.udb(1).all('select from_name, to_name, travel_time, ordinal from directions')
+        )
+
     def test_commit(self):
         # expect
         self.assertEqual(0, self.mdb.one("select value from properties where name='tick'")[0])
@@ -244,6 +417,187 @@ class TestMultiverse(unittest.TestCase):
         # then
         self.assertEqual(2, self.mdb.one("select value from properties where name='tick'")[0])
 
+    def test_parallel_apply_batch(self):
+        # given
+        actions = [(CreateUniverse(), ROOT_CHARACTER_ID) for _ in range(8)]
+        actions += [
+            (CreateLocation(name=f'Location {i}', universe_id=universe_id, description='Somewhere'), ROOT_CHARACTER_ID)
+            for i in range(20)
+            for universe_id in range(1, 10)
+        ]
+        actions.append((CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID))
+        actions += [
+            (
+                ConnectLocations(
+                    from_name=f'Location {i}',
+                    to_name=f'Location {(i * 7) % 20}',
+                    universe_id=universe_id,
+                    travel_time=i
+                ),
+                ROOT_CHARACTER_ID
+            )
+            for universe_id in range(1, 10)
+            for i in range(20)
+        ]
+        self.multiverse.__exit__()
+        instance_ids = [self.multiverse.instance_id, '.test-' + str(uuid4())]
+        errors = []
+        # when
+        for instance_id, workers in zip(instance_ids, [1, 4]):
+            with Multiverse(instance_id, workers=workers) as multiverse:
+                errors.append([type(error) for error in multiverse.apply_batch(actions)])
+                multiverse.commit()
+        self.multiverse = Multiverse(self.multiverse.instance_id).__enter__()
+        # then
+        self.assertEqual(errors[0], errors[1])
+        for name in ['multiverse.db'] + [f'{universe_id}.db' for universe_id in range(1, 9)]:
+            with open(f'{instance_ids[0]}/{name}', 'rb') as serial, open(f'{instance_ids[1]}/{name}', 'rb') as parallel:
+                self.assertEqual(serial.read(), parallel.read(), name)
+        shutil.rmtree(instance_ids[1])
+
+    def test_commit_flushes_only_dirty_universes(self):
+        # given
+        for _ in range(3):
+            self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # expect
+        self.assertEqual(3, self.multiverse.flushed_universe_count)
+        # when
+        self.multiverse.apply(
+            CreateLocation(name='Strezhevoy', universe_id=2, description='The best town in the world'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.commit()
+        # then
+        self.assertEqual(1, self.multiverse.flushed_universe_count)
+        self.assertEqual(
+            [('Strezhevoy', 'The best town in the world')],
+            self.udb(2).all('select name, description from locations')
+        )
+        # when nothing happens during the tick
+        self.multiverse.commit()
+        # then
+        self.assertEqual(0, self.multiverse.flushed_universe_count)
+
+    def test_universe_connections_are_bounded(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, max_open_universes=2)
+        self.multiverse.__enter__()
+        # when
+        for universe_id in range(1, 5):
+            self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            self.multiverse.apply(
+                CreateLocation(name=f'Location {universe_id}', universe_id=universe_id, description='Somewhere'),
+                ROOT_CHARACTER_ID
+            )
+        # then least recently used connections are committed and closed
+        self.assertEqual([3, 4], list(self.multiverse.universe_dbs))
+        self.assertEqual(
+            [('Location 1', 'Somewhere')],
+            self.udb(1).all('select name, description from locations')
+        )
+        # when
+        self.multiverse.commit()
+        self.assertEqual([('Location 2', 'Somewhere')], self.multiverse.locations(2))
+        # then
+        self.assertEqual([4, 2], list(self.multiverse.universe_dbs))
+        # when reopened
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, max_open_universes=2)
+        self.multiverse.__enter__()
+        # then no universe is opened until used
+        self.assertEqual([], list(self.multiverse.universe_dbs))
+        self.assertEqual([('Location 4', 'Somewhere')], self.multiverse.locations(4))
+        self.assertEqual([4], list(self.multiverse.universe_dbs))
+
+    def test_durability_profile(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, durability='wal')
+        self.multiverse.__enter__()
+        # when
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # then
+        for conn in [self.multiverse.mdb, self.multiverse.udb(1), self.multiverse.udb(2)]:
+            self.assertEqual(('wal',), conn.execute('pragma journal_mode').fetchone())
+            self.assertEqual((1,), conn.execute('pragma synchronous').fetchone())
+        # when unknown profile is requested
+        # then
+        with self.assertRaises(Exception):
+            Multiverse(self.multiverse.instance_id, durability='reckless')
+
+    def test_group_commit(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, commit_every_ticks=3)
+        self.multiverse.__enter__()
+        # when
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        self.multiverse.commit()
+        # then tick advances, but nothing is durable yet
+        self.assertEqual(2, self.multiverse.tick)
+        self.assertEqual(0, self.mdb.one("select value from properties where name='tick'")[0])
+        self.assertEqual([('root',)], self.mdb.all('select id from players'))
+        # when
+        self.multiverse.commit()
+        # then
+        self.assertEqual(3, self.multiverse.tick)
+        self.assertEqual(3, self.mdb.one("select value from properties where name='tick'")[0])
+        self.assertEqual([('root',), ('player1',)], self.mdb.all('select id from players'))
+        # when reopened
+        self.multiverse.commit()
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, commit_every_ticks=3)
+        self.multiverse.__enter__()
+        # then the ticks committed since the last flush are made durable on exit
+        self.assertEqual(4, self.multiverse.tick)
+
+    def test_reenter(self):
+        # given
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        self.multiverse.apply(
+            CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'),
+            ROOT_CHARACTER_ID
+        )
+        # when the same object leaves on an error with unflushed writes and is entered again
+        self.multiverse.__exit__(Exception, Exception('Interrupted'), None)
+        self.multiverse.__enter__()
+        self.multiverse.apply(
+            CreateLocation(name='Beijing', universe_id=1, description='The capital of China'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.commit()
+        # then
+        self.assertEqual([('Beijing', 'The capital of China')], self.multiverse.locations(1))
+        self.assertEqual(2, self.multiverse.tick)
+
+    def test_exit_flushes_group_commit(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, commit_every_ticks=10)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.apply(
+            CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.commit()
+        self.multiverse.commit()
+        # when
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, commit_every_ticks=10)
+        self.multiverse.__enter__()
+        # then
+        self.assertEqual(2, self.multiverse.tick)
+        self.assertEqual([('root',), ('player1',)], self.mdb.all('select id from players'))
+        self.assertEqual([('Strezhevoy', 'The best town in the world')], self.multiverse.locations(1))
+
     def test_create_character(self):
         # given
         self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
@@ -317,6 +671,45 @@ class TestMultiverse(unittest.TestCase):
             self.mdb.all('select id, player_id, universe_id, parent_id from characters')
         )
 
+    def test_reject_invalid_actions(self):
+        # given
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id)
+        self.multiverse.__enter__()
+        # when
+        errors = [
+            self.multiverse.apply(action, ROOT_CHARACTER_ID)
+            for action in [
+                CreatePlayer(player_id='player1'),
+                CreateUniverse(parent_id=42),
+                CreateLocation(name='Kyiv', universe_id=42, description='No such universe'),
+                ConnectLocations(from_name='Kyiv', to_name='Kyiv', universe_id=1, travel_time=1),
+                CreateCharacter(parent_id=3333),
+                CreateCharacter(player_id='i_dont_exist')
+            ]
+        ]
+        errors.append(self.multiverse.apply(CreatePlayer(player_id='player2'), 3333))
+        # then rejected without raising, by the ids loaded when the instance was opened
+        self.assertEqual(
+            [
+                ('already_exists', 'Player already exists: player1'),
+                ('not_found', 'No such universe: 42'),
+                ('not_found', 'No such universe: 42'),
+                ('invalid_argument', 'Cannot connect location to itself'),
+                ('not_found', 'No such character: 3333'),
+                ('not_found', 'No such player: i_dont_exist'),
+                ('not_permitted', 'Action permitted only for root character')
+            ],
+            [(error.reason, error.message) for error in errors]
+        )
+        self.assertEqual(7, self.multiverse.rejected_action_count)
+        # and the caches follow the applied actions
+        self.assertIsNone(self.multiverse.apply(CreateCharacter(player_id='player1', universe_id=1), ROOT_CHARACTER_ID))
+        self.assertIsNone(self.multiverse.apply(CreateCharacter(parent_id=1), ROOT_CHARACTER_ID))
+
     def test_record_action(self):
         # given
         self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
@@ -402,6 +795,300 @@ class TestMultiverse(unittest.TestCase):
             self.fetch_actions()
         )
 
+    def test_actions_for_character(self):
+        # given
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateCharacter(player_id='player1', universe_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        for tick in range(1, 5):
+            self.multiverse.record_action(
+                0,
+                ROOT_CHARACTER_ID,
+                CreateLocation(name=f'Location {tick}', universe_id=1, description='Somewhere')
+            )
+            self.multiverse.record_action(1, 1, CreatePlayer(player_id=f'player{tick}'))
+            self.multiverse.commit()
+        # expect
+        self.assertEqual(
+            [(2, 1, CreatePlayer(player_id='player2')), (3, 1, CreatePlayer(player_id='player3'))],
+            list(self.multiverse.actions_for_character(1, 2, 4))
+        )
+        self.assertEqual(
+            [
+                (3, 0, CreateLocation(name='Location 3', universe_id=1, description='Somewhere')),
+                (4, 0, CreateLocation(name='Location 4', universe_id=1, description='Somewhere'))
+            ],
+            list(self.multiverse.actions_for_character(ROOT_CHARACTER_ID, 3))
+        )
+        # and the scan is served by the index
+        self.assertIn(
+            'actions_character_id_idx',
+            str(self.mdb.all('explain query plan select * from actions where character_id = 1 and tick >= 2'))
+        )
+
+    def test_compact(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, archive_horizon=3, archive_every_ticks=4)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # when
+        for tick in range(1, 10):
+            self.multiverse.record_action(
+                0,
+                ROOT_CHARACTER_ID,
+                CreateLocation(name=f'Location {tick}', universe_id=1, description='Somewhere')
+            )
+            self.multiverse.commit()
+        # then old ticks are moved to the archive
+        self.assertEqual(4, self.multiverse.archive.archived_until())
+        self.assertEqual([(5,), (6,), (7,), (8,), (9,)], self.mdb.all('select tick from actions'))
+        # and scans read the archive and the actions table alike
+        self.assertEqual(
+            [
+                (tick, 0, CreateLocation(name=f'Location {tick}', universe_id=1, description='Somewhere'))
+                for tick in range(3, 10)
+            ],
+            list(self.multiverse.actions_for_character(ROOT_CHARACTER_ID, 3))
+        )
+        self.assertEqual(9, self.multiverse.replay(1, 10, universe_id=1).actions)
+        self.multiverse.commit()
+        self.assertEqual(
+            [(f'Location {tick}', 'Somewhere') for tick in range(1, 10)],
+            self.multiverse.locations(1)
+        )
+
+    def test_replay(self):
+        # given
+        actions = [
+            [(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID), (CreateUniverse(), ROOT_CHARACTER_ID)],
+            [],
+            [
+                (CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'), 0),
+                (CreateLocation(name='Beijing', universe_id=1, description='The capital of China'), 0),
+                (CreateLocation(name='Beijing', universe_id=1, description='Duplicate'), 0)
+            ],
+            [
+                (ConnectLocations(from_name='Strezhevoy', to_name='Beijing', universe_id=1, travel_time=3510), 0),
+                (CreateCharacter(player_id='player1', universe_id=1), ROOT_CHARACTER_ID),
+                (CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+            ],
+            [(CreateLocation(name='London', universe_id=2, description='The capital of the UK'), 0)],
+            []
+        ]
+        for tick_actions in actions:
+            for subtick, (action, character_id) in enumerate(tick_actions):
+                self.multiverse.record_action(subtick, character_id, action)
+                self.multiverse.apply(action, character_id)
+            self.multiverse.commit()
+        # when
+        replica = Multiverse(self.multiverse.instance_id + '-replica')
+        replica.__enter__()
+        try:
+            stats = replica.replay(0, 6, source=f'{self.multiverse.instance_id}/multiverse.db')
+            # then
+            self.assertEqual((6, 9), (stats.ticks, stats.actions))
+            self.assertEqual(6, replica.tick)
+            for table in ['players', 'universes', 'characters', 'actions', 'properties']:
+                self.assertEqual(
+                    self.mdb.all(f'select * from {table}'),
+                    replica.mdb.execute(f'select * from {table}').fetchall()
+                )
+            for universe_id in [1, 2]:
+                self.assertEqual(self.multiverse.locations(universe_id), replica.locations(universe_id))
+                self.assertEqual(self.multiverse.directions(universe_id), replica.directions(universe_id))
+        finally:
+            replica.__exit__()
+            shutil.rmtree(replica.instance_id)
+
+    def test_record_action_binary(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, action_encoding='binary')
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        actions = [
+            CreateLocation(name='Tbilisi', universe_id=1, description='The capital of Georgia'),
+            CreateLocation(name='London', universe_id=1, description='The capital of the UK'),
+            ConnectLocations(from_name='London', to_name='Tbilisi', universe_id=1, travel_time=33),
+            CreateCharacter(player_id='root', universe_id=1)
+        ]
+        # when
+        for subtick, action in enumerate(actions):
+            self.multiverse.record_action(subtick, ROOT_CHARACTER_ID, action)
+        self.multiverse.commit()
+        # then
+        self.assertEqual(
+            [(None, 1), (None, 1), (None, 1), (None, 1)],
+            self.mdb.all('select payload_json, universe_id from actions')
+        )
+        self.assertEqual(
+            [(1, subtick, ROOT_CHARACTER_ID, action) for subtick, action in enumerate(actions)],
+            list(self.multiverse.logged_actions(0, 2))
+        )
+
+    def test_replay_universe_from_own_log(self):
+        # given
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        for subtick, action in enumerate([
+            CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'),
+            CreateLocation(name='Beijing', universe_id=1, description='The capital of China'),
+            ConnectLocations(from_name='Strezhevoy', to_name='Beijing', universe_id=1, travel_time=3510)
+        ]):
+            self.multiverse.record_action(subtick, ROOT_CHARACTER_ID, action)
+        self.multiverse.commit()
+        # when the universe state is lost and replayed
+        stats = self.multiverse.replay(0, 2, universe_id=1)
+        self.multiverse.commit()
+        # then
+        self.assertEqual(3, stats.actions)
+        self.assertEqual(
+            [('Beijing', 'Strezhevoy', 3510, 0), ('Strezhevoy', 'Beijing', 3510, 0)],
+            self.multiverse.directions(1)
+        )
+        self.assertEqual(3, self.multiverse.tick)
+
+    def test_checkpoints(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(
+            self.multiverse.instance_id,
+            checkpoint_every_ticks=2,
+            checkpoint_keep_recent=2,
+            checkpoint_sparse_ticks=8
+        )
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        # when
+        for tick in range(12):
+            self.record_and_apply(
+                CreateLocation(name=f'Location {tick}', universe_id=1, description='Somewhere')
+            )
+            self.multiverse.commit()
+        # then dense recent checkpoints are kept, and the oldest of the ages [0, 8) and [8, 16)
+        self.assertEqual(
+            [(0, 2), (0, 6), (0, 10), (0, 12), (1, 2), (1, 6), (1, 10), (1, 12), (2, 2)],
+            self.mdb.all('select universe_id, tick from checkpoints order by universe_id, tick')
+        )
+        self.assertEqual(
+            ['10', '12', '2', '6'],
+            sorted(os.listdir(f'{self.multiverse.instance_id}/checkpoints'))
+        )
+        self.assertEqual(
+            ['1.db', '2.db', 'multiverse.db'],
+            sorted(os.listdir(f'{self.multiverse.instance_id}/checkpoints/2'))
+        )
+        checkpoint = Conn(f'{self.multiverse.instance_id}/checkpoints/6/1.db')
+        self.assertEqual(
+            [(f'Location {tick}', 'Somewhere') for tick in range(6)],
+            checkpoint.all('select * from locations')
+        )
+        checkpoint.close()
+        # and the snapshots of the multiverse database leave the actions log out
+        checkpoint = Conn(f'{self.multiverse.instance_id}/checkpoints/12/multiverse.db')
+        self.assertEqual(0, checkpoint.count('actions'))
+        self.assertEqual(2, checkpoint.count('universes'))
+        checkpoint.close()
+
+    def test_checkpoint_count_is_logarithmic(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(
+            self.multiverse.instance_id,
+            checkpoint_every_ticks=1,
+            checkpoint_keep_recent=2,
+            checkpoint_sparse_ticks=1
+        )
+        self.multiverse.__enter__()
+        # when
+        for _ in range(300):
+            self.multiverse.commit()
+        # then one older checkpoint is kept per age range [0, 1), [1, 2), [2, 4), ..., [256, 512)
+        self.assertLessEqual(self.mdb.count('checkpoints'), 2 + 10)
+
+    def test_fork_at(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, checkpoint_every_ticks=4)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        for tick in range(10):
+            self.record_and_apply(
+                CreateLocation(name=f'Location {tick}', universe_id=1, description='Somewhere')
+            )
+            self.multiverse.commit()
+        # when
+        universe_id = self.multiverse.fork_at(1, 6)
+        self.multiverse.commit()
+        # then
+        self.assertEqual(2, universe_id)
+        self.assertEqual([(1, None), (2, 1)], self.mdb.all('select id, parent_id from universes'))
+        self.assertEqual(
+            [(f'Location {tick}', 'Somewhere') for tick in range(6)],
+            self.udb(2).all('select * from locations')
+        )
+        # when no checkpoint is old enough
+        # then
+        with self.assertRaises(Exception):
+            self.multiverse.fork_at(1, 3)
+
+    def test_restore(self):
+        # given
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, checkpoint_every_ticks=3)
+        self.multiverse.__enter__()
+        self.record_and_apply(CreateUniverse())
+        self.multiverse.commit()
+        for tick in range(1, 8):
+            self.record_and_apply(
+                CreateLocation(name=f'Location {tick}', universe_id=1, description='Somewhere')
+            )
+            if tick == 4:
+                self.record_and_apply(CreateUniverse(parent_id=1))
+            if tick > 4:
+                self.record_and_apply(
+                    CreateLocation(name=f'Location {tick}', universe_id=2, description='Elsewhere')
+                )
+            self.multiverse.commit()
+        # when
+        self.multiverse.restore(7, self.multiverse.instance_id + '-restored')
+        # then
+        restored = Multiverse(self.multiverse.instance_id + '-restored')
+        restored.__enter__()
+        try:
+            self.assertEqual(7, restored.tick)
+            self.assertEqual([(1, None), (2, 1)], restored.mdb.execute('select * from universes').fetchall())
+            self.assertEqual(
+                [(f'Location {tick}', 'Somewhere') for tick in range(1, 7)],
+                restored.locations(1)
+            )
+            self.assertEqual(
+                [(f'Location {tick}', 'Somewhere') for tick in range(1, 5)]
+                + [(f'Location {tick}', 'Elsewhere') for tick in range(5, 7)],
+                restored.locations(2)
+            )
+            self.assertEqual(
+                self.mdb.all('select * from actions where tick < 7'),
+                restored.mdb.execute('select * from actions').fetchall()
+            )
+            self.assertEqual([], restored.mdb.execute('select * from checkpoints').fetchall())
+        finally:
+            restored.__exit__()
+            shutil.rmtree(restored.instance_id)
+
+    def record_and_apply(self, action: Any) -> None:
+        subtick = self.multiverse.mdb.execute(
+            'select count(*) from actions where tick = ?',
+            (self.multiverse.tick,)
+        ).fetchone()[0]
+        self.multiverse.record_action(subtick, ROOT_CHARACTER_ID, action)
+        self.multiverse.apply(action, ROOT_CHARACTER_ID)
+
     def fetch_actions(self) -> list[Any]:
         rows: list[Any] = self.mdb.all(
             '''
@@ -0,0 +1,168 @@
+from __future__ import annotations
+
+import json
+import shutil
+import unittest
+from unittest.mock import patch
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations, CreateCharacter, LoadWorld
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from perception import DIGEST_SIZE, Perception, PerceptionDiff, diff, digest
+from storage import TEMPORAL_STORAGE
+from testutil import Conn
+
+
+class TestPerception(unittest.TestCase):
+    multiverse: Multiverse
+    mdb: Conn
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()), perception_log=True)
+        self.multiverse.__enter__()
+        self.mdb = Conn(f'{self.multiverse.instance_id}/multiverse.db')
+        for action in [
+            CreateUniverse(),
+            CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'),
+            CreatePlayer(player_id='player1'),
+            CreateCharacter(player_id='player1', universe_id=1)
+        ]:
+            self.multiverse.apply(action, ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # the twin of character 1
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.apply(CreateCharacter(universe_id=2, parent_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        self.mdb.close()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_digest_log(self):
+        # expect twins perceiving the same log the same digest
+        self.assertEqual([(1, 0), (2, 1)], self.mdb.all('select character_id, tick from perceptions'))
+        self.assertEqual(1, self.mdb.one('select count(distinct digest) from perceptions')[0])
+        # when
+        self.multiverse.apply(
+            CreateLocation(name='Beijing', universe_id=2, description='The capital of China'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.commit()
+        self.multiverse.commit()
+        # then only the changes are logged
+        self.assertEqual(
+            [(1, 0), (2, 1), (2, 2)],
+            self.mdb.all('select character_id, tick from perceptions order by character_id, tick')
+        )
+        self.assertEqual(2, self.mdb.one('select count(distinct digest) from perceptions')[0])
+        # when reopened
+        self.multiverse.__exit__()
+        self.multiverse.__enter__()
+        self.multiverse.commit()
+        # then
+        self.assertEqual(3, self.mdb.count('perceptions'))
+
+    def test_divergence(self):
+        # expect
+        self.assertIsNone(self.multiverse.divergence(2, 1))
+        # when
+        self.multiverse.apply(
+            CreateLocation(name='Beijing', universe_id=2, description='The capital of China'),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.apply(
+            ConnectLocations(from_name='Strezhevoy', to_name='Beijing', universe_id=2, travel_time=3510),
+            ROOT_CHARACTER_ID
+        )
+        self.multiverse.commit()
+        # then
+        self.assertIsNone(self.multiverse.divergence(2, 1))
+        self.assertEqual(
+            PerceptionDiff(
+                {
+                    'locations': [('Beijing', 'The capital of China')],
+                    'directions': [('Beijing', 'Strezhevoy', 3510), ('Strezhevoy', 'Beijing', 3510)]
+                },
+                {}
+            ),
+            self.multiverse.divergence(2, 2)
+        )
+        with self.assertRaises(Exception):
+            self.multiverse.divergence(1, 2)
+        # when the universe changes again
+        self.multiverse.apply(CreateLocation(name='Tomsk', universe_id=2, description='City'), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # then the perception logged at tick 2 cannot be rebuilt without temporal storage
+        with self.assertRaisesRegex(Exception, 'no longer available'):
+            self.multiverse.divergence(2, 2)
+
+    def test_divergence_in_the_past(self):
+        # given
+        with Multiverse(self.multiverse.instance_id + '/temporal', storage=TEMPORAL_STORAGE, perception_log=True) as m:
+            m.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            m.apply(CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID)
+            m.apply(CreateCharacter(player_id='player1', universe_id=1), ROOT_CHARACTER_ID)
+            m.commit()
+            m.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+            m.apply(CreateCharacter(universe_id=2, parent_id=1), ROOT_CHARACTER_ID)
+            m.apply(CreateLocation(name='Beijing', universe_id=2, description='Capital'), ROOT_CHARACTER_ID)
+            m.commit()
+            # when
+            m.apply(CreateLocation(name='Tomsk', universe_id=2, description='City'), ROOT_CHARACTER_ID)
+            m.commit()
+            # then the past perceptions are rebuilt from the views of the universes
+            self.assertEqual(PerceptionDiff({'locations': [('Beijing', 'Capital')]}, {}), m.divergence(2, 1))
+            self.assertEqual(
+                PerceptionDiff({'locations': [('Beijing', 'Capital'), ('Tomsk', 'City')]}, {}),
+                m.divergence(2, 2)
+            )
+
+    def test_large_world(self):
+        # given
+        source = f'{self.multiverse.instance_id}/world.jsonl'
+        with open(source, 'w', encoding='utf-8') as f:
+            for i in range(20000):
+                f.write(json.dumps({'name': f'Location {i}', 'description': 'Somewhere'}) + '\n')
+                if i > 0:
+                    connection = {'from_name': f'Location {i - 1}', 'to_name': f'Location {i}', 'travel_time': 1}
+                    f.write(json.dumps(connection) + '\n')
+        self.assertIsNone(self.multiverse.apply(LoadWorld(universe_id=1, source=source), ROOT_CHARACTER_ID))
+        self.multiverse.commit()
+        # when
+        with patch.object(self.multiverse.storage, 'locations', side_effect=AssertionError('read again')), \
+                patch.object(self.multiverse.storage, 'directions', side_effect=AssertionError('read again')):
+            for tick in range(10):
+                self.multiverse.apply(
+                    CreateLocation(name=f'New {tick}', universe_id=1, description='New'),
+                    ROOT_CHARACTER_ID
+                )
+                self.multiverse.apply(
+                    ConnectLocations(from_name='Location 0', to_name=f'New {tick}', universe_id=1, travel_time=1),
+                    ROOT_CHARACTER_ID
+                )
+                self.multiverse.commit()
+        # then every change is logged as a digest, folded in without reading the universe again
+        self.assertEqual(12, self.mdb.one('select count(*) from perceptions where character_id = 1')[0])
+        self.assertEqual(DIGEST_SIZE, self.mdb.one('select max(length(digest)) from perceptions')[0])
+        incremental = self.multiverse.senses.perceive(1)
+        self.multiverse.senses.invalidate(1)
+        self.assertEqual(self.multiverse.senses.perceive(1), incremental)
+
+    def test_digest_is_order_independent(self):
+        # given
+        perception = Perception([('Strezhevoy', 'Town'), ('Tomsk', 'City')], [('Strezhevoy', 'Tomsk', 600)])
+        # expect
+        self.assertEqual(
+            digest(perception),
+            digest(Perception(perception.locations[::-1], perception.directions))
+        )
+        self.assertNotEqual(digest(perception), digest(Perception(perception.locations[:1], perception.directions)))
+        self.assertEqual(
+            PerceptionDiff({}, {'locations': [('Tomsk', 'City')]}),
+            diff(Perception(perception.locations[:1], perception.directions), perception)
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import shutil
+import unittest
+from dataclasses import dataclass
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse, CreateCharacter, CreateLocation
+from handlers import ActionHandler, register_action, unregister_action
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from replay import ReplayDriver
+
+
+@dataclass
+class Explore:
+    name: str
+    universe_id: int
+
+
+def explore(multiverse: Multiverse, action: Explore) -> None:
+    multiverse.storage.create_location(action.universe_id, action.name, 'Explored')
+
+
+class TestReplayDriver(unittest.TestCase):
+    multiverse: Multiverse
+    driver: ReplayDriver
+
+    @classmethod
+    def setUpClass(cls):
+        register_action(Explore, 101, ActionHandler(explore, root_only=False, universe_level=True))
+
+    @classmethod
+    def tearDownClass(cls):
+        unregister_action(Explore)
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()))
+        self.multiverse.__enter__()
+        self.tick([
+            (CreateUniverse(), ROOT_CHARACTER_ID),
+            (CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID),
+            (CreateCharacter(player_id='player1', universe_id=1), ROOT_CHARACTER_ID)
+        ])
+        # character 2 replays character 1, and so does character 3 replaying character 2
+        self.tick([
+            (CreateUniverse(parent_id=1), ROOT_CHARACTER_ID),
+            (CreateUniverse(parent_id=2), ROOT_CHARACTER_ID),
+            (CreateCharacter(universe_id=2, parent_id=1), ROOT_CHARACTER_ID),
+            (CreateCharacter(universe_id=3, parent_id=2), ROOT_CHARACTER_ID)
+        ])
+        self.driver = ReplayDriver(self.multiverse)
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_replay_twin(self):
+        # when
+        self.tick([(Explore(name='Strezhevoy', universe_id=1), 1), (Explore(name='Tomsk', universe_id=1), 1)])
+        # then
+        for universe_id in (1, 2, 3):
+            self.assertEqual(['Strezhevoy', 'Tomsk'], [name for name, _ in self.multiverse.locations(universe_id)])
+        self.assertEqual(
+            [
+                (0, 1, Explore(name='Strezhevoy', universe_id=1)),
+                (1, 1, Explore(name='Tomsk', universe_id=1)),
+                (2, 2, Explore(name='Strezhevoy', universe_id=2)),
+                (3, 2, Explore(name='Tomsk', universe_id=2)),
+                (4, 3, Explore(name='Strezhevoy', universe_id=3)),
+                (5, 3, Explore(name='Tomsk', universe_id=3))
+            ],
+            [(subtick, character_id, action) for _, subtick, character_id, action in self.logged_actions(2)]
+        )
+        # and both replaying characters share the cursor of their ancestor twin
+        self.assertEqual([(1, 0)], list(self.driver.cursors))
+
+    def test_follow_with_lag(self):
+        # given
+        self.driver.follow(2, 1)
+        self.tick([(Explore(name='Strezhevoy', universe_id=1), 1)])
+        # when
+        self.tick([(Explore(name='Tomsk', universe_id=1), 1)])
+        # then the replaying characters are one tick behind
+        self.assertEqual(['Strezhevoy', 'Tomsk'], [name for name, _ in self.multiverse.locations(1)])
+        for universe_id in (2, 3):
+            self.assertEqual(['Strezhevoy'], [name for name, _ in self.multiverse.locations(universe_id)])
+        self.assertEqual([(1, 1)], list(self.driver.cursors))
+        # when
+        self.tick([])
+        # then
+        self.assertEqual(['Strezhevoy', 'Tomsk'], [name for name, _ in self.multiverse.locations(3)])
+
+    def test_root_only_actions_are_not_replayed(self):
+        # given the built-in universe actions, which only the root character may take
+        action = CreateLocation(name='Strezhevoy', universe_id=1, description='Town')
+        self.multiverse.record_action(0, 1, action)
+        # when
+        batch = self.driver.inject(1)
+        # then the replaying characters would be refused, so nothing is replayed or logged for them
+        self.assertEqual([], batch)
+        self.assertEqual('not_permitted', self.multiverse.apply_batch([(action, 1)])[0].reason)
+        self.multiverse.commit()
+        self.assertEqual([(0, 1, action)], [row[1:] for row in self.logged_actions(2)])
+        for universe_id in (1, 2, 3):
+            self.assertEqual([], self.multiverse.locations(universe_id))
+
+    def logged_actions(self, tick: int) -> list[tuple[int, int, int, dataclass]]:
+        return list(self.multiverse.logged_actions(tick, tick + 1))
+
+    def tick(self, actions: list[tuple[dataclass, int]]) -> None:
+        # the setup is not logged, as actions referring to universes created in the same tick cannot be
+        if hasattr(self, 'driver'):
+            for subtick, (action, character_id) in enumerate(actions):
+                self.multiverse.record_action(subtick, character_id, action)
+            actions = actions + self.driver.inject(len(actions))
+        self.assertEqual([None] * len(actions), self.multiverse.apply_batch(actions))
+        self.multiverse.commit()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import shutil
+import unittest
+from uuid import uuid4
+
+from actions import CreateUniverse, CreateLocation, ConnectLocations
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from routing import ROUTE_TREES_PER_UNIVERSE, Route
+from storage import DELTA_STORAGE
+
+
+class TestRouting(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()), storage=DELTA_STORAGE)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        for name in ['A', 'B', 'C', 'D']:
+            self.multiverse.apply(CreateLocation(name=name, universe_id=1, description=f'Station {name}'), ROOT_CHARACTER_ID)
+        self.connect_locations(1, 'A', 'B', 60)
+        self.connect_locations(1, 'B', 'C', 120)
+        self.multiverse.commit()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_route(self):
+        # expect
+        self.assertEqual(Route(['A', 'B', 'C'], 180), self.multiverse.route(1, 'A', 'C'))
+        self.assertEqual(Route(['C', 'B', 'A'], 180), self.multiverse.route(1, 'C', 'A'))
+        self.assertEqual(Route(['B'], 0), self.multiverse.route(1, 'B', 'B'))
+        self.assertIsNone(self.multiverse.route(1, 'A', 'D'))
+        with self.assertRaises(Exception):
+            self.multiverse.route(1, 'A', 'Atlantis')
+
+    def test_new_directions_invalidate_only_their_universe(self):
+        # given
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.assertEqual(Route(['A', 'B', 'C'], 180), self.multiverse.route(1, 'A', 'C'))
+        self.assertEqual(Route(['A', 'B', 'C'], 180), self.multiverse.route(2, 'A', 'C'))
+        # when
+        self.connect_locations(2, 'A', 'D', 30)
+        self.connect_locations(2, 'D', 'C', 30)
+        # then
+        self.assertEqual(Route(['A', 'D', 'C'], 60), self.multiverse.route(2, 'A', 'C'))
+        self.assertIn(1, self.multiverse.router.trees)
+        self.assertEqual(Route(['A', 'B', 'C'], 180), self.multiverse.route(1, 'A', 'C'))
+
+    def test_new_location(self):
+        # given
+        self.assertIsNone(self.multiverse.route(1, 'A', 'D'))
+        # when
+        self.multiverse.apply(CreateLocation(name='E', universe_id=1, description='Station E'), ROOT_CHARACTER_ID)
+        self.multiverse.apply_batch([
+            (ConnectLocations(from_name='C', to_name='D', universe_id=1, travel_time=10), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='D', to_name='E', universe_id=1, travel_time=10), ROOT_CHARACTER_ID)
+        ])
+        # then
+        self.assertEqual(Route(['A', 'B', 'C', 'D', 'E'], 200), self.multiverse.route(1, 'A', 'E'))
+
+    def test_caches_are_bounded(self):
+        # given
+        for i in range(ROUTE_TREES_PER_UNIVERSE):
+            self.multiverse.apply(CreateLocation(name=f'S{i}', universe_id=1, description='Stop'), ROOT_CHARACTER_ID)
+            self.connect_locations(1, 'A', f'S{i}', 1)
+        self.multiverse.route(1, 'A', 'C')
+        # when
+        for i in range(ROUTE_TREES_PER_UNIVERSE):
+            self.multiverse.route(1, f'S{i}', 'C')
+        # then the least recently used tree is dropped
+        self.assertEqual(ROUTE_TREES_PER_UNIVERSE, len(self.multiverse.router.trees[1]))
+        self.assertNotIn('A', self.multiverse.router.trees[1])
+        # when
+        self.multiverse.universe_db_close(1)
+        # then
+        self.assertNotIn(1, self.multiverse.router.trees)
+        self.assertNotIn(1, self.multiverse.router.adjacency)
+        self.assertEqual(Route(['A', 'B', 'C'], 180), self.multiverse.route(1, 'A', 'C'))
+
+    def connect_locations(self, universe_id: int, from_name: str, to_name: str, travel_time: int) -> None:
+        self.multiverse.apply(
+            ConnectLocations(from_name=from_name, to_name=to_name, universe_id=universe_id, travel_time=travel_time),
+            ROOT_CHARACTER_ID
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import shutil
+import unittest
+from dataclasses import dataclass
+from unittest.mock import patch
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateCharacter, CreateUniverse
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from server import SHED_ON_OVERFLOW, TickServer
+from testutil import Conn
+
+
+@dataclass
+class Unregistered:
+    name: str
+
+
+class TestTickServer(unittest.IsolatedAsyncioTestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()))
+
+    def tearDown(self):
+        shutil.rmtree(self.multiverse.instance_id)
+
+    async def test_sessions(self):
+        # given
+        async with TickServer(self.multiverse, tick_seconds=0.01) as server:
+            await server.submit(ROOT_CHARACTER_ID, CreateUniverse())
+            # when
+            outcomes = await asyncio.gather(*[
+                server.submit(ROOT_CHARACTER_ID, CreatePlayer(player_id=f'player{i}')) for i in range(100)
+            ], server.submit(42, CreatePlayer(player_id='intruder')))
+        # then
+        self.assertEqual([None] * 100, list(outcomes[:100]))
+        self.assertEqual('not_found', outcomes[100].reason)
+        mdb = Conn(f'{self.multiverse.instance_id}/multiverse.db')
+        self.assertEqual(101, mdb.count('players'))
+        self.assertEqual(101, mdb.count('actions'))
+        mdb.close()
+
+    async def test_tick_closes_at_size_threshold(self):
+        # given
+        async with TickServer(self.multiverse, tick_seconds=60, max_tick_actions=3) as server:
+            # when
+            outcomes = await asyncio.gather(*[
+                server.submit(ROOT_CHARACTER_ID, CreatePlayer(player_id=f'player{i}')) for i in range(6)
+            ])
+            # then the full ticks are closed without waiting for the cadence
+            self.assertEqual([None] * 6, outcomes)
+        mdb = Conn(f'{self.multiverse.instance_id}/multiverse.db')
+        self.assertEqual(
+            [(0, 0), (0, 1), (0, 2), (1, 0), (1, 1), (1, 2)],
+            mdb.all('select tick, subtick from actions order by tick, subtick')
+        )
+        mdb.close()
+
+    async def test_subticks_are_deterministic(self):
+        # given
+        async with TickServer(self.multiverse, tick_seconds=0.01) as server:
+            await server.submit(ROOT_CHARACTER_ID, CreatePlayer(player_id='player1'))
+            await server.submit(ROOT_CHARACTER_ID, CreateCharacter(player_id='player1'))
+            await server.submit(ROOT_CHARACTER_ID, CreateCharacter(player_id='player1'))
+            server.tick_seconds = 60
+            server.max_tick_actions = 6
+            # when characters 2, 1 and root queue actions in this order
+            outcomes = await asyncio.gather(*[
+                server.submit(character_id, CreatePlayer(player_id=f'player{character_id}-{i}'))
+                for character_id in (2, 1, ROOT_CHARACTER_ID)
+                for i in range(2)
+            ])
+        # then they take turns by character id
+        self.assertEqual(6, len(outcomes))
+        mdb = Conn(f'{self.multiverse.instance_id}/multiverse.db')
+        self.assertEqual(
+            [(0, 0), (1, 1), (2, 2), (0, 3), (1, 4), (2, 5)],
+            mdb.all('''
+                select character_id, subtick from actions
+                where tick = (select max(tick) from actions) order by subtick
+            ''')
+        )
+        mdb.close()
+
+    async def test_shed_on_overflow(self):
+        # given
+        server = TickServer(self.multiverse, tick_seconds=60, queue_size=2, overflow=SHED_ON_OVERFLOW)
+        async with server:
+            submissions = [
+                asyncio.create_task(server.submit(ROOT_CHARACTER_ID, CreatePlayer(player_id=f'player{i}')))
+                for i in range(3)
+            ]
+            # when
+            shed = await submissions[2]
+            # then
+            self.assertEqual('overloaded', shed.reason)
+            self.assertFalse(submissions[0].done())
+            server.full.set()
+            self.assertEqual([None, None], await asyncio.gather(*submissions[:2]))
+
+    async def test_invalid_actions_do_not_stop_the_server(self):
+        # given
+        async with TickServer(Multiverse(self.multiverse.instance_id, action_encoding='binary'), 0.01) as server:
+            # when
+            outcomes = await asyncio.gather(
+                server.submit(ROOT_CHARACTER_ID, Unregistered(name='x')),
+                server.submit(ROOT_CHARACTER_ID, 'not an action'),
+                server.submit(ROOT_CHARACTER_ID, CreatePlayer(player_id=None))
+            )
+            # then
+            self.assertEqual(['unknown_action', 'unknown_action', 'invalid_argument'], [o.reason for o in outcomes])
+            self.assertIsNone(await asyncio.wait_for(server.submit(ROOT_CHARACTER_ID, CreatePlayer('p')), 5))
+            # when a whole tick fails
+            with patch.object(server.multiverse, 'apply_batch', side_effect=Exception('Disk full')):
+                with self.assertRaisesRegex(Exception, 'Disk full'):
+                    await server.submit(ROOT_CHARACTER_ID, CreatePlayer('q'))
+            # then the next ticks go on
+            self.assertIsNone(await asyncio.wait_for(server.submit(ROOT_CHARACTER_ID, CreatePlayer('q')), 5))
+        mdb = Conn(f'{self.multiverse.instance_id}/multiverse.db')
+        self.assertEqual([('p',), ('q',)], mdb.all("select id from players where id != 'root' order by id"))
+        mdb.close()
+
+    async def test_queued_actions_are_resolved_on_exit(self):
+        # given
+        server = TickServer(self.multiverse, tick_seconds=60, max_tick_actions=1, queue_size=1)
+        async with server:
+            submissions = [
+                asyncio.create_task(server.submit(ROOT_CHARACTER_ID, CreatePlayer(player_id=f'player{i}')))
+                for i in range(3)
+            ]
+            await asyncio.sleep(0)
+        # when the server stops
+        outcomes = await asyncio.wait_for(asyncio.gather(*submissions), 5)
+        # then the actions left in the queue are rejected instead of waiting forever
+        self.assertIsNone(outcomes[0])
+        self.assertEqual(['stopped', 'stopped'], [outcome.reason for outcome in outcomes[1:]])
+        self.assertEqual('stopped', (await server.submit(ROOT_CHARACTER_ID, CreatePlayer('late'))).reason)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+from __future__ import annotations
+
+import os
+import shutil
+import unittest
+from uuid import uuid4
+
+from actions import CreatePlayer, CreateUniverse, CreateLocation, ConnectLocations
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from routing import Route
+from shard import ShardedMultiverse
+from testutil import Conn
+
+
+class TestShardedMultiverse(unittest.TestCase):
+    instance_id: str
+
+    def setUp(self):
+        self.instance_id = '.test-' + str(uuid4())
+
+    def tearDown(self):
+        shutil.rmtree(self.instance_id)
+
+    def test_apply_batch_across_shards(self):
+        # given
+        actions = [(CreateUniverse(), ROOT_CHARACTER_ID) for _ in range(3)]
+        actions += [
+            (CreateLocation(name=f'Location {i}', universe_id=universe_id, description='Somewhere'), ROOT_CHARACTER_ID)
+            for i in range(3)
+            for universe_id in range(1, 4)
+        ]
+        actions.append((CreatePlayer(player_id='player1'), ROOT_CHARACTER_ID))
+        actions += [
+            (
+                ConnectLocations(from_name='Location 0', to_name='Location 2', universe_id=universe_id, travel_time=5),
+                ROOT_CHARACTER_ID
+            )
+            for universe_id in range(1, 4)
+        ]
+        actions.append((CreateLocation(name='Location 0', universe_id=4, description='Nowhere'), ROOT_CHARACTER_ID))
+        actions.append((CreateLocation(name='Location 0', universe_id=1, description='Again'), ROOT_CHARACTER_ID))
+        # when
+        with ShardedMultiverse(self.instance_id, shard_count=2) as multiverse:
+            errors = multiverse.apply_batch(actions)
+            multiverse.commit()
+            route = multiverse.route(3, 'Location 0', 'Location 2')
+        # then
+        self.assertEqual([None] * 16, errors[:16])
+        self.assertEqual('not_found', errors[16].reason)
+        self.assertIsInstance(errors[17], Exception)
+        self.assertEqual(Route(['Location 0', 'Location 2'], 5), route)
+        mdb = Conn(f'{self.instance_id}/multiverse.db')
+        self.assertEqual([(1, 0), (2, 1), (3, 0)], mdb.all('select universe_id, shard from universe_shards'))
+        self.assertEqual(1, mdb.one("select value from properties where name = 'tick'")[0])
+        mdb.close()
+        for universe_id, shard in [(1, 0), (2, 1), (3, 0)]:
+            udb = Conn(f'{self.instance_id}/shard-{shard}/{universe_id}.db')
+            self.assertEqual(3, udb.count('locations'))
+            udb.close()
+
+    def test_fork_and_move_universe(self):
+        # given
+        with ShardedMultiverse(self.instance_id, shard_count=2) as multiverse:
+            multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            multiverse.apply(CreateLocation(name='Strezhevoy', universe_id=1, description='Town'), ROOT_CHARACTER_ID)
+            # when the fork lands on the other shard
+            multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+            multiverse.apply(CreateLocation(name='Tomsk', universe_id=2, description='City'), ROOT_CHARACTER_ID)
+            multiverse.commit()
+            # then
+            self.assertEqual([('Strezhevoy', 'Town')], multiverse.locations(1))
+            self.assertEqual([('Strezhevoy', 'Town'), ('Tomsk', 'City')], sorted(multiverse.locations(2)))
+            # when
+            multiverse.move_universe(2, 0)
+            multiverse.apply(CreateLocation(name='Surgut', universe_id=2, description='City'), ROOT_CHARACTER_ID)
+            multiverse.commit()
+            # then
+            self.assertEqual(3, len(multiverse.locations(2)))
+        self.assertFalse(os.path.exists(f'{self.instance_id}/shard-1/2.db'))
+        # when reopened
+        with ShardedMultiverse(self.instance_id, shard_count=2) as multiverse:
+            # then the assignment is kept
+            self.assertEqual({1: 0, 2: 0}, multiverse.assignment)
+            self.assertEqual(3, len(multiverse.locations(2)))
+
+    def test_unsupported_features(self):
+        # expect
+        for kwargs in [{'storage': 'delta'}, {'checkpoint_every_ticks': 1}, {'checkpoint_every_actions': 10}]:
+            with self.subTest(**kwargs), self.assertRaises(Exception):
+                ShardedMultiverse(self.instance_id, **kwargs)
+        with ShardedMultiverse(self.instance_id, shard_count=1) as multiverse:
+            multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            multiverse.commit()
+            with self.assertRaisesRegex(Exception, 'fork_at'):
+                multiverse.fork_at(1, 0)
+            with self.assertRaisesRegex(Exception, 'restore'):
+                multiverse.restore(0, self.instance_id + '/restored')
+
+    def test_shard_is_a_multiverse(self):
+        # given
+        with ShardedMultiverse(self.instance_id, shard_count=1) as multiverse:
+            multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            multiverse.commit()
+        # expect the universes of a shard are listed in its own multiverse database
+        with Multiverse(f'{self.instance_id}/shard-0') as shard:
+            self.assertEqual({1}, shard.universe_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
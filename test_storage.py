@@ -0,0 +1,293 @@
+from __future__ import annotations
+
+import shutil
+import unittest
+from uuid import uuid4
+
+from actions import CreateUniverse, CreateLocation, ConnectLocations
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from storage import DELTA_STORAGE, TEMPORAL_STORAGE
+from testutil import Conn
+
+
+class TestDeltaStorage(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()), storage=DELTA_STORAGE, flatten_depth=3)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.create_location(1, 'Strezhevoy', 'The best town in the world')
+        self.create_location(1, 'Beijing', 'The capital of China')
+        self.connect_locations(1, 'Strezhevoy', 'Beijing', 3510)
+        self.multiverse.commit()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_fork_stores_only_changes(self):
+        # when
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.create_location(2, 'London', 'The capital of the UK')
+        self.connect_locations(2, 'Strezhevoy', 'London', 6000)
+        self.multiverse.commit()
+        # then child reads fall through to the parent
+        self.assertEqual(
+            [
+                ('Beijing', 'The capital of China'),
+                ('London', 'The capital of the UK'),
+                ('Strezhevoy', 'The best town in the world')
+            ],
+            self.multiverse.locations(2)
+        )
+        self.assertEqual(
+            [
+                ('Beijing', 'Strezhevoy', 3510, 0),
+                ('London', 'Strezhevoy', 6000, 0),
+                ('Strezhevoy', 'Beijing', 3510, 0),
+                ('Strezhevoy', 'London', 6000, 1)
+            ],
+            self.multiverse.directions(2)
+        )
+        # and child database holds only its own rows
+        child = Conn(f'{self.multiverse.instance_id}/2.db')
+        self.assertEqual([('London',)], child.all('select name from locations'))
+        self.assertEqual(2, child.count('directions'))
+        child.close()
+        # and the parent is not affected
+        self.assertEqual(
+            [('Beijing', 'The capital of China'), ('Strezhevoy', 'The best town in the world')],
+            self.multiverse.locations(1)
+        )
+
+    def test_parent_changes_after_fork_are_invisible(self):
+        # given
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        # when
+        self.create_location(1, 'Tomsk', 'Not my favourite city')
+        self.multiverse.commit()
+        # then
+        self.assertEqual(
+            [('Beijing', 'The capital of China'), ('Strezhevoy', 'The best town in the world')],
+            self.multiverse.locations(2)
+        )
+        # and the child may create a location with the same name
+        self.create_location(2, 'Tomsk', 'Still not my favourite city')
+        self.multiverse.commit()
+        self.assertEqual(('Tomsk', 'Still not my favourite city'), self.multiverse.locations(2)[2])
+
+    def test_constraints_span_chain(self):
+        # given
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        # when duplicates and dangling connections are requested
+        self.create_location(2, 'Beijing', 'The capital of China, again')
+        self.connect_locations(2, 'Beijing', 'Strezhevoy', 100)
+        self.connect_locations(2, 'Beijing', 'Atlantis', 100)
+        self.multiverse.commit()
+        # then nothing changes
+        self.assertEqual(self.multiverse.locations(1), self.multiverse.locations(2))
+        self.assertEqual(self.multiverse.directions(1), self.multiverse.directions(2))
+
+    def test_apply_batch(self):
+        # given
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        # when
+        errors = self.multiverse.apply_batch([
+            (CreateLocation(name='London', universe_id=2, description='The capital of the UK'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='Beijing', universe_id=2, description='Duplicate'), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='London', to_name='Beijing', universe_id=2, travel_time=999), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='London', to_name='Strezhevoy', universe_id=2, travel_time=6000), ROOT_CHARACTER_ID)
+        ])
+        self.multiverse.commit()
+        # then
+        self.assertEqual([False, True, False, False], [error is not None for error in errors])
+        self.assertEqual(
+            [
+                ('Beijing', 'Strezhevoy', 3510, 0),
+                ('Beijing', 'London', 999, 1),
+                ('London', 'Beijing', 999, 0),
+                ('London', 'Strezhevoy', 6000, 1),
+                ('Strezhevoy', 'Beijing', 3510, 0),
+                ('Strezhevoy', 'London', 6000, 1)
+            ],
+            self.multiverse.directions(2)
+        )
+
+    def test_tombstones_hide_base_rows(self):
+        # given
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        child = Conn(f'{self.multiverse.instance_id}/2.db')
+        # when
+        child.connection.execute("insert into locations (name, deleted) values ('Beijing', 1)")
+        child.connection.commit()
+        child.close()
+        # then
+        self.assertEqual([('Strezhevoy', 'The best town in the world')], self.multiverse.locations(2))
+        self.assertEqual(
+            [('Beijing', 'The capital of China'), ('Strezhevoy', 'The best town in the world')],
+            self.multiverse.locations(1)
+        )
+
+    def test_flatten_deep_chain(self):
+        # when
+        for parent_id in range(1, 5):
+            self.multiverse.apply(CreateUniverse(parent_id=parent_id), ROOT_CHARACTER_ID)
+            self.create_location(parent_id + 1, f'Location {parent_id + 1}', 'Somewhere')
+        self.multiverse.commit()
+        # then the chain is cut once it reaches the configured depth
+        self.assertEqual(3, len(self.multiverse.storage.chain(3)))
+        self.assertEqual(1, len(self.multiverse.storage.chain(4)))
+        self.assertEqual(2, len(self.multiverse.storage.chain(5)))
+        self.assertEqual(
+            [
+                ('Beijing', 'The capital of China'),
+                ('Location 2', 'Somewhere'),
+                ('Location 3', 'Somewhere'),
+                ('Location 4', 'Somewhere'),
+                ('Location 5', 'Somewhere'),
+                ('Strezhevoy', 'The best town in the world')
+            ],
+            self.multiverse.locations(5)
+        )
+        self.assertEqual(self.multiverse.directions(1), self.multiverse.directions(5))
+
+    def test_reopen(self):
+        # given
+        self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+        self.create_location(2, 'London', 'The capital of the UK')
+        self.multiverse.commit()
+        # when
+        self.multiverse.__exit__()
+        self.multiverse = Multiverse(self.multiverse.instance_id, storage=DELTA_STORAGE)
+        self.multiverse.__enter__()
+        # then
+        self.assertEqual(
+            [
+                ('Beijing', 'The capital of China'),
+                ('London', 'The capital of the UK'),
+                ('Strezhevoy', 'The best town in the world')
+            ],
+            self.multiverse.locations(2)
+        )
+
+    def create_location(self, universe_id: int, name: str, description: str) -> None:
+        self.multiverse.apply(
+            CreateLocation(name=name, universe_id=universe_id, description=description),
+            ROOT_CHARACTER_ID
+        )
+
+    def connect_locations(self, universe_id: int, from_name: str, to_name: str, travel_time: int) -> None:
+        self.multiverse.apply(
+            ConnectLocations(from_name=from_name, to_name=to_name, universe_id=universe_id, travel_time=travel_time),
+            ROOT_CHARACTER_ID
+        )
+
+
+class TestTemporalStorage(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()), storage=TEMPORAL_STORAGE)
+        self.multiverse.__enter__()
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        self.create_location(1, 'Strezhevoy', 'The best town in the world')
+        self.create_location(1, 'Beijing', 'The capital of China')
+        self.connect_locations(1, 'Strezhevoy', 'Beijing', 3510)
+        self.multiverse.commit()
+        self.create_location(1, 'London', 'The capital of the UK')
+        self.connect_locations(1, 'Strezhevoy', 'London', 6000)
+        self.multiverse.commit()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_view(self):
+        # expect
+        self.assertEqual(([], []), self.as_of(0))
+        self.assertEqual(
+            (
+                [('Beijing', 'The capital of China'), ('Strezhevoy', 'The best town in the world')],
+                [('Beijing', 'Strezhevoy', 3510, 0), ('Strezhevoy', 'Beijing', 3510, 0)]
+            ),
+            self.as_of(1)
+        )
+        self.assertEqual((self.multiverse.locations(1), self.multiverse.directions(1)), self.as_of(2))
+        self.assertEqual(4, len(self.multiverse.directions(1)))
+        # and the changes of the current tick are not part of its view
+        self.create_location(1, 'Tomsk', 'A city in Siberia')
+        self.assertEqual(3, len(self.as_of(2)[0]))
+        with self.assertRaises(Exception):
+            self.multiverse.view(1, 3)
+
+    def test_fork_at(self):
+        # when
+        universe_id = self.multiverse.fork_at(1, 1)
+        # then
+        self.assertEqual(2, universe_id)
+        self.assertEqual(self.as_of(1), (self.multiverse.locations(2), self.multiverse.directions(2)))
+        # when
+        self.connect_locations(2, 'Strezhevoy', 'London', 6000)
+        self.create_location(2, 'London', 'The capital of the UK')
+        self.connect_locations(2, 'London', 'Strezhevoy', 6000)
+        # then
+        self.assertEqual(self.multiverse.directions(1), self.multiverse.directions(2))
+
+    def test_constraints(self):
+        # when
+        errors = self.multiverse.apply_batch([
+            (CreateLocation(name='Tomsk', universe_id=1, description='A city in Siberia'), ROOT_CHARACTER_ID),
+            (CreateLocation(name='London', universe_id=1, description='Again'), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='Tomsk', to_name='Beijing', universe_id=1, travel_time=300), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='Tomsk', to_name='Paris', universe_id=1, travel_time=5000), ROOT_CHARACTER_ID),
+            (ConnectLocations(from_name='Beijing', to_name='Tomsk', universe_id=1, travel_time=300), ROOT_CHARACTER_ID)
+        ])
+        # then
+        self.assertEqual([False, True, False, True, True], [error is not None for error in errors])
+        self.assertEqual(
+            [('Beijing', 'Strezhevoy', 3510, 0), ('Beijing', 'Tomsk', 300, 1)],
+            [direction for direction in self.multiverse.directions(1) if direction[0] == 'Beijing']
+        )
+
+    def test_past_views_seek_rows_existing_at_their_tick(self):
+        # given
+        conn = self.multiverse.udb(1)
+        # expect
+        for table, order in [('locations', 'name'), ('directions', 'from_name, ordinal')]:
+            plan = ' '.join(
+                row[3] for row in conn.execute(
+                    f'explain query plan select * from {table} '
+                    f'where valid_from_tick <= 1 and valid_to_tick > 1 order by {order}'
+                )
+            )
+            self.assertIn(f'SEARCH {table} USING INDEX {table}_valid_idx (valid_from_tick<?)', plan)
+
+    def test_views_require_temporal_storage(self):
+        # given
+        with Multiverse(self.multiverse.instance_id + '/copy') as multiverse:
+            multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+            # expect
+            with self.assertRaises(Exception):
+                multiverse.view(1, 0)
+
+    def as_of(self, tick: int) -> tuple[list[tuple[str, str]], list[tuple[str, str, int, int]]]:
+        view = self.multiverse.view(1, tick)
+        return view.locations, view.directions
+
+    def create_location(self, universe_id: int, name: str, description: str) -> None:
+        self.multiverse.apply(
+            CreateLocation(name=name, universe_id=universe_id, description=description),
+            ROOT_CHARACTER_ID
+        )
+
+    def connect_locations(self, universe_id: int, from_name: str, to_name: str, travel_time: int) -> None:
+        self.multiverse.apply(
+            ConnectLocations(from_name=from_name, to_name=to_name, universe_id=universe_id, travel_time=travel_time),
+            ROOT_CHARACTER_ID
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
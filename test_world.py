@@ -0,0 +1,162 @@
+from __future__ import annotations
+
+import json
+import shutil
+import unittest
+from uuid import uuid4
+
+from actions import CreateUniverse, CreateLocation, ConnectLocations, LoadWorld
+from codec import BINARY_ENCODING, JSON_ENCODING
+from multiverse import Multiverse, ROOT_CHARACTER_ID
+from storage import COPY_STORAGE, DELTA_STORAGE
+from world import world_digest
+
+
+class TestLoadWorld(unittest.TestCase):
+    multiverse: Multiverse
+
+    def setUp(self):
+        self.multiverse = Multiverse('.test-' + str(uuid4()))
+        self.multiverse.__enter__()
+
+    def tearDown(self):
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+
+    def test_load_world(self):
+        for storage in [COPY_STORAGE, DELTA_STORAGE]:
+            with self.subTest(storage=storage):
+                # given
+                self.reopen(storage)
+                self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+                self.multiverse.apply(
+                    CreateLocation(name='Strezhevoy', universe_id=1, description='The best town in the world'),
+                    ROOT_CHARACTER_ID
+                )
+                self.multiverse.apply(
+                    CreateLocation(name='Tomsk', universe_id=1, description='Not my favourite city'),
+                    ROOT_CHARACTER_ID
+                )
+                self.multiverse.apply(
+                    ConnectLocations(from_name='Strezhevoy', to_name='Tomsk', universe_id=1, travel_time=700),
+                    ROOT_CHARACTER_ID
+                )
+                self.multiverse.apply(CreateUniverse(parent_id=1), ROOT_CHARACTER_ID)
+                source = self.write_world('world.jsonl', [
+                    json.dumps({'name': 'Beijing', 'description': 'The capital of China'}),
+                    json.dumps({'from_name': 'Strezhevoy', 'to_name': 'Beijing', 'travel_time': 3510}),
+                    json.dumps({'name': 'London', 'description': 'The capital of the UK'}),
+                    '',
+                    json.dumps({'from_name': 'London', 'to_name': 'Strezhevoy', 'travel_time': 6000})
+                ])
+                # when
+                error = self.multiverse.apply(LoadWorld(universe_id=2, source=source), ROOT_CHARACTER_ID)
+                self.multiverse.commit()
+                # then
+                self.assertIsNone(error)
+                self.assertEqual(
+                    [
+                        ('Beijing', 'The capital of China'),
+                        ('London', 'The capital of the UK'),
+                        ('Strezhevoy', 'The best town in the world'),
+                        ('Tomsk', 'Not my favourite city')
+                    ],
+                    self.multiverse.locations(2)
+                )
+                self.assertEqual(
+                    [
+                        ('Beijing', 'Strezhevoy', 3510, 0),
+                        ('London', 'Strezhevoy', 6000, 0),
+                        ('Strezhevoy', 'Tomsk', 700, 0),
+                        ('Strezhevoy', 'Beijing', 3510, 1),
+                        ('Strezhevoy', 'London', 6000, 2),
+                        ('Tomsk', 'Strezhevoy', 700, 0)
+                    ],
+                    self.multiverse.directions(2)
+                )
+                self.assertEqual(2, len(self.multiverse.locations(1)))
+
+    def test_load_world_csv(self):
+        # given
+        self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+        source = self.write_world('world.csv', [
+            'location,A,Station A',
+            'location,B,"Station B, in the middle"',
+            'location,C,Station C',
+            'connection,A,B,60',
+            'connection,B,C,120'
+        ])
+        action = LoadWorld(universe_id=1, source=source)
+        # when
+        self.multiverse.record_action(0, ROOT_CHARACTER_ID, action)
+        self.multiverse.apply(action, ROOT_CHARACTER_ID)
+        self.multiverse.commit()
+        # then
+        self.assertEqual(('B', 'Station B, in the middle'), self.multiverse.locations(1)[1])
+        self.assertEqual(180, self.multiverse.route(1, 'A', 'C').travel_time)
+        # and the log holds a single entry, with the digest of the file
+        self.assertEqual(world_digest(source), action.digest)
+        self.assertEqual(
+            [(0, 0, ROOT_CHARACTER_ID, action)],
+            list(self.multiverse.logged_actions(0, 1))
+        )
+
+    def test_replay_refuses_changed_world(self):
+        for encoding in [JSON_ENCODING, BINARY_ENCODING]:
+            with self.subTest(encoding=encoding):
+                # given
+                self.reopen(COPY_STORAGE, encoding)
+                self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+                source = self.write_world('world.csv', ['location,A,Station A'])
+                self.multiverse.record_action(0, ROOT_CHARACTER_ID, LoadWorld(universe_id=1, source=source))
+                self.multiverse.commit()
+                self.write_world('world.csv', ['location,A,Station A', 'location,B,Station B'])
+                [(_, _, _, action)] = self.multiverse.logged_actions(0, 1)
+                # when
+                error = self.multiverse.apply(action, ROOT_CHARACTER_ID)
+                # then
+                self.assertEqual(f'World file has changed since it was logged: {source}', str(error))
+                self.assertEqual([], self.multiverse.locations(1))
+
+    def test_load_world_is_atomic(self):
+        for storage in [COPY_STORAGE, DELTA_STORAGE]:
+            with self.subTest(storage=storage):
+                # given
+                self.reopen(storage)
+                self.multiverse.apply(CreateUniverse(), ROOT_CHARACTER_ID)
+                source = self.write_world('world.csv', [
+                    'location,A,Station A',
+                    'location,B,Station B',
+                    'connection,A,B,60',
+                    'connection,B,Atlantis,120'
+                ])
+                # when
+                error = self.multiverse.apply(LoadWorld(universe_id=1, source=source), ROOT_CHARACTER_ID)
+                self.multiverse.commit()
+                # then
+                self.assertIsNotNone(error)
+                self.assertEqual([], self.multiverse.locations(1))
+                self.assertEqual([], self.multiverse.directions(1))
+                # and the indexes are still there
+                self.assertEqual(
+                    1,
+                    self.multiverse.udb(1).execute(
+                        "select count(*) from sqlite_master where name = 'directions_from_name_idx'"
+                    ).fetchone()[0]
+                )
+
+    def reopen(self, storage: str, action_encoding: str = JSON_ENCODING) -> None:
+        self.multiverse.__exit__()
+        shutil.rmtree(self.multiverse.instance_id)
+        self.multiverse = Multiverse(self.multiverse.instance_id, storage=storage, action_encoding=action_encoding)
+        self.multiverse.__enter__()
+
+    def write_world(self, name: str, lines: list[str]) -> str:
+        source = f'{self.multiverse.instance_id}/{name}'
+        with open(source, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return source
+
+
+if __name__ == '__main__':
+    unittest.main()
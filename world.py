@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import csv
+import json
+from hashlib import blake2b
+from typing import Iterator
+
+# A world file lists locations and the connections between them, every location before the connections using it.
+# JSON lines: {"name": ..., "description": ...} and {"from_name": ..., "to_name": ..., "travel_time": ...}
+# CSV (*.csv): location,<name>,<description> and connection,<from_name>,<to_name>,<travel_time>
+# The file is referenced by the LoadWorld action in the actions log, so it has to stay in place for replays.
+# The action also logs the digest of the file, so that a replay refuses a file changed since.
+LOCATION_RECORD = 'location'
+CONNECTION_RECORD = 'connection'
+
+# (LOCATION_RECORD, name, description) or (CONNECTION_RECORD, from_name, to_name, travel_time)
+WorldRecord = tuple[str, str, str] | tuple[str, str, str, int]
+
+
+def world_digest(source: str) -> str:
+    digest = blake2b(digest_size=16)
+    with open(source, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_world(source: str, digest: str | None = None) -> Iterator[WorldRecord]:
+    if digest is not None and world_digest(source) != digest:
+        raise Exception(f'World file has changed since it was logged: {source}')
+    with open(source, newline='', encoding='utf-8') as f:
+        if source.endswith('.csv'):
+            rows: Iterator[list[str]] = csv.reader(f)
+            for row in rows:
+                if not row:
+                    continue
+                if row[0] == LOCATION_RECORD and len(row) == 3:
+                    yield LOCATION_RECORD, row[1], row[2]
+                elif row[0] == CONNECTION_RECORD and len(row) == 4:
+                    yield connection(row[1], row[2], int(row[3]))
+                else:
+                    raise Exception(f'Invalid world record: {row}')
+        else:
+            for line in f:
+                if not line.strip():
+                    continue
+                record: dict[str, str | int] = json.loads(line)
+                if 'name' in record:
+                    yield LOCATION_RECORD, record['name'], record['description']
+                else:
+                    yield connection(record['from_name'], record['to_name'], record['travel_time'])
+
+
+def connection(from_name: str, to_name: str, travel_time: int) -> WorldRecord:
+    if from_name == to_name:
+        raise Exception('Cannot connect location to itself')
+    if travel_time < 0:
+        raise Exception('Travel time cannot be less than zero')
+    return CONNECTION_RECORD, from_name, to_name, travel_time